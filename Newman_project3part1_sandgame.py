@@ -17,9 +17,26 @@
     Internet Source: Dudraw documentation
 """
 
-import dudraw
+import csv
+import functools
+import heapq
+import json
+import multiprocessing
+import os
 import random
+import shutil
+import struct
+import tempfile
 import time
+import zlib
+from collections import deque
+from multiprocessing import shared_memory
+import numpy as np
+
+try:
+    import numba
+except ImportError:  # the compiled kernel is optional, see update_particles_compiled
+    numba = None
 
 # Particle type constants
 EMPTY = 0
@@ -31,77 +48,549 @@ EMBER = 5
 OIL = 6
 SNOW = 7
 
+# Lifetimes are counted in ticks; the game loop runs about 50 ticks a second
+TICKS_PER_SECOND = 50
+FIRE_LIFETIME = 6 * TICKS_PER_SECOND
+SNOW_MELT_TIME = 5 * TICKS_PER_SECOND
+FIRE_MELT_SPEED = 5  # snow next to fire melts this many times faster
+LIQUID_SPREAD = 16   # cells a resting liquid drop moves sideways per tick
+EMBER_CHANCE = 0.02  # chance per tick of a fire cell throwing an ember
+OIL_MAX_DEPTH = 2    # oil stacked deeper than this disappears from the top
+TERMINAL_VELOCITY = 8  # most cells a falling particle drops in one tick
+
+# Game loop timing
+MAX_FPS = 60               # frames are drawn at most this often
+MAX_TICKS_PER_FRAME = 5    # ticks run at once before the simulation slows down instead
+CLICK_DEBOUNCE = 0.2       # seconds between button presses while the mouse is held
+IDLE_TICKS = TICKS_PER_SECOND  # quiet ticks before the game loop stops simulating
+IDLE_POLL = 1 / 30         # seconds between input checks while idle
+
+# Movement rules an element can follow
+STATIC = "static"  # never moves (floor)
+POWDER = "powder"  # falls and slides off piles diagonally (sand, snow)
+POOL = "pool"      # falls, then spreads sideways across the surfaces it lists (rain)
+FLOW = "flow"      # falls, slides and flows across any surface (oil)
+RISING = "rising"  # drifts upward and is updated top to bottom (embers)
+CUSTOM = "custom"  # moved only by its own update handler (fire)
+
+class Element:
+    """
+    Describes how one particle type looks, moves, reacts and is placed.
+    """
+    
+    def __init__(self, name: str, color: tuple[int, int, int], movement: str = STATIC,
+                 density: int = 0, reactions: dict = None, sinks: dict = None,
+                 surfaces: tuple = (), aging: bool = False, brush=None, update=None):
+        """
+        Args:
+            name: label shown on the mode button
+            color: (r, g, b) color the particle is drawn with
+            movement: movement rule, one of STATIC, POWDER, POOL, FLOW, RISING or CUSTOM
+            density: a liquid floats up through a denser liquid above it
+            reactions: {neighbor type: type this particle turns into when touching it}
+            sinks: {type below: type left behind} for the particles this one sinks into
+            surfaces: types a POOL liquid spreads sideways across
+            aging: whether the particle's age is counted (see create_ages)
+            brush: (count, x reach, y reach) to scatter particles around the mouse, a
+                ParticleCreator method taking (world, x, y), or None if it can't be placed
+            update: per-cell handler taking (interaction, world, i, j, ages); defaults
+                to the handler for its movement rule
+        """
+        self.name = name
+        self.color = color
+        self.movement = movement
+        self.density = density
+        self.reactions = reactions or {}
+        self.sinks = sinks or {}
+        self.surfaces = surfaces
+        self.aging = aging
+        self.brush = brush
+        self.update = update
+
+# Registered elements by type code, and the dispatch tables compiled from
+# them. The engines build masks from these lists with a few comparisons
+# (see _of_type), which is much faster than looking every cell up in a table.
+ELEMENTS = {}
+MODES = []                                    # placeable types in mode button order
+PALETTE = np.zeros((256, 3), dtype=np.uint8)  # color of each type, indexed by cell value
+POWDERS = []
+POOLS = []
+FLOWS = []
+RISING_TYPES = []
+CUSTOM_TYPES = []
+FALLING = []     # POWDER, POOL and FLOW types
+AGING = []       # types whose age is counted
+FLAMMABLE = []   # types that turn into fire when touching fire
+SINKS = []       # (type, type below it, type left behind)
+FLOATS = []      # (liquid, denser liquid above it that it floats up through)
+SURFACES = {}    # POOL type -> types it spreads sideways across
+REACTIVE = []    # (type, neighbor, result) handled by apply_reactions
+WATCHED = []     # types the per-cell handlers look for next to a cell (see neighbor_fields)
+
+def compile_elements() -> None:
+    """
+    Rebuilds the dispatch tables from ELEMENTS. The tables are filled in
+    place, so code holding a reference to one sees the new values.
+    """
+    PALETTE.fill(0)
+    for table in (MODES, POWDERS, POOLS, FLOWS, RISING_TYPES, CUSTOM_TYPES, FALLING,
+                  AGING, FLAMMABLE, SINKS, FLOATS, REACTIVE, WATCHED):
+        table.clear()
+    SURFACES.clear()
+    rules = {POWDER: POWDERS, POOL: POOLS, FLOW: FLOWS, RISING: RISING_TYPES, CUSTOM: CUSTOM_TYPES}
+    
+    for code, element in ELEMENTS.items():
+        PALETTE[code] = element.color
+        if element.movement in rules:
+            rules[element.movement].append(code)
+        if element.aging:
+            AGING.append(code)
+        for below, left_behind in element.sinks.items():
+            SINKS.append((code, below, left_behind))
+        for neighbor, result in element.reactions.items():
+            if neighbor == FIRE and result == FIRE:
+                FLAMMABLE.append(code)
+            elif element.movement != CUSTOM:
+                REACTIVE.append((code, neighbor, result))
+        if element.movement == POOL:
+            SURFACES[code] = tuple(element.surfaces)
+        if element.brush is not None:
+            MODES.append(code)
+    FALLING.extend(POWDERS + POOLS + FLOWS)
+    # Snow melts faster next to fire, and CUSTOM elements react inside their handlers
+    WATCHED.append(FIRE)
+    for code in CUSTOM_TYPES:
+        WATCHED.extend(neighbor for neighbor in ELEMENTS[code].reactions if neighbor not in WATCHED)
+    liquids = POOLS + FLOWS
+    FLOATS.extend((light, heavy) for light in liquids for heavy in liquids
+                  if ELEMENTS[light].density < ELEMENTS[heavy].density)
+
+def register_element(code: int, element: Element) -> None:
+    """
+    Adds an element (or replaces the one with the same code) and recompiles
+    the dispatch tables.
+    
+    Args:
+        code: type code stored in the world grid, 1-255
+        element: description of the element
+    """
+    if not 0 < code < 256:
+        raise ValueError(f"element code must be between 1 and 255, got {code}")
+    ELEMENTS[code] = element
+    compile_elements()
+
+def _of_type(grid: np.ndarray, types: list[int]) -> np.ndarray:
+    """
+    Marks the cells holding any of the given particle types.
+    
+    Args:
+        grid: 2D array representing the simulation grid (or part of it)
+        types: particle type codes to look for
+        
+    Returns:
+        np.ndarray: boolean mask of matching cells
+    """
+    mask = np.zeros(grid.shape, dtype=bool)
+    for particle_type in types:
+        mask |= grid == particle_type
+    return mask
+
 # Create and initialize the sand world
-def create_world(size: int) -> list[list[int]]:
+def create_world(size: int, cols: int = None) -> np.ndarray:
     """
     Creates an empty simulation grid.
     
+    The grid is a uint8 array so it can be stepped with whole-array
+    operations, but it still supports world[i][j] indexing. For worlds too
+    large to hold densely, see ChunkedWorld.
+    
+    Args:
+        size: dimension of the square grid, or its number of rows if cols is given
+        cols: number of columns of a non-square grid
+        
+    Returns:
+        np.ndarray: size x size (or size x cols) uint8 array representing empty simulation grid
+    """
+    return np.zeros((size, cols if cols is not None else size), dtype=np.uint8)
+
+def create_ages(size: int, cols: int = None) -> np.ndarray:
+    """
+    Creates the grid of particle ages that goes with a world.
+    
+    ages[i][j] counts the ticks the fire or snow particle in cell (i, j) has
+    existed. The age moves with the particle, and every other cell is kept
+    at 0 so a new particle always starts out at age 0.
+    
+    Args:
+        size: dimension of the square grid, or its number of rows if cols is given
+        cols: number of columns of a non-square grid
+        
+    Returns:
+        np.ndarray: size x size (or size x cols) uint16 array of zeros
+    """
+    return np.zeros((size, cols if cols is not None else size), dtype=np.uint16)
+
+def create_velocities(size: int, cols: int = None) -> np.ndarray:
+    """
+    Creates the grid of falling speeds that goes with a world.
+    
+    velocities[i][j] is how many cells the particle in cell (i, j) fell
+    last tick. Like an age, the speed moves with the particle; it is 0 for
+    particles at rest and for every empty cell.
+    
     Args:
-        size: dimension of the square grid
+        size: dimension of the square grid, or its number of rows if cols is given
+        cols: number of columns of a non-square grid
         
     Returns:
-        list[list[int]]: 2D list representing empty simulation grid
+        np.ndarray: size x size (or size x cols) uint8 array of zeros
+    """
+    return np.zeros((size, cols if cols is not None else size), dtype=np.uint8)
+
+def advance_ages(world: np.ndarray, ages: np.ndarray) -> None:
+    """
+    Ends a tick: aging particles (fire and snow) get one tick older, every
+    other cell goes back to age 0.
+    
+    Args:
+        world: 2D array representing the simulation grid
+        ages: per-cell particle ages
+    """
+    aging = _of_type(world, AGING).view(np.uint8)
+    ages += aging
+    ages *= aging
+
+# Most random numbers a per-cell handler draws for one particle in one tick
+DRAWS_PER_CELL = 4
+
+class ParticleRandom:
+    """
+    Seeded random source for the particle rules.
+    
+    Numbers are generated in batches with NumPy and handed out from a plain
+    list, so a per-cell draw is little more than a list pop. Before a batch
+    of per-cell work (a tick, or placing particles) call refill() with the
+    most numbers it can use; the engines do this once per tick. Without
+    it, random() still works, generating a new batch whenever the buffer
+    runs dry, so handlers can also be called on their own. The same seed
+    and the same inputs always give the same world.
     """
-    return [[EMPTY for _ in range(size)] for _ in range(size)]
+    
+    def __init__(self, seed: int = None, batch: int = 4096):
+        """
+        Args:
+            seed: seed for the generator, or None for a random one
+            batch: smallest number of values generated at a time
+        """
+        self.seed = seed
+        self.batch = batch
+        self.generator = np.random.default_rng(seed)
+        # random() draws with the buffer's own pop, so the buffer is only
+        # ever changed in place
+        self.floats = []
+        self._pop = self.floats.pop
+        # While compiled code is drawing, the buffer lives in this array
+        # instead, in the same order; only the first array_used are left
+        self.array = None
+        self.array_used = 0
+    
+    def random(self) -> float:
+        """
+        Draws the next number, refilling the buffer first if it is empty.
+        
+        Returns:
+            float: uniform random number in [0, 1)
+        """
+        try:
+            return self._pop()
+        except IndexError:
+            self.refill(1)
+            return self._pop()
+    
+    def _unload_array(self) -> None:
+        """Moves numbers left over in the array back into the list."""
+        if self.array is not None:
+            self.floats[:0] = self.array[:self.array_used].tolist()
+            self.array = None
+            self.array_used = 0
+    
+    def refill(self, count: int) -> None:
+        """
+        Makes sure at least count numbers are buffered. The buffer is topped
+        up to twice that, so work that uses far fewer numbers than it could
+        doesn't generate a batch every time.
+        
+        Args:
+            count: numbers the coming work can draw
+        """
+        self._unload_array()
+        if len(self.floats) < count:
+            # New numbers go in front, since the buffer is popped from the end
+            self.floats[:0] = self.generator.random(max(2 * count - len(self.floats), self.batch)).tolist()
+    
+    def refill_array(self, count: int) -> tuple[np.ndarray, int]:
+        """
+        Like refill, but hands the buffer over as an array for compiled
+        code, which draws from the end just like random(). Pass the number
+        left afterward to release_array. The numbers drawn are the same as
+        with refill and random().
+        
+        Args:
+            count: numbers the coming work can draw
+            
+        Returns:
+            tuple: (buffer, numbers in it)
+        """
+        if self.array is None:
+            self.array = np.array(self.floats, dtype=np.float64)
+            self.array_used = len(self.floats)
+            del self.floats[:]
+        if self.array_used < count:
+            fresh = self.generator.random(max(2 * count - self.array_used, self.batch))
+            self.array = np.concatenate((fresh, self.array[:self.array_used]))
+            self.array_used = len(self.array)
+        return self.array, self.array_used
+    
+    def release_array(self, remaining: int) -> None:
+        """
+        Takes the buffer back from compiled code.
+        
+        Args:
+            remaining: numbers left at the front of the array
+        """
+        self.array_used = remaining
+    
+    def coin_flips(self, shape: tuple[int, int]) -> np.ndarray:
+        """
+        Draws a grid of random booleans.
+        
+        Args:
+            shape: (rows, cols) of the grid
+            
+        Returns:
+            np.ndarray: boolean array, each cell True with probability 1/2
+        """
+        size = int(np.prod(shape))
+        bits = np.frombuffer(self.generator.bytes(size // 8 + 1), dtype=np.uint8)
+        return np.unpackbits(bits, count=size).view(bool).reshape(shape)
+    
+    def seeds(self, count: int) -> list[int]:
+        """
+        Draws seeds for other ParticleRandoms, e.g. in worker processes.
+        
+        Args:
+            count: number of seeds
+            
+        Returns:
+            list[int]: the seeds
+        """
+        return self.generator.integers(0, 2**63, count).tolist()
+    
+    def getstate(self) -> bytes:
+        """
+        Packs the generator state and the buffered numbers.
+        
+        Returns:
+            bytes: state to pass to setstate
+        """
+        self._unload_array()
+        state = self.generator.bit_generator.state
+        header = _RANDOM_STATE.pack(state["state"]["state"].to_bytes(16, "little"),
+                                    state["state"]["inc"].to_bytes(16, "little"),
+                                    bool(state["has_uint32"]), state["uinteger"], self.batch)
+        return header + np.array(self.floats, dtype="<f8").tobytes()
+    
+    def setstate(self, data) -> None:
+        """
+        Restores a state saved with getstate.
+        
+        Args:
+            data: packed state
+        """
+        data = bytes(data)
+        self.array = None
+        self.array_used = 0
+        state, inc, has_uint32, uinteger, self.batch = _RANDOM_STATE.unpack_from(data)
+        self.generator.bit_generator.state = {
+            "bit_generator": "PCG64",
+            "state": {"state": int.from_bytes(state, "little"), "inc": int.from_bytes(inc, "little")},
+            "has_uint32": int(has_uint32),
+            "uinteger": uinteger,
+        }
+        self.floats[:] = np.frombuffer(data, dtype="<f8", offset=_RANDOM_STATE.size).tolist()
+
+# PCG64 state and increment, has_uint32, uinteger, batch size
+_RANDOM_STATE = struct.Struct("<16s16s?QI")
+
+# Used when no ParticleRandom is passed in
+DEFAULT_RANDOM = ParticleRandom()
 
 # Draw the sand world
-def draw_world(world: list[list[int]]) -> None:
+def _build_flicker_tables(seed: int = 1351) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Precomputes the colors that fire and embers flicker between.
+    
+    Each table has 256 entries so a byte of noise picks a color. About 30%
+    of the fire entries are side-flame colors and the rest are shades of the
+    main flame, matching the odds of the per-cell renderer.
+    
+    Args:
+        seed: seed for the table contents, so frames look the same run to run
+        
+    Returns:
+        tuple: (fire colors, ember colors, noise bytes)
+    """
+    rng = np.random.default_rng(seed)
+    flame_colors = np.array([(255, 0, 0), (255, 178, 0), (255, 128, 0)], dtype=np.uint8)
+    fire = np.zeros((256, 3), dtype=np.uint8)
+    fire[:, 0] = (rng.uniform(0.8, 1.0, 256) * 255).astype(np.uint8)
+    fire[:, 1] = int(0.4 * 255)
+    side_flames = rng.random(256) < 0.3
+    fire[side_flames] = flame_colors[rng.integers(0, 3, side_flames.sum())]
+    
+    ember_colors = np.array([(255, 100, 0), (200, 80, 0), (150, 150, 150)], dtype=np.uint8)
+    ember = ember_colors[rng.integers(0, 3, 256)]
+    
+    # A prime length keeps neighbouring cells from lining up on the same noise
+    noise = rng.integers(0, 256, 4093, dtype=np.uint8)
+    return fire, ember, noise
+
+
+def _dudraw_private(name: str):
+    """
+    Looks up a private attribute of dudraw's module.
+    
+    dudraw has no call to draw an image from memory or to read input
+    without redrawing, so the renderer and the idle game loop reach into
+    its module globals for those, only through here. They exist in the
+    dudraw version recorded in requirements.txt; when another version
+    doesn't have them, callers fall back to slower public calls.
+    
+    Args:
+        name: attribute of the dudraw.dudraw module, e.g. "_surface"
+        
+    Returns:
+        the attribute, or None if this dudraw doesn't have it
+    """
+    import dudraw
+    
+    return getattr(getattr(dudraw, "dudraw", None), name, None)
+
+
+class FrameRenderer:
+    """
+    Draws the world as one image instead of one shape per particle.
+    
+    The grid is turned into an RGB pixel buffer through PALETTE, fire and
+    embers are colored from precomputed flicker tables, and the buffer is
+    scaled onto the dudraw canvas in a single blit.
+    """
+    
+    def __init__(self):
+        """Builds the flicker tables used for every frame."""
+        self.fire_colors, self.ember_colors, self.noise = _build_flicker_tables()
+    
+    def _flicker(self, world: np.ndarray, particle_type: int, colors: np.ndarray,
+                 pixels: np.ndarray) -> None:
+        """
+        Colors every cell of one flickering type from its table.
+        
+        Args:
+            world: 2D array representing the simulation grid
+            particle_type: FIRE or EMBER
+            colors: 256-entry color table for that type
+            pixels: flat (cells, 3) RGB buffer to write into
+        """
+        cells = np.flatnonzero(world == particle_type)
+        if len(cells):
+            offset = random.randrange(len(self.noise))
+            pixels[cells] = colors[self.noise[(cells + offset) % len(self.noise)]]
+    
+    def render(self, world: np.ndarray) -> np.ndarray:
+        """
+        Builds the RGB image of the world, one pixel per cell.
+        
+        Args:
+            world: 2D array representing the simulation grid
+            
+        Returns:
+            np.ndarray: (rows, columns, 3) uint8 array, top row first
+        """
+        world = np.asarray(world, dtype=np.uint8)
+        pixels = PALETTE[world]
+        flat = pixels.reshape(-1, 3)
+        flat_world = world.reshape(-1)
+        self._flicker(flat_world, FIRE, self.fire_colors, flat)
+        self._flicker(flat_world, EMBER, self.ember_colors, flat)
+        return pixels
+    
+    def draw(self, world: np.ndarray) -> None:
+        """
+        Renders the world and copies it onto the dudraw canvas.
+        
+        Args:
+            world: 2D array representing the simulation grid
+        """
+        self.blit(self.render(world))
+    
+    def blit(self, pixels: np.ndarray) -> None:
+        """
+        Copies a rendered image onto the dudraw canvas, scaled to fill it.
+        
+        Args:
+            pixels: (rows, columns, 3) uint8 image from render()
+        """
+        import pygame
+        
+        rows, columns = pixels.shape[:2]
+        # dudraw has no image-from-array call, so draw on its canvas surface
+        create_window = _dudraw_private("_make_sure_window_created")
+        if create_window is not None:
+            create_window()
+        canvas = _dudraw_private("_surface")
+        if canvas is None:
+            self._draw_runs(pixels)
+            return
+        image = pygame.image.frombuffer(pixels.tobytes(), (columns, rows), "RGB")
+        canvas.blit(pygame.transform.scale(image, canvas.get_size()), (0, 0))
+    
+    def _draw_runs(self, pixels: np.ndarray) -> None:
+        """
+        Draws an image with public dudraw calls only, one rectangle per run
+        of same-colored pixels in a row. Slower than blit's canvas copy;
+        used when dudraw doesn't expose its canvas. Assumes the canvas
+        scale starts at 0 on both axes, as main sets it.
+        
+        Args:
+            pixels: (rows, columns, 3) uint8 image from render()
+        """
+        import dudraw
+        
+        rows, columns = pixels.shape[:2]
+        cell_w, cell_h = dudraw.get_canvas_width() / columns, dudraw.get_canvas_height() / rows
+        packed = pixels.astype(np.uint32) @ np.array([1 << 16, 1 << 8, 1], dtype=np.uint32)
+        for i, row in enumerate(packed):
+            starts = np.flatnonzero(np.diff(row, prepend=row[0] ^ 1))
+            ends = np.append(starts[1:], columns)
+            y = (rows - i - 0.5) * cell_h
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                dudraw.set_pen_color_rgb(*pixels[i, start].tolist())
+                dudraw.filled_rectangle((start + end) / 2 * cell_w, y, (end - start) / 2 * cell_w, cell_h / 2)
+
+
+def draw_world(world: np.ndarray, renderer: FrameRenderer = None) -> None:
     """
     Draws the current state of the simulation.
     
     Args:
-        world: 2D list representing the simulation grid
+        world: 2D array representing the simulation grid
+        renderer: FrameRenderer to reuse between frames (a new one is made if None)
     """
-    size = len(world)
-    dudraw.clear(dudraw.BLACK)
-    for i in range(size):
-        for j in range(size):
-            if world[i][j] == SAND:
-                dudraw.set_pen_color(dudraw.YELLOW)
-                dudraw.filled_square(j + 0.5, size - i - 0.5, 0.5)
-            elif world[i][j] == RAIN:
-                dudraw.set_pen_color(dudraw.BLUE)
-                dudraw.filled_square(j + 0.5, size - i - 0.5, 0.5)
-            elif world[i][j] == FLOOR:
-                dudraw.set_pen_color(dudraw.GRAY)
-                dudraw.filled_square(j + 0.5, size - i - 0.5, 0.5)
-            elif world[i][j] == FIRE:
-                # Main fire
-                r = int(random.uniform(0.8, 1.0) * 255)
-                g = int(0.4 * 255)
-                b = 0
-                dudraw.set_pen_color_rgb(r, g, b)
-                dudraw.filled_square(j + 0.5, size - i - 0.5, 0.5)
-                
-                # Side flame particles
-                if random.random() < 0.3:
-                    flame_colors = [
-                        (255, 0, 0),    # Red
-                        (255, 178, 0),  # Yellow
-                        (255, 128, 0)   # Orange
-                    ]
-                    color = random.choice(flame_colors)
-                    dudraw.set_pen_color_rgb(*color)
-                    offset = random.uniform(-0.3, 0.3)
-                    dudraw.filled_circle(j + 0.5 + offset, size - i - 0.2, 0.2)
-            elif world[i][j] == EMBER:
-                # Draw rising embers
-                ember_colors = [
-                    (255, 100, 0),   # Orange
-                    (200, 80, 0),    # Dark orange
-                    (150, 150, 150)  # Smoke gray
-                ]
-                color = random.choice(ember_colors)
-                dudraw.set_pen_color_rgb(*color)
-                offset_x = random.uniform(-0.2, 0.2)
-                dudraw.filled_circle(j + 0.5 + offset_x, size - i - 0.5, 0.15)
-            elif world[i][j] == OIL:
-                dudraw.set_pen_color_rgb(139, 69, 19)  # Brown color for oil
-                dudraw.filled_square(j + 0.5, size - i - 0.5, 0.5)
-            elif world[i][j] == SNOW:
-                dudraw.set_pen_color(dudraw.WHITE)
-                dudraw.filled_square(j + 0.5, size - i - 0.5, 0.5)
+    import dudraw
     
+    if renderer is None:
+        renderer = FrameRenderer()
+    renderer.draw(world)
     dudraw.show()
 
 class ParticleCreator:
@@ -109,26 +598,52 @@ class ParticleCreator:
     Handles the creation of different particle types in the simulation.
     """
     
-    def create_sand(self, world: list[list[int]], x: int, y: int) -> None:
+    def __init__(self, rng: ParticleRandom = None):
         """
-        Creates sand particles in a small radius around the given position.
+        Args:
+            rng: random source for scattering particles (defaults to DEFAULT_RANDOM)
+        """
+        self.rng = rng or DEFAULT_RANDOM
+    
+    def create(self, world: list[list[int]], x: int, y: int, particle_type: int) -> None:
+        """
+        Places particles of any registered type with that element's brush.
         
         Args:
             world: 2D list representing the simulation grid
             x: x-coordinate for particle placement
             y: y-coordinate for particle placement
+            particle_type: type of particle to place
         """
-        size = len(world)
-        for _ in range(5):
+        brush = ELEMENTS[particle_type].brush
+        if callable(brush):
+            brush(self, world, x, y)
+            return
+        count, reach_x, reach_y = brush
+        rows, cols = len(world), len(world[0])
+        random = self.rng.random
+        self.rng.refill(2 * count)
+        for _ in range(count):
             # Random spread in both directions
-            dx = random.randint(-2, 2)
-            dy = random.randint(-2, 2)
+            dx = int(random() * (2 * reach_x + 1)) - reach_x
+            dy = int(random() * (2 * reach_y + 1)) - reach_y
             nx, ny = x + dx, y + dy
             # Only place in empty spaces
-            if (0 <= nx < size and 0 <= ny < size and 
+            if (0 <= nx < cols and 0 <= ny < rows and 
                 world[ny][nx] == EMPTY):
-                world[ny][nx] = SAND
+                world[ny][nx] = particle_type
     
+    def create_sand(self, world: list[list[int]], x: int, y: int) -> None:
+        """
+        Creates sand particles in a small radius around the given position.
+        
+        Args:
+            world: 2D list representing the simulation grid
+            x: x-coordinate for particle placement
+            y: y-coordinate for particle placement
+        """
+        self.create(world, x, y, SAND)
+
     def create_rain(self, world: list[list[int]], x: int, y: int) -> None:
         """
         Creates rain particles in a wider horizontal spread.
@@ -138,35 +653,19 @@ class ParticleCreator:
             x: x-coordinate for particle placement
             y: y-coordinate for particle placement
         """
-        size = len(world)
-        for _ in range(5):
-            dx = random.randint(-4, 4)
-            dy = random.randint(-1, 1)
-            nx, ny = x + dx, y + dy
-            if (0 <= nx < size and 0 <= ny < size and 
-                world[ny][nx] == EMPTY):
-                world[ny][nx] = RAIN
-    
-    def create_fire(self, world: list[list[int]], x: int, y: int, fire_timers: dict) -> None:
+        self.create(world, x, y, RAIN)
+
+    def create_fire(self, world: list[list[int]], x: int, y: int) -> None:
         """
-        Creates fire particles in a small radius with timing information.
+        Creates fire particles in a small radius.
         
         Args:
             world: 2D list representing the simulation grid
             x: x-coordinate for fire placement
             y: y-coordinate for fire placement
-            fire_timers: dictionary tracking fire particle lifetimes
         """
-        size = len(world)
-        for _ in range(3):
-            dx = random.randint(-2, 2)
-            dy = random.randint(-2, 2)
-            nx, ny = x + dx, y + dy
-            if (0 <= nx < size and 0 <= ny < size and 
-                world[ny][nx] == EMPTY):
-                world[ny][nx] = FIRE
-                fire_timers[(ny,nx)] = time.time()
-    
+        self.create(world, x, y, FIRE)
+
     def create_floor(self, world: list[list[int]], x: int, y: int) -> None:
         """
         Creates a solid 7x3 floor block centered at the given position.
@@ -176,14 +675,26 @@ class ParticleCreator:
             x: x-coordinate for floor center
             y: y-coordinate for floor bottom
         """
-        size = len(world)
+        rows, cols = len(world), len(world[0])
         for dy in range(3):
             for dx in range(-3, 4):
                 nx = x + dx
                 ny = y + dy
-                if 0 <= nx < size and 0 <= ny < size:
+                if 0 <= nx < cols and 0 <= ny < rows:
                     world[ny][nx] = FLOOR
     
+    def place_floor(self, world: list[list[int]], x: int, y: int) -> None:
+        """
+        Creates a floor block, but only where it won't overlap other particles.
+        
+        Args:
+            world: 2D list representing the simulation grid
+            x: x-coordinate for floor center
+            y: y-coordinate for floor bottom
+        """
+        if self.can_place_floor(world, x, y):
+            self.create_floor(world, x, y)
+    
     def can_place_floor(self, world: list[list[int]], x: int, y: int) -> bool:
         """
         Checks if a 7x3 floor block can be placed without overlapping other particles.
@@ -196,12 +707,12 @@ class ParticleCreator:
         Returns:
             bool: True if floor can be placed, False if space is occupied
         """
-        size = len(world)
+        rows, cols = len(world), len(world[0])
         for dy in range(3):
             for dx in range(-3, 4):
                 nx = x + dx
                 ny = y + dy
-                if (0 <= nx < size and 0 <= ny < size and 
+                if (0 <= nx < cols and 0 <= ny < rows and 
                     world[ny][nx] != EMPTY):
                     return False
         return True
@@ -215,15 +726,8 @@ class ParticleCreator:
             x: x-coordinate for oil placement
             y: y-coordinate for oil placement
         """
-        size = len(world)
-        for _ in range(5):
-            dx = random.randint(-3, 3)
-            dy = random.randint(-1, 1)
-            nx, ny = x + dx, y + dy
-            if (0 <= nx < size and 0 <= ny < size and 
-                world[ny][nx] == EMPTY):
-                world[ny][nx] = OIL
-    
+        self.create(world, x, y, OIL)
+
     def create_snow(self, world: list[list[int]], x: int, y: int) -> None:
         """
         Creates snow particles in a small radius around the given position.
@@ -233,84 +737,307 @@ class ParticleCreator:
             x: x-coordinate for snow placement
             y: y-coordinate for snow placement
         """
-        size = len(world)
-        for _ in range(5):
-            dx = random.randint(-2, 2)
-            dy = random.randint(-2, 2)
-            nx, ny = x + dx, y + dy
-            if (0 <= nx < size and 0 <= ny < size and 
-                world[ny][nx] == EMPTY):
-                world[ny][nx] = SNOW
+        self.create(world, x, y, SNOW)
 
-class ParticleMovement:
-    """
-    Handles movement mechanics for all particle types.
-    """
-    
-    def apply_gravity(self, world: list[list[int]], i: int, j: int, particle_type: int) -> bool:
+    def fill(self, world: np.ndarray, mask: np.ndarray, particle_type: int, top: int = 0,
+             left: int = 0, density: float = 1.0) -> int:
         """
-        Applies gravity to a particle, making it fall if possible.
+        Places particles in every marked cell of a mask in one write. Like
+        the brushes, particles only go into empty cells, and a FLOOR shape
+        (like place_floor) isn't placed at all if it would cover anything
+        but floor.
         
         Args:
-            world: 2D list representing the simulation grid
-            i: current row index
-            j: current column index
-            particle_type: type of particle to move
+            world: 2D array representing the simulation grid
+            mask: boolean mask of the cells to fill; may reach past the world's edges
+            particle_type: type of particle to place
+            top: world row of the mask's first row
+            left: world column of the mask's first column
+            density: chance of each marked cell getting a particle, 0 to 1
             
         Returns:
-            bool: True if particle moved down, False otherwise
+            int: number of particles placed
         """
-        size = len(world)
-        if i < size-1 and world[i+1][j] == EMPTY:
-            world[i][j] = EMPTY
-            world[i+1][j] = particle_type
-            return True
-        return False
+        if not 0 <= density <= 1:
+            raise ValueError(f"density must be between 0 and 1, got {density}")
+        rows, cols = world.shape
+        mask = np.asarray(mask, dtype=bool)
+        # Clip the mask to the world
+        top_in, left_in = max(top, 0), max(left, 0)
+        bottom, right = min(top + mask.shape[0], rows), min(left + mask.shape[1], cols)
+        if top_in >= bottom or left_in >= right:
+            return 0
+        mask = mask[top_in - top:bottom - top, left_in - left:right - left]
+        window = world[top_in:bottom, left_in:right]
+        if particle_type == FLOOR and np.any(mask & (window != EMPTY) & (window != FLOOR)):
+            return 0
+        if density < 1:
+            mask = mask & (self.rng.generator.random(mask.shape) < density)
+        mask &= window == EMPTY
+        window[mask] = particle_type
+        return int(np.count_nonzero(mask))
     
-    def move_sideways(self, world: list[list[int]], i: int, j: int, particle_type: int) -> bool:
+    def rect(self, world: np.ndarray, x: int, y: int, width: int, height: int,
+             particle_type: int, density: float = 1.0) -> int:
         """
-        Attempts to move a particle diagonally down-left or down-right.
+        Fills a rectangle with particles (see fill).
         
         Args:
-            world: 2D list representing the simulation grid
-            i: current row index
-            j: current column index
-            particle_type: type of particle to move
+            world: 2D array representing the simulation grid
+            x: column of the left edge
+            y: row of the top edge
+            width: width in cells
+            height: height in cells
+            particle_type: type of particle to place
+            density: chance of each cell getting a particle, 0 to 1
             
         Returns:
-            bool: True if particle moved diagonally, False otherwise
+            int: number of particles placed
         """
-        size = len(world)
-        direction = random.choice([-1, 1])
-        if (j + direction >= 0 and j + direction < size and 
-            world[i + 1][j + direction] == EMPTY):
-            world[i][j] = EMPTY
-            world[i + 1][j + direction] = particle_type
-            return True
-        return False
-    
-    def move_ember(self, world: list[list[int]], i: int, j: int) -> None:
-        size = len(world)
-        if random.random() < 0.3:
-            new_j = j + random.choice([-1, 1]) if random.random() < 0.2 else j
-            if (i > 0 and 0 <= new_j < size and 
-                world[i-1][new_j] == EMPTY):
-                world[i][j] = EMPTY
-                world[i-1][new_j] = EMBER
-            elif (i == 0 or world[i-1][j] != EMPTY):
-                world[i][j] = EMPTY
+        return self.fill(world, np.ones((max(height, 0), max(width, 0)), dtype=bool),
+                         particle_type, y, x, density)
     
-    def float_up(self, world: list[list[int]], i: int, j: int, particle_type: int) -> bool:
-        """Makes particles float up through specific materials"""
-        size = len(world)
-        # Check if particle can float up through water
-        if i > 0 and world[i-1][j] == RAIN:
-            world[i][j] = RAIN
-            world[i-1][j] = particle_type
-            return True
-        return False
-    
-    def flow_to_lowest_point(self, world: list[list[int]], i: int, j: int, particle_type: int) -> bool:
+    def circle(self, world: np.ndarray, x: int, y: int, radius: float, particle_type: int,
+               density: float = 1.0) -> int:
+        """
+        Fills a disk with particles (see fill).
+        
+        Args:
+            world: 2D array representing the simulation grid
+            x: column of the center
+            y: row of the center
+            radius: radius in cells
+            particle_type: type of particle to place
+            density: chance of each cell getting a particle, 0 to 1
+            
+        Returns:
+            int: number of particles placed
+        """
+        reach = int(radius)
+        dy, dx = np.ogrid[-reach:reach + 1, -reach:reach + 1]
+        return self.fill(world, dx * dx + dy * dy <= radius * radius, particle_type,
+                         y - reach, x - reach, density)
+    
+    def line(self, world: np.ndarray, x0: int, y0: int, x1: int, y1: int, particle_type: int,
+             width: float = 1, density: float = 1.0) -> int:
+        """
+        Fills a straight line with particles (see fill).
+        
+        Args:
+            world: 2D array representing the simulation grid
+            x0, y0: column and row of one end
+            x1, y1: column and row of the other end
+            particle_type: type of particle to place
+            width: thickness in cells
+            density: chance of each cell getting a particle, 0 to 1
+            
+        Returns:
+            int: number of particles placed
+        """
+        half = width / 2
+        reach = int(np.ceil(half))
+        top, left = min(y0, y1) - reach, min(x0, x1) - reach
+        rows = np.arange(top, max(y0, y1) + reach + 1)[:, None]
+        cols = np.arange(left, max(x0, x1) + reach + 1)[None, :]
+        # Distance from each cell to the closest point of the segment
+        dx, dy = x1 - x0, y1 - y0
+        length = dx * dx + dy * dy
+        t = 0 if length == 0 else np.clip(((cols - x0) * dx + (rows - y0) * dy) / length, 0, 1)
+        distance = (cols - x0 - t * dx) ** 2 + (rows - y0 - t * dy) ** 2
+        return self.fill(world, distance <= half * half, particle_type, top, left, density)
+    
+    def polygon(self, world: np.ndarray, points: list[tuple[int, int]], particle_type: int,
+                density: float = 1.0) -> int:
+        """
+        Fills a polygon with particles (see fill). Cells are inside when
+        their center is, by the even-odd rule.
+        
+        Args:
+            world: 2D array representing the simulation grid
+            points: (column, row) corners in order
+            particle_type: type of particle to place
+            density: chance of each cell getting a particle, 0 to 1
+            
+        Returns:
+            int: number of particles placed
+        """
+        if len(points) < 3:
+            raise ValueError(f"a polygon needs at least 3 points, got {len(points)}")
+        xs, ys = np.array(points, dtype=float).T
+        top, left = int(np.floor(ys.min())), int(np.floor(xs.min()))
+        rows = np.arange(top, int(np.ceil(ys.max())) + 1)[:, None]
+        cols = np.arange(left, int(np.ceil(xs.max())) + 1)[None, :]
+        inside = np.zeros((rows.shape[0], cols.shape[1]), dtype=bool)
+        # Flip for every edge a ray from the cell to the right crosses
+        for ax, ay, bx, by in zip(xs, ys, np.roll(xs, -1), np.roll(ys, -1)):
+            if ay == by:
+                continue
+            spans = (ay > rows) != (by > rows)
+            crossing = ax + (rows - ay) * (bx - ax) / (by - ay)
+            inside ^= spans & (cols < crossing)
+        return self.fill(world, inside, particle_type, top, left, density)
+    
+    @staticmethod
+    def reach(particle_type: int) -> tuple[int, int, int, int]:
+        """
+        Returns how far an element's brush places particles from where it
+        is clicked.
+        
+        Args:
+            particle_type: type of particle the brush places
+            
+        Returns:
+            tuple: (left, right, up, down) reach in cells, all 0 for an
+            element with no brush
+        """
+        brush = ELEMENTS[particle_type].brush
+        if brush is None:
+            return 0, 0, 0, 0
+        if callable(brush):
+            # Floor blocks reach 3 cells left and right and 2 rows down
+            return 3, 3, 0, 2
+        _, reach_x, reach_y = brush
+        return reach_x, reach_x, reach_y, reach_y
+    
+    def stroke(self, world: np.ndarray, x0: int, y0: int, x1: int, y1: int, particle_type: int) -> int:
+        """
+        Places an element's brush all along a line, e.g. between two mouse
+        samples, so a fast drag leaves no gaps. Every cell the brush passes
+        over gets a particle with the chance the brush fills a cell in one
+        click; a placing function like FLOOR's sweeps its 7x3 block. A
+        stroke that doesn't move is a single click.
+        
+        Args:
+            world: 2D array representing the simulation grid
+            x0, y0: column and row the stroke starts at
+            x1, y1: column and row it ends at
+            particle_type: type of particle to place
+            
+        Returns:
+            int: number of particles placed
+        """
+        brush = ELEMENTS[particle_type].brush
+        if brush is None:
+            return 0
+        if callable(brush):
+            density = 1.0
+        else:
+            count, reach_x, reach_y = brush
+            density = min(count / ((2 * reach_x + 1) * (2 * reach_y + 1)), 1.0)
+        left_reach, right_reach, up_reach, down_reach = self.reach(particle_type)
+        if (x0, y0) == (x1, y1):
+            # Count what the click placed within the brush's reach
+            box = (slice(max(y1 - up_reach, 0), max(y1 + down_reach + 1, 0)),
+                   slice(max(x1 - left_reach, 0), max(x1 + right_reach + 1, 0)))
+            before = np.count_nonzero(world[box] == particle_type)
+            self.create(world, x1, y1, particle_type)
+            return int(np.count_nonzero(world[box] == particle_type) - before)
+        top, left = min(y0, y1) - up_reach, min(x0, x1) - left_reach
+        rows = np.arange(top, max(y0, y1) + down_reach + 1)[:, None]
+        cols = np.arange(left, max(x0, x1) + right_reach + 1)[None, :]
+        # The brush covers a cell at some point t in [0, 1] along the line
+        # when it is in reach both across and down; intersect those ranges
+        low, high = np.zeros(1), np.ones(1)
+        for cells, start, end, before, after in ((cols, x0, x1, left_reach, right_reach),
+                                                 (rows, y0, y1, up_reach, down_reach)):
+            if start == end:
+                covered = (cells >= start - before) & (cells <= start + after)
+                high = np.where(covered, high, -1.0)
+                continue
+            a, b = (cells - after - start) / (end - start), (cells + before - start) / (end - start)
+            low, high = np.maximum(low, np.minimum(a, b)), np.minimum(high, np.maximum(a, b))
+        return self.fill(world, low <= high, particle_type, top, left, density)
+
+class ParticleMovement:
+    """
+    Handles movement mechanics for all particle types.
+    """
+    
+    def __init__(self, rng: ParticleRandom = None, liquid_spread: int = LIQUID_SPREAD):
+        """
+        Args:
+            rng: random source for the movement rules (defaults to DEFAULT_RANDOM)
+            liquid_spread: cells a liquid drop moves sideways per tick, or None
+                to drop straight into the nearest gap
+        """
+        self.rng = rng or DEFAULT_RANDOM
+        self.liquid_spread = liquid_spread
+        # Cells drops spread from and into this tick, so a drop is only
+        # moved once and the others still see where it started
+        self.spread_from = set()
+        self.spread_to = set()
+    
+    def apply_gravity(self, world: list[list[int]], i: int, j: int, particle_type: int) -> bool:
+        """
+        Applies gravity to a particle, making it fall if possible.
+        
+        Args:
+            world: 2D list representing the simulation grid
+            i: current row index
+            j: current column index
+            particle_type: type of particle to move
+            
+        Returns:
+            bool: True if particle moved down, False otherwise
+        """
+        size = len(world)
+        if i < size-1 and world[i+1][j] == EMPTY:
+            world[i][j] = EMPTY
+            world[i+1][j] = particle_type
+            return True
+        return False
+    
+    def move_sideways(self, world: list[list[int]], i: int, j: int, particle_type: int,
+                      ages: np.ndarray = None) -> bool:
+        """
+        Attempts to move a particle diagonally down-left or down-right,
+        trying a random side first and then the other one.
+        
+        Args:
+            world: 2D list representing the simulation grid
+            i: current row index
+            j: current column index
+            particle_type: type of particle to move
+            ages: per-cell particle ages to move along with the particle, if it has one
+            
+        Returns:
+            bool: True if particle moved diagonally, False otherwise
+        """
+        width = len(world[0])
+        direction = -1 if self.rng.random() < 0.5 else 1
+        for dx in (direction, -direction):
+            if (j + dx >= 0 and j + dx < width and 
+                world[i + 1][j + dx] == EMPTY):
+                world[i][j] = EMPTY
+                world[i + 1][j + dx] = particle_type
+                if ages is not None:
+                    ages[i + 1][j + dx] = ages[i][j]
+                return True
+        return False
+    
+    def move_ember(self, world: list[list[int]], i: int, j: int) -> None:
+        """Makes rising particles like embers drift up"""
+        width = len(world[0])
+        random = self.rng.random
+        if random() < 0.3:
+            new_j = j + (-1 if random() < 0.5 else 1) if random() < 0.2 else j
+            if (i > 0 and 0 <= new_j < width and 
+                world[i-1][new_j] == EMPTY):
+                world[i-1][new_j] = world[i][j]
+                world[i][j] = EMPTY
+            elif (i == 0 or world[i-1][j] != EMPTY):
+                world[i][j] = EMPTY
+    
+    def float_up(self, world: list[list[int]], i: int, j: int, particle_type: int) -> bool:
+        """Makes particles float up through denser liquids"""
+        # Check if particle can float up through a heavier liquid (oil through water)
+        if i > 0 and (particle_type, world[i-1][j]) in FLOATS:
+            world[i][j] = world[i-1][j]
+            world[i-1][j] = particle_type
+            return True
+        return False
+    
+    def flow_to_lowest_point(self, world: list[list[int]], i: int, j: int, particle_type: int) -> bool:
         """
         Makes liquid particles flow towards the lowest available point.
         
@@ -324,7 +1051,6 @@ class ParticleMovement:
             bool: True if particle moved, False otherwise
         """
         size = len(world)
-        moved = False
         
         # Try to move straight down first
         if i < size-1 and world[i+1][j] == EMPTY:
@@ -332,141 +1058,269 @@ class ParticleMovement:
             world[i+1][j] = particle_type
             return True
             
-        # If can't move down, try diagonal movement
-        for dx in [-1, 1]:  # Check both left and right
-            if (i < size-1 and 0 <= j + dx < size and 
-                world[i+1][j+dx] == EMPTY):
-                world[i][j] = EMPTY
-                world[i+1][j+dx] = particle_type
-                return True
+        # If can't move down, try diagonal movement, a random side first
+        if i < size-1 and self.move_sideways(world, i, j, particle_type):
+            return True
         
-        # If can't move down or diagonal, try horizontal spread
-        for dx in [-1, 1]:
-            if (0 <= j + dx < size and 
-                world[i][j+dx] == EMPTY):
-                world[i][j] = EMPTY
-                world[i][j+dx] = particle_type
-                return True
-                
-        return False
+        # If can't move down or diagonal, spread toward the nearest gap
+        return i < size-1 and self.spread(world, i, j, particle_type)
+    
+    def spread(self, world: list[list[int]], i: int, j: int, particle_type: int,
+               surfaces: tuple = None) -> bool:
+        """
+        Moves a resting liquid drop sideways toward the nearest gap it can
+        drop into, up to liquid_spread cells per tick.
+        
+        The drop looks both ways along its row, past the drops next to it and
+        across empty cells, and heads for the closer gap (a random one if
+        both are equally close). The drop at the front of a run takes the
+        first gap cell, the one behind it the next, and so on. When the gap
+        is out of reach, the first liquid_spread drops of the run move that
+        far toward it. A drop with no gap to reach stays put, so a level
+        surface stays still. Cells are judged as they were at the start of
+        the tick, so the scan order doesn't favor either side.
+        
+        Args:
+            world: 2D list representing the simulation grid
+            i: current row index
+            j: current column index
+            particle_type: type of particle to move
+            surfaces: types the drop can move across, or None for any
+            
+        Returns:
+            bool: True if particle moved, False otherwise
+        """
+        if (i, j) in self.spread_to:
+            return False
+        width = len(world[0])
+        row, below = world[i], world[i + 1]
+        moved_from, moved_to = self.spread_from, self.spread_to
+        best = None
+        for dx in (-1, 1):
+            # Count the drops in front of this one, then cross the empty cells
+            k, rank = j + dx, 0
+            while 0 <= k < width and ((row[k] == particle_type and (i, k) not in moved_to)
+                                       or (i, k) in moved_from):
+                k, rank = k + dx, rank + 1
+            while 0 <= k < width and (row[k] == EMPTY or (i, k) in moved_to):
+                if below[k] == EMPTY or (i + 1, k) in moved_to:
+                    break
+                if surfaces is not None and below[k] not in surfaces:
+                    k = -1
+                    break
+                k += dx
+            if not 0 <= k < width or not (row[k] == EMPTY or (i, k) in moved_to):
+                continue
+            # This drop's gap cell is rank cells past the first one
+            target = k + rank * dx
+            if not all(0 <= x < width and row[x] == EMPTY and (below[x] == EMPTY or (i + 1, x) in moved_to)
+                       for x in range(k + dx, target + dx, dx)):
+                continue
+            travel = abs(target - j)
+            if best is None or travel < best[1] or (travel == best[1] and self.rng.random() < 0.5):
+                best = (target, travel, rank, dx)
+        if best is None:
+            return False
+        
+        target, travel, rank, dx = best
+        if self.liquid_spread is None or travel <= self.liquid_spread:
+            target_i, target_j = i + 1, target
+        elif rank < self.liquid_spread:
+            # Out of reach this tick; get closer along the surface
+            target_i, target_j = i, j + dx * self.liquid_spread
+        else:
+            return False
+        if world[target_i][target_j] != EMPTY:
+            return False
+        world[i][j] = EMPTY
+        world[target_i][target_j] = particle_type
+        moved_from.add((i, j))
+        moved_to.add((target_i, target_j))
+        return True
 
 class ParticleInteraction:
     """
     Handles interactions between different particle types.
+    
+    On creation it compiles the registered elements into handler tables
+    indexed by cell value, so updating a cell is one list lookup.
     """
     
-    def __init__(self):
-        self.movement = ParticleMovement()
+    # Handler used for each movement rule when an element doesn't give its own
+    DEFAULT_HANDLERS = {
+        POWDER: "handle_powder",
+        POOL: "handle_pool",
+        FLOW: "handle_flow",
+        RISING: "handle_rising",
+    }
+    
+    def __init__(self, rng: ParticleRandom = None, liquid_spread: int = LIQUID_SPREAD):
+        """
+        Args:
+            rng: random source for the particle rules (defaults to DEFAULT_RANDOM)
+            liquid_spread: cells a liquid drop moves sideways per tick, or None
+                to drop straight into the nearest gap
+        """
+        self.rng = rng or DEFAULT_RANDOM
+        self.movement = ParticleMovement(self.rng, liquid_spread)
+        # {type: mask of cells next to it}, set by the engines each tick with neighbor_fields
+        self.near = None
+        # Rising particles are updated in their own top-down pass
+        self.handlers = [None] * 256
+        self.rising_handlers = [None] * 256
+        for code, element in ELEMENTS.items():
+            if element.update is not None:
+                handler = element.update.__get__(self)
+            elif element.movement in self.DEFAULT_HANDLERS:
+                handler = getattr(self, self.DEFAULT_HANDLERS[element.movement])
+            else:
+                continue
+            if element.movement == RISING:
+                self.rising_handlers[code] = handler
+            else:
+                self.handlers[code] = handler
+        # Compiled from the same elements by update_particles_compiled when first needed
+        self.kernel_tables = None
+    
+    def begin_tick(self) -> None:
+        """
+        Forgets what the last tick left behind (which drops have spread and
+        the neighbor fields), so the same handlers can run another tick.
+        """
+        self.movement.spread_from.clear()
+        self.movement.spread_to.clear()
+        self.near = None
     
-    def handle_sand(self, world: list[list[int]], i: int, j: int) -> None:
+    def handle_rising(self, world: list[list[int]], i: int, j: int, ages: np.ndarray) -> None:
         """
-        Handles sand particle movement and interactions.
+        Handles rising particles (embers): drifting up and burning out.
         
         Args:
             world: 2D list representing the simulation grid
             i: current row index
             j: current column index
+            ages: per-cell particle ages
         """
-        if not self.movement.apply_gravity(world, i, j, SAND):
-            if world[i + 1][j] == RAIN:
-                world[i][j] = EMPTY
-                world[i + 1][j] = SAND
-            else:
-                self.movement.move_sideways(world, i, j, SAND)
+        self.movement.move_ember(world, i, j)
+    
+    def handle_powder(self, world: list[list[int]], i: int, j: int, ages: np.ndarray) -> None:
+        """
+        Handles powder movement (sand, snow): falling, sinking into what the
+        element sinks into, and sliding off piles.
+        
+        Args:
+            world: 2D list representing the simulation grid
+            i: current row index
+            j: current column index
+            ages: per-cell particle ages
+        """
+        size = len(world)
+        if i >= size - 1:
+            return
+        particle = world[i][j]
+        below = world[i + 1][j]
+        if below == EMPTY:
+            world[i][j] = EMPTY
+            world[i + 1][j] = particle
+            ages[i + 1][j] = ages[i][j]
+        elif below in ELEMENTS[particle].sinks:
+            world[i][j] = ELEMENTS[particle].sinks[below]
+            world[i + 1][j] = particle
+            ages[i + 1][j] = ages[i][j]
+        else:
+            self.movement.move_sideways(world, i, j, particle, ages)
     
-    def handle_rain(self, world: list[list[int]], i: int, j: int) -> None:
+    def handle_pool(self, world: list[list[int]], i: int, j: int, ages: np.ndarray) -> None:
         """
-        Handles rain particle movement and interactions.
+        Handles pooling liquid movement (rain): falling, sinking into what the
+        element sinks into (rain puts out fire), and spreading sideways across
+        its surfaces toward the nearest gap.
         
         Args:
             world: 2D list representing the simulation grid
             i: current row index
             j: current column index
+            ages: per-cell particle ages
         """
         size = len(world)
         if i + 1 < size:
-            # If water hits fire, extinguish it and continue flowing
-            if world[i + 1][j] == FIRE:
-                world[i][j] = EMPTY
-                world[i + 1][j] = RAIN
+            particle = world[i][j]
+            below = world[i + 1][j]
+            sinks = ELEMENTS[particle].sinks
+            if below in sinks:
+                world[i][j] = sinks[below]
+                world[i + 1][j] = particle
                 return
             
-            if world[i + 1][j] == EMPTY:
+            if below == EMPTY:
                 world[i][j] = EMPTY
-                world[i + 1][j] = RAIN
-            elif world[i + 1][j] == RAIN or world[i + 1][j] == SAND:
-                for direction in [-1, 1]:
-                    if (0 <= j + direction < size and 
-                        world[i][j + direction] == EMPTY):
-                        world[i][j] = EMPTY
-                        world[i][j + direction] = RAIN
-                        break
+                world[i + 1][j] = particle
+            elif below in SURFACES[particle]:
+                self.movement.spread(world, i, j, particle, SURFACES[particle])
     
-    def handle_oil(self, world: list[list[int]], i: int, j: int) -> None:
-        size = len(world)
-        
-        # Check oil layer limit (max 2)
-        if i < size-1 and world[i+1][j] == OIL:
-            if i < size-2 and world[i+2][j] == OIL:
-                world[i][j] = EMPTY
-                return
+    def handle_flow(self, world: list[list[int]], i: int, j: int, ages: np.ndarray) -> None:
+        """
+        Handles flowing liquid movement: floating up through denser liquids,
+        then flowing to the lowest point.
         
-        # Float on water
-        if self.movement.float_up(world, i, j, OIL):
+        Args:
+            world: 2D list representing the simulation grid
+            i: current row index
+            j: current column index
+            ages: per-cell particle ages
+        """
+        particle = world[i][j]
+        if self.movement.float_up(world, i, j, particle):
             return
-            
-        # Flow to lowest point
-        self.movement.flow_to_lowest_point(world, i, j, OIL)
+        self.movement.flow_to_lowest_point(world, i, j, particle)
     
-    def spread_fire_through_oil(self, world: list[list[int]], i: int, j: int, fire_timers: dict) -> None:
-        """Recursively spread fire through connected oil particles"""
+    def handle_oil(self, world: list[list[int]], i: int, j: int, ages: np.ndarray) -> None:
+        """
+        Handles oil: at most OIL_MAX_DEPTH layers deep, otherwise it flows.
+        
+        Args:
+            world: 2D list representing the simulation grid
+            i: current row index
+            j: current column index
+            ages: per-cell particle ages
+        """
         size = len(world)
-        current_time = time.time()
         
-        # Check all adjacent cells for oil
-        for di in [-1, 0, 1]:
-            for dj in [-1, 0, 1]:
-                ni, nj = i + di, j + dj
-                if (0 <= ni < size and 0 <= nj < size and 
-                    world[ni][nj] == OIL):
-                    world[ni][nj] = FIRE
-                    fire_timers[(ni,nj)] = current_time
-                    # Recursively spread to connected oil
-                    self.spread_fire_through_oil(world, ni, nj, fire_timers)
+        # Check oil layer limit
+        if (i < size - OIL_MAX_DEPTH and world[i + 1][j] == OIL
+                and all(world[i + d][j] == OIL for d in range(2, OIL_MAX_DEPTH + 1))):
+            world[i][j] = EMPTY
+            return
+        
+        self.handle_flow(world, i, j, ages)
     
-    def check_fire_interactions(self, world: list[list[int]], i: int, j: int, fire_timers: dict) -> bool:
+    def react(self, world: list[list[int]], i: int, j: int, ages: np.ndarray) -> bool:
         """
-        Checks and handles fire interactions with water and oil.
+        Turns a particle into its reaction product if it touches a neighbor
+        it reacts with (water touching fire puts it out).
+        
+        Catching fire is handled separately by ignite_oil before fire is
+        updated each tick. Neighbors are looked up in the fields the engine
+        computed for the tick (see neighbor_fields).
         
         Args:
             world: 2D list representing the simulation grid
             i: current row index
             j: current column index
-            fire_timers: dictionary tracking fire particle lifetimes
+            ages: per-cell particle ages
             
         Returns:
-            bool: True if fire was extinguished or spread, False otherwise
+            bool: True if the particle reacted, False otherwise
         """
-        size = len(world)
-        
-        # Check all adjacent cells for water or oil
-        for di in [-1, 0, 1]:
-            for dj in [-1, 0, 1]:
-                ni, nj = i + di, j + dj
-                if 0 <= ni < size and 0 <= nj < size:
-                    # If water is touching fire, extinguish fire
-                    if world[ni][nj] == RAIN:
-                        world[i][j] = EMPTY
-                        del fire_timers[(i,j)]
-                        return True
-                    # If oil is touching fire, convert oil to fire
-                    elif world[ni][nj] == OIL:
-                        world[ni][nj] = FIRE
-                        fire_timers[(ni,nj)] = time.time()
-                        self.spread_fire_through_oil(world, ni, nj, fire_timers)
+        near = self.near
+        for neighbor, result in ELEMENTS[world[i][j]].reactions.items():
+            if near[neighbor][i, j]:
+                world[i][j] = result
+                ages[i][j] = 0
+                return True
         return False
 
-    def handle_fire(self, world: list[list[int]], i: int, j: int, fire_timers: dict) -> None:
+    def handle_fire(self, world: list[list[int]], i: int, j: int, ages: np.ndarray) -> None:
         """
         Handles fire particle behavior, timing, and interactions.
         
@@ -474,25 +1328,20 @@ class ParticleInteraction:
             world: 2D list representing the simulation grid
             i: current row index
             j: current column index
-            fire_timers: dictionary tracking fire particle lifetimes
+            ages: per-cell particle ages
         """
         size = len(world)
-        current_time = time.time()
         
-        if (i,j) not in fire_timers:
-            fire_timers[(i,j)] = current_time
-        
-        # Check for water/oil interactions first
-        if self.check_fire_interactions(world, i, j, fire_timers):
+        # Check for water first
+        if self.react(world, i, j, ages):
             return
         
         # Normal fire behavior
-        if current_time - fire_timers[(i,j)] > 6:
+        if ages[i][j] > FIRE_LIFETIME:
             world[i][j] = EMPTY
-            del fire_timers[(i,j)]
             return
         
-        if random.random() < 0.02 and i > 0 and world[i-1][j] == EMPTY:
+        if self.rng.random() < EMBER_CHANCE and i > 0 and world[i-1][j] == EMPTY:
             world[i-1][j] = EMBER
         
         if i >= size - 1:
@@ -501,216 +1350,3694 @@ class ParticleInteraction:
         if world[i + 1][j] == EMPTY:
             world[i][j] = EMPTY
             world[i + 1][j] = FIRE
-            fire_timers[(i+1,j)] = fire_timers.pop((i,j))
+            ages[i + 1][j] = ages[i][j]
         else:
-            self.movement.move_sideways(world, i, j, FIRE)
+            self.movement.move_sideways(world, i, j, FIRE, ages)
     
-    def handle_snow(self, world: list[list[int]], i: int, j: int, snow_timers: dict) -> None:
+    def handle_snow(self, world: list[list[int]], i: int, j: int, ages: np.ndarray) -> None:
         """
-        Handles snow particle movement, melting, and interactions.
+        Handles snow particle melting, then moves it like any powder.
         
         Args:
             world: 2D list representing the simulation grid
             i: current row index
             j: current column index
-            snow_timers: dictionary tracking snow melting times
+            ages: per-cell particle ages
         """
-        size = len(world)
-        current_time = time.time()
-        
-        if (i,j) not in snow_timers:
-            snow_timers[(i,j)] = current_time
-        
         # Check for nearby fire
-        melt_speed = 1.0
-        for di in [-1, 0, 1]:
-            for dj in [-1, 0, 1]:
-                ni, nj = i + di, j + dj
-                if (0 <= ni < size and 0 <= nj < size and 
-                    world[ni][nj] == FIRE):
-                    melt_speed = 5.0
-                    break
+        melt_speed = FIRE_MELT_SPEED if self.near[FIRE][i, j] else 1
         
         # Melt snow into water
-        if current_time - snow_timers[(i,j)] > (5.0 / melt_speed):
+        if ages[i][j] > SNOW_MELT_TIME / melt_speed:
             world[i][j] = RAIN
-            del snow_timers[(i,j)]
             return
             
-        # Move through liquids or fall
-        if i < size-1:
-            if world[i+1][j] == EMPTY:
-                world[i][j] = EMPTY
-                world[i+1][j] = SNOW
-            elif world[i+1][j] in [RAIN, OIL]:
-                # Store the liquid type
-                liquid = world[i+1][j]
-                # Swap positions
-                world[i+1][j] = SNOW
-                world[i][j] = liquid
-            else:
-                self.movement.move_sideways(world, i, j, SNOW)
+        # Fall, sink through liquids or slide
+        self.handle_powder(world, i, j, ages)
 
-def update_particles(world: list[list[int]], fire_timers: dict, snow_timers: dict) -> None:
-    """
-    Updates all particles in the simulation for one time step.
-    
-    Args:
-        world: 2D list representing the simulation grid
-        fire_timers: dictionary tracking fire particle lifetimes
-        snow_timers: dictionary tracking snow particle melting times
-    """
-    size = len(world)
-    movement = ParticleMovement()
-    interaction = ParticleInteraction()
-    
-    # Update embers
-    for i in range(size-1):
-        for j in range(size):
-            if world[i][j] == EMBER:
-                movement.move_ember(world, i, j)
-    
-    # Update from bottom to top for proper particle movement
-    for i in range(size-2, -1, -1):
-        for j in range(size-1, -1, -1):
-            # Handle each particle type
-            if world[i][j] == SAND:
-                interaction.handle_sand(world, i, j)
-            elif world[i][j] == RAIN:
-                interaction.handle_rain(world, i, j)
-            elif world[i][j] == FIRE:
-                interaction.handle_fire(world, i, j, fire_timers)
-            elif world[i][j] == OIL:
-                interaction.handle_oil(world, i, j)
-            elif world[i][j] == SNOW:
-                interaction.handle_snow(world, i, j, snow_timers)
+# Built-in elements. Registration order is the mode button order.
+register_element(SAND, Element(
+    "SAND", (255, 255, 0), POWDER, density=3,
+    sinks={RAIN: EMPTY},  # sand soaks up the water it lands in
+    brush=(5, 2, 2)))
+register_element(RAIN, Element(
+    "RAIN", (0, 0, 255), POOL, density=2,
+    sinks={FIRE: EMPTY},  # rain puts out fire below it
+    surfaces=(RAIN, SAND), brush=(5, 4, 1)))
+register_element(FLOOR, Element(
+    "FLOOR", (128, 128, 128), STATIC, brush=ParticleCreator.place_floor))
+register_element(FIRE, Element(
+    "FIRE", (255, 102, 0), CUSTOM, reactions={RAIN: EMPTY}, aging=True,
+    brush=(3, 2, 2), update=ParticleInteraction.handle_fire))
+register_element(OIL, Element(
+    "OIL", (139, 69, 19), FLOW, density=1, reactions={FIRE: FIRE},
+    brush=(5, 3, 1), update=ParticleInteraction.handle_oil))
+register_element(SNOW, Element(
+    "SNOW", (255, 255, 255), POWDER, density=3, sinks={RAIN: RAIN, OIL: OIL}, aging=True,
+    brush=(5, 2, 2), update=ParticleInteraction.handle_snow))
+register_element(EMBER, Element("EMBER", (255, 100, 0), RISING))
 
-def draw_button(mode: int) -> None:
-    """
-    Draws the mode selection and clear buttons.
-    
-    Args:
-        mode: Current particle type selected
+class ChunkTracker:
     """
-    # Draw mode button background
-    dudraw.set_pen_color(dudraw.GRAY)
-    dudraw.filled_rectangle(10, 95, 8, 3)
-    
-    # Draw mode button text
-    dudraw.set_pen_color(dudraw.WHITE)
-    if mode == SAND:
-        dudraw.text(10, 95, "Mode: SAND")
-    elif mode == RAIN:
-        dudraw.text(10, 95, "Mode: RAIN")
-    elif mode == FLOOR:
-        dudraw.text(10, 95, "Mode: FLOOR")
-    elif mode == FIRE:
-        dudraw.text(10, 95, "Mode: FIRE")
-    elif mode == OIL:
-        dudraw.text(10, 95, "Mode: OIL")
-    elif mode == SNOW:
-        dudraw.text(10, 95, "Mode: SNOW")
-    
-    # Draw clear button in top right
-    dudraw.set_pen_color(dudraw.RED)
-    dudraw.filled_rectangle(95, 95, 4, 2)
-    dudraw.set_pen_color(dudraw.WHITE)
-    dudraw.text(95, 95, "Clear")
+    Splits the world into fixed-size square chunks and tracks which ones are
+    awake, so settled parts of the world can be skipped.
 
-def is_button_clicked(mouse_x: float, mouse_y: float) -> tuple[bool, bool]:
-    """
-    Checks if mode or clear buttons were clicked.
-    
-    Args:
-        mouse_x: x-coordinate of mouse click
-        mouse_y: y-coordinate of mouse click
-        
-    Returns:
-        tuple[bool, bool]: (mode_clicked, clear_clicked)
-    """
-    mode_clicked = (2 <= mouse_x <= 18 and 92 <= mouse_y <= 98)
-    clear_clicked = (91 <= mouse_x <= 99 and 93 <= mouse_y <= 97)  # Updated clear button hitbox
-    return (mode_clicked, clear_clicked)
+    A chunk wakes when anything changes in it or in a neighboring chunk,
+    and goes back to sleep after a tick with no changes. Chunks holding
+    fire, embers or snow stay awake because those change on their own.
 
-def main():
-    """
-    Main function that runs the simulation loop.
-    Handles:
-    - Window setup
-    - User input
-    - Particle updates
-    - Drawing
+    A tick only covers a window of rows around the awake chunks (see
+    begin_tick), so once everything has settled a tick costs next to
+    nothing. What the engines change is found by comparing the window
+    before and after the tick. Particles placed between ticks have to be
+    reported with mark(), or wake_all() when it isn't known what changed.
     """
-    size = 100
-    world = create_world(size)
-    dudraw.set_canvas_size(500, 500)
-    dudraw.set_x_scale(0, size)
-    dudraw.set_y_scale(0, size)
-    
-    # Initialize state variables
-    current_mode = SAND
-    fire_timers = {}
-    snow_timers = {}
-    creator = ParticleCreator()
-    
-    # Main game loop
-    while True:
-        time.sleep(0.02)  # Control simulation speed
-        
-        # Handle user input
-        if dudraw.mouse_is_pressed():
-            mouse_x = dudraw.mouse_x()
-            mouse_y = dudraw.mouse_y()
-            
-            mode_clicked, clear_clicked = is_button_clicked(mouse_x, mouse_y)
-            
-            # Handle button clicks
-            if mode_clicked:
-                # Cycle through particle types
-                if current_mode == SAND:
-                    current_mode = RAIN
-                elif current_mode == RAIN:
-                    current_mode = FLOOR
-                elif current_mode == FLOOR:
-                    current_mode = FIRE
-                elif current_mode == FIRE:
-                    current_mode = OIL
-                elif current_mode == OIL:
-                    current_mode = SNOW
-                else:
-                    current_mode = SAND
-                time.sleep(0.2)
-            elif clear_clicked:
-                world = create_world(size)
-                fire_timers.clear()
-                snow_timers.clear()
-                time.sleep(0.2)
-            else:
-                x = int(mouse_x)
-                y = size - int(mouse_y)
-                
-                if current_mode == FLOOR:
-                    if creator.can_place_floor(world, x, y):
-                        creator.create_floor(world, x, y)
-                elif current_mode == FIRE:
-                    creator.create_fire(world, x, y, fire_timers)
-                elif current_mode == RAIN:
-                    creator.create_rain(world, x, y)
-                elif current_mode == OIL:
-                    creator.create_oil(world, x, y)
-                elif current_mode == SNOW:
-                    creator.create_snow(world, x, y)
-                else:  # SAND
-                    creator.create_sand(world, x, y)
-        
-        if dudraw.has_next_key_typed():
-            if dudraw.next_key_typed() == 'q':
-                break
-        
-        update_particles(world, fire_timers, snow_timers)
-        draw_world(world)
-        draw_button(current_mode)
-        dudraw.show()
+
+    def __init__(self, chunk_size: int = 16):
+        """
+        Args:
+            chunk_size: width and height of a chunk in cells
+        """
+        self.chunk_size = chunk_size
+        self.awake = None
+        self.marked = None        # chunks changed between ticks
+        self.window = None        # (rows, cols) slices of the grid the tick covers
+        self.window_chunks = None # the same in chunks
+        self.snapshot = None      # the window's cells when the tick began
+        self.changed = 0     # cells the last tick changed
+        self.live = False    # whether particles that change on their own were left after it
+
+    def chunk_any(self, mask: np.ndarray) -> np.ndarray:
+        """
+        Reduces a cell mask to a chunk mask.
+
+        Args:
+            mask: boolean mask with one entry per cell
+
+        Returns:
+            np.ndarray: boolean mask with one entry per chunk, True where any
+            cell in the chunk is True
+        """
+        cs = self.chunk_size
+        h, w = mask.shape
+        if h % cs or w % cs:
+            mask = np.pad(mask, ((0, -h % cs), (0, -w % cs)))
+        # OR the rows of each chunk together first, then the columns; this is
+        # much faster than a single any() over two non-adjacent axes
+        rows = np.bitwise_or.reduce(mask.reshape(-1, cs, mask.shape[1]), axis=1)
+        return np.bitwise_or.reduce(rows.reshape(rows.shape[0], -1, cs), axis=2)
+
+    def cell_mask(self, shape: tuple[int, int]) -> np.ndarray:
+        """
+        Expands the awake chunks to a cell mask.
+
+        Args:
+            shape: (rows, cols) of the world
+
+        Returns:
+            np.ndarray: boolean mask, True for cells in awake chunks
+        """
+        return self._cells(self.awake, shape)
+
+    def window_mask(self) -> np.ndarray:
+        """
+        Expands the awake chunks in the window of the tick in progress to a
+        cell mask.
+
+        Returns:
+            np.ndarray: boolean mask the shape of the window, True for cells in awake chunks
+        """
+        return self._cells(self.awake[self.window_chunks], self.snapshot.shape)
+
+    def _cells(self, chunks: np.ndarray, shape: tuple[int, int]) -> np.ndarray:
+        """Expands a chunk mask to a cell mask of the given shape."""
+        cs = self.chunk_size
+        rows, cols = chunks.shape
+        cells = np.broadcast_to(chunks[:, None, :, None], (rows, cs, cols, cs))
+        return cells.reshape(rows * cs, cols * cs)[:shape[0], :shape[1]]
+
+    def columns(self) -> list[list[int]]:
+        """
+        Lists the awake columns for every row of the window of the tick in
+        progress, right to left.
+
+        Returns:
+            list[list[int]]: column indices in awake chunks, one list per row
+        """
+        cs = self.chunk_size
+        height, width = self.snapshot.shape
+        chunk_rows = []
+        for awake_row in self.awake[self.window_chunks]:
+            chunk_rows.append([j for c in np.flatnonzero(awake_row)[::-1].tolist()
+                               for j in range(min((c + 1) * cs, width) - 1, c * cs - 1, -1)])
+        return [chunk_rows[i // cs] for i in range(height)]
+
+    def mark(self, top: int, left: int, rows: int, cols: int) -> None:
+        """
+        Wakes the chunks around a block of cells changed between ticks, e.g.
+        by placing particles. Any part of the block outside the grid is
+        ignored.
+
+        Args:
+            top: first row of the block
+            left: first column of the block
+            rows: number of rows in the block
+            cols: number of columns in the block
+        """
+        if self.marked is None:
+            # The first tick wakes every chunk anyway
+            return
+        cs = self.chunk_size
+        bottom, right = top + rows, left + cols
+        top, left = max(top, 0), max(left, 0)
+        if bottom > top and right > left:
+            self.marked[top // cs:(bottom - 1) // cs + 1, left // cs:(right - 1) // cs + 1] = True
+
+    def wake_all(self) -> None:
+        """Wakes every chunk, e.g. after the world was replaced."""
+        self.awake = None
+        self.marked = None
+
+    def begin_tick(self, world: np.ndarray) -> tuple[slice, slice]:
+        """
+        Wakes the chunks around the ones marked since the last tick and picks
+        the window the tick covers: the rows of chunks from one above the
+        awake chunks to one below them, for their particles to move into.
+        Remembers the window's cells to compare with at the end of the tick.
+
+        The engines update only the awake chunks and run their whole-grid
+        phases on the window alone, with its top and bottom as the edges of
+        the grid. Particles in the awake chunks are at least a chunk away
+        from those, unless they are the grid's own. The window spans whole
+        rows, as a liquid drop looks along its row for a gap however far
+        away it is.
+
+        Args:
+            world: 2D array representing the simulation grid
+
+        Returns:
+            tuple: (rows, cols) slices of the window, with no rows if no chunk is awake
+        """
+        grid = np.asarray(world)
+        cs = self.chunk_size
+        shape = (-(-grid.shape[0] // cs), -(-grid.shape[1] // cs))
+        if self.awake is None or self.awake.shape != shape:
+            self.awake = np.ones(shape, dtype=bool)
+            self.marked = np.zeros(shape, dtype=bool)
+        elif self.marked.any():
+            self.awake |= self._dilate(self.marked)
+            self.marked[...] = False
+        rows = np.flatnonzero(self.awake.any(axis=1))
+        top, bottom = (max(rows[0] - 1, 0), min(rows[-1] + 2, shape[0])) if len(rows) else (0, 0)
+        self.window_chunks = (slice(top, bottom), slice(None))
+        self.window = (slice(top * cs, bottom * cs), slice(None))
+        self.snapshot = grid[self.window].copy()
+        return self.window
+
+    def end_tick(self, world: np.ndarray) -> None:
+        """
+        Puts chunks that didn't change this tick to sleep.
+
+        Args:
+            world: 2D array representing the simulation grid
+        """
+        cells = np.asarray(world)[self.window]
+        diff = cells != self.snapshot
+        self.changed = int(np.count_nonzero(diff))
+        moving = _of_type(cells, RISING_TYPES + CUSTOM_TYPES + AGING)
+        # The bottom row is never updated, so what's there can't change
+        self.live = bool(moving[:len(world) - 1 - self.window[0].start].any())
+        changed, live = np.zeros_like(self.awake), np.zeros_like(self.awake)
+        if cells.size:
+            changed[self.window_chunks] = self.chunk_any(diff)
+            live[self.window_chunks] = self.chunk_any(moving)
+        self.awake = self._dilate(changed) | live
+        self.snapshot = None
+
+    def _dilate(self, chunks: np.ndarray) -> np.ndarray:
+        """Adds the 8 neighbors of every marked chunk."""
+        near = chunks.copy()
+        near[1:] |= chunks[:-1]
+        near[:-1] |= chunks[1:]
+        wide = near.copy()
+        wide[:, 1:] |= near[:, :-1]
+        wide[:, :-1] |= near[:, 1:]
+        return wide
+
+class _TrackedRow:
+    """One row of the grid seen through ActiveParticles; writes update its sets."""
+
+    __slots__ = ("active", "row", "i")
+
+    def __init__(self, active: "ActiveParticles", row: np.ndarray, i: int):
+        self.active = active
+        self.row = row
+        self.i = i
+
+    def __len__(self) -> int:
+        return len(self.row)
+
+    def __getitem__(self, j: int) -> int:
+        return self.row[j]
+
+    def __setitem__(self, j: int, particle_type: int) -> None:
+        self.active.write(self.i, j, particle_type)
+
+class ActiveParticles:
+    """
+    Keeps a set of cell coordinates for every particle type, so update_particles
+    can visit just the particles instead of scanning every cell.
+
+    The tracker stands in for the grid: handlers and ParticleCreator read
+    and write it with world[i][j] as usual, and every write moves the cell
+    between the sets. Changes made straight to the grid (ignite_oil,
+    apply_reactions) are picked up with refresh(). If the grid is replaced
+    or edited some other way, call rebuild().
+    """
+
+    def __init__(self):
+        self.grid = None
+        self.width = 0
+        self.rows = []
+        self.cells = [set() for _ in range(256)]  # particle type -> {(i, j)}
+        # State of the pass in progress (see run)
+        self.pending = None
+        self.handlers = None
+        self.order = 1
+        self.cursor = 0
+
+    def attach(self, world: np.ndarray) -> "ActiveParticles":
+        """
+        Starts tracking a grid, rebuilding the sets if it isn't the one
+        already tracked.
+
+        Args:
+            world: 2D array representing the simulation grid
+
+        Returns:
+            ActiveParticles: this tracker, to use in place of the grid
+        """
+        if world is not self.grid:
+            self.rebuild(world)
+        return self
+
+    def rebuild(self, world: np.ndarray) -> None:
+        """
+        Fills the sets from scratch.
+
+        Args:
+            world: 2D array representing the simulation grid
+        """
+        self.grid = world
+        self.width = world.shape[1]
+        self.rows = [_TrackedRow(self, row, i) for i, row in enumerate(world)]
+        self.cells = [set() for _ in range(256)]
+        for particle_type in np.unique(world).tolist():
+            if particle_type != EMPTY:
+                rows, cols = np.nonzero(world == particle_type)
+                self.cells[particle_type] = set(zip(rows.tolist(), cols.tolist()))
+
+    def count(self, particle_type: int) -> int:
+        """Returns how many cells hold a particle type."""
+        return len(self.cells[particle_type])
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, i: int) -> _TrackedRow:
+        return self.rows[i]
+
+    def write(self, i: int, j: int, particle_type: int) -> None:
+        """
+        Sets a cell and moves it to the set for its new type. During a pass,
+        a particle written to a cell the pass hasn't reached yet is queued
+        so it gets visited, just as a full scan would.
+
+        Args:
+            i: row index
+            j: column index
+            particle_type: new type of the cell
+        """
+        row = self.grid[i]
+        old = row[j]
+        if old == particle_type:
+            return
+        row[j] = particle_type
+        cell = (i, j)
+        if old != EMPTY:
+            self.cells[old].discard(cell)
+        if particle_type != EMPTY:
+            self.cells[particle_type].add(cell)
+            if self.pending is not None and self.handlers[particle_type] is not None \
+                    and i < len(self.rows) - 1:
+                key = self.order * (i * self.width + j)
+                if key > self.cursor:
+                    heapq.heappush(self.pending, key)
+
+    def refresh(self, before: np.ndarray) -> None:
+        """
+        Updates the sets for cells changed straight in the grid.
+
+        Args:
+            before: copy of the grid taken before the changes
+        """
+        rows, cols = np.nonzero(self.grid != before)
+        for i, j, old, new in zip(rows.tolist(), cols.tolist(),
+                                  before[rows, cols].tolist(), self.grid[rows, cols].tolist()):
+            if old != EMPTY:
+                self.cells[old].discard((i, j))
+            if new != EMPTY:
+                self.cells[new].add((i, j))
+
+    def run(self, handlers: list, ages: np.ndarray, top_down: bool) -> int:
+        """
+        Calls the handler of every particle above the bottom row in scan
+        order: top to bottom and left to right, or bottom to top and right
+        to left. Particles that move into a cell the scan hasn't reached yet
+        are visited again, like in a full scan.
+
+        Args:
+            handlers: handler for each particle type, or None to skip it
+            ages: per-cell particle ages
+            top_down: scan direction
+
+        Returns:
+            int: number of handler calls
+        """
+        width, last_row = self.width, len(self.rows) - 1
+        order = 1 if top_down else -1
+        pending = [order * (i * width + j)
+                   for particle_type, cells in enumerate(self.cells) if handlers[particle_type] is not None
+                   for i, j in cells if i < last_row]
+        heapq.heapify(pending)
+        self.pending, self.handlers, self.order = pending, handlers, order
+        self.cursor = -width * (last_row + 1) - 1
+        grid, visited, last = self.grid, 0, None
+        try:
+            while pending:
+                key = heapq.heappop(pending)
+                if key == last:
+                    continue
+                last = self.cursor = key
+                i, j = divmod(order * key, width)
+                handler = handlers[grid[i][j]]
+                if handler is not None:
+                    visited += 1
+                    handler(self, i, j, ages)
+        finally:
+            self.pending = self.handlers = None
+        return visited
+
+# Paged-out chunks go in a temporary directory with this prefix unless one is given
+PAGE_DIR_PREFIX = "sandgame_pages_"
+
+class ChunkedWorld:
+    """
+    Stores a world of any extent as square chunks, allocating only the
+    chunks that hold particles or floor, so memory grows with the occupied
+    chunks rather than the area. A 100,000 column map with a thin strip of
+    terrain costs about as much as the strip.
+
+    Every tick the awake chunks and their neighbors are copied into a few
+    small dense windows, stepped with the usual engines and written back;
+    chunks that come out empty are freed. Windows are merged when they
+    touch, so particles never cross between two windows in the same tick.
+    Wakefulness follows the same rules as ChunkTracker.
+
+    Chunks that have been settled for a while and lie away from the
+    viewport can be paged out to disk as compressed snapshots. They are
+    read back as soon as a window, read or write touches them.
+    """
+
+    def __init__(self, rows: int, cols: int, chunk_size: int = 64,
+                 page_dir: str = None, page_after: int = None):
+        """
+        Args:
+            rows: height of the world in cells
+            cols: width of the world in cells
+            chunk_size: width and height of a chunk in cells
+            page_dir: directory for paged-out chunks (a temporary one by default)
+            page_after: page out chunks settled for this many ticks every time
+                that many ticks pass, or None to only page on page_out()
+        """
+        if rows < 1 or cols < 1:
+            raise ValueError(f"world must be at least 1 x 1, got {rows} x {cols}")
+        if chunk_size < 4:
+            raise ValueError(f"chunk_size must be at least 4, got {chunk_size}")
+        self.shape = (rows, cols)
+        self.chunk_size = chunk_size
+        self.page_dir = page_dir
+        self.owns_page_dir = False
+        self.page_after = page_after
+        self.viewport = None
+        self.tick = 0
+        self.chunks = {}      # (chunk row, chunk col) -> uint8 cells
+        self.ages = {}        # same keys, only for chunks with a nonzero age
+        self.changed = {}     # same keys -> tick the chunk last changed
+        self.paged = set()    # keys of occupied chunks that are on disk
+        self.awake = set()
+
+    @classmethod
+    def from_dense(cls, world: np.ndarray, ages: np.ndarray = None, **options) -> "ChunkedWorld":
+        """
+        Builds a chunked world from a dense grid.
+
+        Args:
+            world: 2D array representing the simulation grid
+            ages: per-cell particle ages (all zero by default)
+            **options: passed on to ChunkedWorld
+
+        Returns:
+            ChunkedWorld: world holding a copy of the grid
+        """
+        chunked = cls(*np.shape(world), **options)
+        chunked.write(0, 0, world, ages)
+        return chunked
+
+    def to_dense(self) -> tuple[np.ndarray, np.ndarray]:
+        """Returns (world, ages) for the whole extent as dense arrays."""
+        return self.read(0, 0, *self.shape)
+
+    def occupied(self) -> int:
+        """Returns the number of allocated chunks, in memory or paged out."""
+        return len(self.chunks) + len(self.paged)
+
+    def memory_bytes(self) -> int:
+        """Returns the bytes held by chunks in memory."""
+        return (sum(cells.nbytes for cells in self.chunks.values())
+                + sum(ages.nbytes for ages in self.ages.values()))
+
+    def _keys(self, top: int, left: int, rows: int, cols: int) -> list[tuple[int, int]]:
+        """Lists the chunks overlapping a block of cells, checking it is inside the world."""
+        if top < 0 or left < 0 or rows < 0 or cols < 0 or \
+                top + rows > self.shape[0] or left + cols > self.shape[1]:
+            raise ValueError(f"block {rows} x {cols} at ({top}, {left}) is outside the "
+                             f"{self.shape[0]} x {self.shape[1]} world")
+        if rows == 0 or cols == 0:
+            return []
+        cs = self.chunk_size
+        return [(r, c) for r in range(top // cs, (top + rows - 1) // cs + 1)
+                for c in range(left // cs, (left + cols - 1) // cs + 1)]
+
+    def _overlap(self, key: tuple[int, int], top: int, left: int, rows: int, cols: int) -> tuple:
+        """
+        Finds where a chunk and a block of cells overlap.
+
+        Returns:
+            tuple: (slices into the chunk, slices into the block)
+        """
+        cs = self.chunk_size
+        r0, c0 = key[0] * cs, key[1] * cs
+        y0, y1 = max(top, r0), min(top + rows, r0 + cs)
+        x0, x1 = max(left, c0), min(left + cols, c0 + cs)
+        return ((slice(y0 - r0, y1 - r0), slice(x0 - c0, x1 - c0)),
+                (slice(y0 - top, y1 - top), slice(x0 - left, x1 - left)))
+
+    def _chunk_shape(self, key: tuple[int, int]) -> tuple[int, int]:
+        """Returns the size of a chunk, which is smaller along the far edges of the world."""
+        cs = self.chunk_size
+        return (min(cs, self.shape[0] - key[0] * cs), min(cs, self.shape[1] - key[1] * cs))
+
+    def _page_path(self, key: tuple[int, int]) -> str:
+        """Returns the file a chunk is paged out to."""
+        return os.path.join(self.page_dir, f"chunk_{key[0]}_{key[1]}.snap")
+
+    def _page_in(self, key: tuple[int, int]) -> None:
+        """Reads a paged-out chunk back into memory."""
+        path = self._page_path(key)
+        cells, ages, _ = load_snapshot(path)
+        os.remove(path)
+        self.paged.discard(key)
+        self.chunks[key] = cells
+        if ages.any():
+            self.ages[key] = ages
+        # Give it a full idle period before it can be paged out again
+        self.changed[key] = self.tick
+
+    def read(self, top: int, left: int, rows: int, cols: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Copies a block of cells into dense arrays, paging chunks in as needed.
+
+        Args:
+            top: first row of the block
+            left: first column of the block
+            rows: height of the block
+            cols: width of the block
+
+        Returns:
+            tuple: (world, ages) for the block
+        """
+        world = np.zeros((rows, cols), dtype=np.uint8)
+        ages = np.zeros((rows, cols), dtype=np.uint16)
+        for key in self._keys(top, left, rows, cols):
+            if key in self.paged:
+                self._page_in(key)
+            if key in self.chunks:
+                inside, block = self._overlap(key, top, left, rows, cols)
+                world[block] = self.chunks[key][inside]
+                if key in self.ages:
+                    ages[block] = self.ages[key][inside]
+        return world, ages
+
+    def view(self, top: int, left: int, rows: int, cols: int) -> np.ndarray:
+        """
+        Reads the block of cells on screen and keeps it (and the chunks
+        around it) from being paged out.
+
+        Returns:
+            np.ndarray: the visible part of the world
+        """
+        self.viewport = (top, left, rows, cols)
+        return self.read(top, left, rows, cols)[0]
+
+    def write(self, top: int, left: int, world: np.ndarray, ages: np.ndarray = None) -> None:
+        """
+        Copies a dense block of cells into the world. Chunks that change are
+        woken, chunks left empty are freed.
+
+        Args:
+            top: row the block starts at
+            left: column the block starts at
+            world: 2D array of particle types
+            ages: per-cell particle ages (zero by default)
+        """
+        world = np.asarray(world, dtype=np.uint8)
+        rows, cols = world.shape
+        for key in self._keys(top, left, rows, cols):
+            inside, block = self._overlap(key, top, left, rows, cols)
+            cells = world[block]
+            if key in self.paged:
+                self._page_in(key)
+            if key not in self.chunks:
+                if not cells.any():
+                    continue
+                self.chunks[key] = np.zeros(self._chunk_shape(key), dtype=np.uint8)
+            chunk = self.chunks[key]
+            chunk_ages = self.ages.get(key)
+            new_ages = ages[block] if ages is not None else 0
+            if np.array_equal(chunk[inside], cells) and (
+                    np.array_equal(chunk_ages[inside], new_ages) if chunk_ages is not None
+                    else not np.any(new_ages)):
+                continue
+            chunk[inside] = cells
+            if chunk_ages is None and np.any(new_ages):
+                chunk_ages = self.ages[key] = np.zeros(chunk.shape, dtype=np.uint16)
+            if chunk_ages is not None:
+                chunk_ages[inside] = new_ages
+            self.changed[key] = self.tick
+            self.awake.add(key)
+            if not chunk.any():
+                del self.chunks[key]
+                del self.changed[key]
+                self.ages.pop(key, None)
+            elif chunk_ages is not None and not chunk_ages.any():
+                del self.ages[key]
+
+    def _windows(self, keys: set) -> list[list[int]]:
+        """
+        Groups chunks into boxes that don't touch each other.
+
+        Args:
+            keys: chunks to cover
+
+        Returns:
+            list[list[int]]: [top, left, bottom, right] chunk coordinates of each box, inclusive
+        """
+        boxes = []
+        for r, c in sorted(keys):
+            box = [r, c, r, c]
+            merged = True
+            while merged:
+                merged = False
+                for other in boxes:
+                    if other[0] <= box[2] + 1 and box[0] <= other[2] + 1 and \
+                            other[1] <= box[3] + 1 and box[1] <= other[3] + 1:
+                        boxes.remove(other)
+                        box = [min(box[0], other[0]), min(box[1], other[1]),
+                               max(box[2], other[2]), max(box[3], other[3])]
+                        merged = True
+                        break
+            boxes.append(box)
+        return boxes
+
+    def step(self, update=None, **options) -> int:
+        """
+        Runs one tick over the awake chunks and their neighbors.
+
+        Args:
+            update: engine to step each window with (update_particles_vectorized by default)
+            **options: passed on to the engine, e.g. rng or oil_spread
+
+        Returns:
+            int: number of windows stepped (0 once the whole world has settled)
+        """
+        update = update or update_particles_vectorized
+        cs = self.chunk_size
+        last_row, last_col = (self.shape[0] - 1) // cs, (self.shape[1] - 1) // cs
+        near = {(r, c) for kr, kc in self.awake
+                for r in range(max(kr - 1, 0), min(kr + 1, last_row) + 1)
+                for c in range(max(kc - 1, 0), min(kc + 1, last_col) + 1)}
+        self.awake = set()
+        windows = self._windows(near)
+        live = RISING_TYPES + CUSTOM_TYPES + AGING
+        for top, left, bottom, right in windows:
+            rows = min((bottom + 1) * cs, self.shape[0]) - top * cs
+            cols = min((right + 1) * cs, self.shape[1]) - left * cs
+            world, ages = self.read(top * cs, left * cs, rows, cols)
+            update(world, ages, **options)
+            self.write(top * cs, left * cs, world, ages)
+            # Fire, embers and snow change on their own, so their chunks stay awake
+            for key in self._keys(top * cs, left * cs, rows, cols):
+                if key in self.chunks and _of_type(self.chunks[key], live).any():
+                    self.awake.add(key)
+        self.tick += 1
+        if self.page_after and self.tick % self.page_after == 0:
+            self.page_out()
+        return len(windows)
+
+    def page_out(self, idle: int = None, margin: int = 1) -> int:
+        """
+        Writes settled chunks away from the viewport to disk and frees them.
+
+        Args:
+            idle: ticks a chunk must have gone unchanged (page_after by default)
+            margin: chunks around the viewport that stay in memory
+
+        Returns:
+            int: number of chunks paged out
+        """
+        idle = idle if idle is not None else (self.page_after or 0)
+        if self.page_dir is None:
+            self.page_dir = tempfile.mkdtemp(prefix=PAGE_DIR_PREFIX)
+            self.owns_page_dir = True
+        os.makedirs(self.page_dir, exist_ok=True)
+        cs = self.chunk_size
+        if self.viewport is not None:
+            top, left, rows, cols = self.viewport
+            near_rows = (top // cs - margin, (top + rows - 1) // cs + margin)
+            near_cols = (left // cs - margin, (left + cols - 1) // cs + margin)
+
+        paged = 0
+        for key in list(self.chunks):
+            if key in self.awake or self.tick - self.changed[key] < idle:
+                continue
+            if self.viewport is not None and near_rows[0] <= key[0] <= near_rows[1] \
+                    and near_cols[0] <= key[1] <= near_cols[1]:
+                continue
+            cells = self.chunks.pop(key)
+            ages = self.ages.pop(key, None)
+            save_snapshot(self._page_path(key), cells,
+                          ages if ages is not None else np.zeros(cells.shape, dtype=np.uint16),
+                          encoding="rle")
+            self.paged.add(key)
+            paged += 1
+        return paged
+
+    def close(self) -> None:
+        """Deletes the paged-out chunk files (and the directory, if it was made here)."""
+        if self.page_dir is not None:
+            for key in self.paged:
+                path = self._page_path(key)
+                if os.path.exists(path):
+                    os.remove(path)
+            if self.owns_page_dir:
+                shutil.rmtree(self.page_dir, ignore_errors=True)
+                self.page_dir = None
+                self.owns_page_dir = False
+        self.paged = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# The game writes its profile to this name plus .csv and .json
+PROFILE_FILE = "sandgame_profile"
+
+class Profiler:
+    """
+    Records where the time goes, one record per frame (or per tick when
+    the engines run without a game loop).
+    
+    The engines time each of their phases, time every per-cell handler call
+    by element, and count particles, visited cells and moved cells. The
+    game loop adds its input and draw phases. The last `history` records
+    are kept for the HUD, histograms and CSV/JSON export.
+    
+    Pass a Profiler to the update functions to turn profiling on. Without
+    one they only pay for a few `is None` checks per tick.
+    """
+    
+    # Engine phases that work on the whole grid rather than per cell, so
+    # their time isn't already counted in the per-element handler times
+    GRID_PHASES = ("update.ignite", "update.melt", "update.move", "update.ages")
+    
+    def __init__(self, history: int = 600):
+        """
+        Args:
+            history: number of most recent records to keep
+        """
+        self.records = deque(maxlen=history)
+        self.frames = 0
+        self.handler_times = [0.0] * 256
+        self.record = None
+        self.owns_record = False
+        self.frame_start = None
+        self.before = None
+    
+    def begin_frame(self) -> float:
+        """
+        Starts a new record for one pass of the game loop.
+        
+        Returns:
+            float: the clock value to pass to the first lap()
+        """
+        now = time.perf_counter()
+        self.record = {"frame": self.frames,
+                       "frame_time": now - self.frame_start if self.frame_start else 0.0,
+                       "phases": {}, "elements": {}, "counts": {}, "visited": 0, "moved": 0}
+        self.frame_start = now
+        self.frames += 1
+        self.owns_record = False
+        return now
+    
+    def lap(self, phase: str, start: float) -> float:
+        """
+        Adds the time since start to a phase.
+        
+        Args:
+            phase: name of the phase that just finished
+            start: clock value when it started
+            
+        Returns:
+            float: the current clock value, to start the next phase
+        """
+        now = time.perf_counter()
+        phases = self.record["phases"]
+        phases[phase] = phases.get(phase, 0.0) + now - start
+        return now
+    
+    def end_frame(self) -> None:
+        """Finishes the current record and adds it to the history."""
+        self.records.append(self.record)
+        self.record = None
+    
+    def begin_tick(self, world: np.ndarray) -> float:
+        """
+        Called by the engines at the start of a tick. Starts a record of its
+        own if no frame is open.
+        
+        Args:
+            world: 2D array representing the simulation grid
+            
+        Returns:
+            float: the clock value to pass to the first lap()
+        """
+        if self.record is None:
+            self.begin_frame()
+            self.owns_record = True
+        self.handler_times[:] = [0.0] * 256
+        self.before = np.array(world, dtype=np.uint8)
+        return time.perf_counter()
+    
+    def wrap(self, handlers: list) -> list:
+        """
+        Wraps a handler table so every call is timed against its element.
+        
+        Args:
+            handlers: 256-entry list of per-cell handlers (or None)
+            
+        Returns:
+            list: the same table with timed handlers
+        """
+        return [None if handler is None else self._timed(code, handler)
+                for code, handler in enumerate(handlers)]
+    
+    def _timed(self, code: int, handler):
+        """Returns handler wrapped to add its run time to handler_times[code]."""
+        times = self.handler_times
+        clock = time.perf_counter
+        
+        def timed(world, i, j, ages):
+            start = clock()
+            handler(world, i, j, ages)
+            times[code] += clock() - start
+        return timed
+    
+    def end_tick(self, world: np.ndarray, visited: int, start: float) -> None:
+        """
+        Called by the engines at the end of a tick with the cells it looked at.
+        
+        Args:
+            world: 2D array representing the simulation grid
+            visited: number of cells the tick visited
+            start: clock value when the tick began
+        """
+        world = np.asarray(world)
+        record = self.record
+        elements = record["elements"]
+        counts = record["counts"]
+        particles = np.bincount(world.ravel(), minlength=256).tolist()
+        for code, element in ELEMENTS.items():
+            if self.handler_times[code]:
+                elements[element.name] = elements.get(element.name, 0.0) + self.handler_times[code]
+            counts[element.name] = particles[code]
+        record["visited"] += visited
+        record["moved"] += int(np.count_nonzero(world != self.before))
+        self.lap("update", start)
+        self.before = None
+        if self.owns_record:
+            self.end_frame()
+    
+    def costs(self, record: dict = None) -> list[tuple[str, float]]:
+        """
+        Lists what took the most time in a record: per-element handler time
+        and the engine's whole-grid phases.
+        
+        Args:
+            record: record to rank (defaults to the average of the history)
+            
+        Returns:
+            list[tuple[str, float]]: (element or phase, seconds), most expensive first
+        """
+        if record is None:
+            record = self.average()
+        costs = dict(record["elements"])
+        for phase in self.GRID_PHASES:
+            if phase in record["phases"]:
+                costs[phase[len("update."):]] = record["phases"][phase]
+        return sorted(costs.items(), key=lambda cost: cost[1], reverse=True)
+    
+    def average(self, last: int = None) -> dict:
+        """
+        Averages the recorded history.
+        
+        Args:
+            last: only average this many of the most recent records
+            
+        Returns:
+            dict: a record holding the mean of every timing and count
+        """
+        records = list(self.records)[-last:] if last else self.records
+        total = {"frame_time": 0.0, "phases": {}, "elements": {}, "counts": {}, "visited": 0, "moved": 0}
+        for record in records:
+            total["frame_time"] += record["frame_time"]
+            total["visited"] += record["visited"]
+            total["moved"] += record["moved"]
+            for key in ("phases", "elements", "counts"):
+                for name, value in record[key].items():
+                    total[key][name] = total[key].get(name, 0) + value
+        n = max(len(records), 1)
+        return {"frame_time": total["frame_time"] / n, "visited": total["visited"] / n,
+                "moved": total["moved"] / n,
+                **{key: {name: value / n for name, value in total[key].items()}
+                   for key in ("phases", "elements", "counts")}}
+    
+    def histogram(self, phase: str = "update", bins: int = 20) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Histograms a phase's time over the recorded history.
+        
+        Args:
+            phase: phase name (e.g. "update", "draw" or "update.move")
+            bins: number of bins
+            
+        Returns:
+            tuple: (counts, bin edges in seconds), as from np.histogram
+        """
+        return np.histogram([record["phases"].get(phase, 0.0) for record in self.records], bins=bins)
+    
+    def fps(self, last: int = None) -> float:
+        """
+        Returns the frame rate averaged over the recorded history.
+        
+        Args:
+            last: only use this many of the most recent records
+        """
+        records = list(self.records)[-last:] if last else self.records
+        times = [record["frame_time"] for record in records if record["frame_time"]]
+        return len(times) / sum(times) if times else 0.0
+    
+    def rows(self) -> list[dict]:
+        """
+        Flattens the history into one row per record, with columns like
+        "phase:draw", "element:FIRE" and "count:SAND".
+        
+        Returns:
+            list[dict]: one flat dict per record
+        """
+        rows = []
+        for record in self.records:
+            row = {"frame": record["frame"], "frame_time": record["frame_time"],
+                   "visited": record["visited"], "moved": record["moved"]}
+            for key, prefix in (("phases", "phase"), ("elements", "element"), ("counts", "count")):
+                for name, value in record[key].items():
+                    row[f"{prefix}:{name}"] = value
+            rows.append(row)
+        return rows
+    
+    def export(self, path: str) -> None:
+        """
+        Writes the history as a CSV (one row per record) or JSON trace,
+        picked by the file extension.
+        
+        Args:
+            path: file to write, ending in .csv or .json
+        """
+        if path.endswith(".json"):
+            with open(path, "w") as f:
+                json.dump(list(self.records), f, indent=1)
+            return
+        rows = self.rows()
+        columns = list(dict.fromkeys(column for row in rows for column in row))
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns, restval=0)
+            writer.writeheader()
+            writer.writerows(rows)
+
+def _connected(mask: np.ndarray, seeds: np.ndarray) -> np.ndarray:
+    """
+    Finds the cells of mask that are connected to a seed, counting
+    diagonal neighbors as connected.
+
+    This is a scanline flood fill: it walks horizontal runs of cells
+    instead of single cells, so a large body costs one step per run and
+    never recurses.
+
+    Args:
+        mask: boolean mask of cells that can be part of a body
+        seeds: boolean mask of cells to start filling from
+
+    Returns:
+        np.ndarray: boolean mask of every cell in a body that holds a seed
+    """
+    h, w = mask.shape
+    edges = np.diff(np.pad(mask, ((0, 0), (1, 1))).view(np.int8), axis=1)
+    run_rows, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+
+    # Runs are sorted by row then column, so keying them by row lets one
+    # search find, for every run, the runs in the rows above and below that
+    # overlap [start - 1, end]
+    run_rows = run_rows.astype(np.int64)
+    start_keys = run_rows * (w + 2) + starts
+    end_keys = run_rows * (w + 2) + ends
+    neighbors = []
+    for dr in (-1, 1):
+        lo = np.searchsorted(end_keys, (run_rows + dr) * (w + 2) + starts)
+        hi = np.searchsorted(start_keys, (run_rows + dr) * (w + 2) + ends, "right")
+        neighbors.append((lo.tolist(), hi.tolist()))
+
+    # Find the run each seed sits in
+    seed_rows, seed_cols = np.nonzero(seeds & mask)
+    todo = np.unique(np.searchsorted(start_keys, seed_rows * (w + 2) + seed_cols, "right") - 1)
+    filled = np.zeros(len(starts), dtype=bool)
+    filled[todo] = True
+    filled_list = filled.tolist()
+    todo = todo.tolist()
+
+    while todo:
+        k = todo.pop()
+        for lo, hi in neighbors:
+            for n in range(lo[k], hi[k]):
+                if not filled_list[n]:
+                    filled_list[n] = True
+                    todo.append(n)
+    filled = np.array(filled_list, dtype=bool)
+
+    marks = np.zeros((h, w + 1), dtype=np.int8)
+    marks[run_rows[filled], starts[filled]] = 1
+    marks[run_rows[filled], ends[filled]] = -1
+    return np.cumsum(marks, axis=1, dtype=np.int8)[:, :w] > 0
+
+def ignite_oil(world: np.ndarray, ages: np.ndarray, spread: int = None) -> None:
+    """
+    Sets fire to oil (and any other flammable element) touching fire.
+
+    By default the whole connected body of oil catches at once. With
+    spread set, the flames move that many cells into the oil per tick
+    instead.
+
+    Args:
+        world: 2D array representing the simulation grid
+        ages: per-cell particle ages
+        spread: cells the flames advance through oil per tick (at least 1), or None for all at once
+    """
+    if spread is not None and spread < 1:
+        raise ValueError(f"spread must be at least 1 or None, got {spread}")
+    oil = _of_type(world, FLAMMABLE)
+    if not oil.any():
+        return
+    # Fire on the bottom row is never updated, so it doesn't spread either
+    fire = world == FIRE
+    fire[-1] = False
+    if not fire.any():
+        return
+    burning = _near(fire) & oil
+    if not burning.any():
+        return
+    if spread is None:
+        burning = _connected(oil, burning)
+    else:
+        for _ in range(spread - 1):
+            burning = _near(burning) & oil
+    world[burning] = FIRE
+    ages[burning] = 0
+
+def apply_reactions(world: np.ndarray, ages: np.ndarray) -> None:
+    """
+    Turns particles touching something they react with into the reaction
+    product. Catching fire is left to ignite_oil, and elements with their
+    own update handler react inside it.
+
+    Args:
+        world: 2D array representing the simulation grid
+        ages: per-cell particle ages
+    """
+    for particle_type, neighbor, result in REACTIVE:
+        reacting = world[:-1] == particle_type
+        if reacting.any():
+            reacting &= _near(world == neighbor)[:-1]
+            world[:-1][reacting] = result
+            ages[:-1][reacting] = 0
+
+def neighbor_fields(world: np.ndarray, types: list[int] = None) -> dict:
+    """
+    Marks, for each watched type, every cell with that type in its 3x3
+    neighborhood. The engines compute these once per tick, after fire has
+    spread, so the per-cell handlers check their surroundings (fire putting
+    out, snow melting faster) with one lookup instead of a 3x3 scan.
+
+    Args:
+        world: 2D array representing the simulation grid
+        types: types to mark cells next to (defaults to WATCHED)
+
+    Returns:
+        dict: {type: boolean mask of cells next to (or on) that type}
+    """
+    return {particle_type: _near(world == particle_type)
+            for particle_type in (WATCHED if types is None else types)}
+
+def _tick_interaction(interaction: ParticleInteraction, rng: ParticleRandom,
+                      liquid_spread: int) -> ParticleInteraction:
+    """Readies the given handlers for a tick, or builds new ones if there are none."""
+    if interaction is None:
+        return ParticleInteraction(rng, liquid_spread)
+    interaction.begin_tick()
+    return interaction
+
+def update_particles(world: list[list[int]], ages: np.ndarray, chunks: ChunkTracker = None,
+                     oil_spread: int = None, rng: ParticleRandom = None,
+                     profiler: Profiler = None, liquid_spread: int = LIQUID_SPREAD,
+                     active: ActiveParticles = None, interaction: ParticleInteraction = None) -> None:
+    """
+    Updates all particles in the simulation for one time step.
+    
+    Args:
+        world: 2D list representing the simulation grid
+        ages: per-cell particle ages, advanced by one tick
+        chunks: optional tracker; when given only awake chunks are updated
+        oil_spread: cells fire spreads through oil per tick, or None to light a whole body at once
+        rng: random source for the tick (defaults to DEFAULT_RANDOM)
+        profiler: optional Profiler to record the tick in
+        liquid_spread: cells a resting liquid drop moves sideways per tick, or
+            None to drop straight into the nearest gap
+        active: optional ActiveParticles; when given only the cells holding
+            particles are visited, which is much faster for sparse scenes.
+            Gives the same result as a full scan.
+        interaction: handlers to reuse instead of building them for this
+            tick; its own rng and liquid spread are used
+    """
+    if chunks is not None and active is not None:
+        raise ValueError("update_particles takes chunks or active, not both")
+    grid = world
+    start = clock = None if profiler is None else profiler.begin_tick(grid)
+    if chunks is not None:
+        # The tick runs on the rows around the awake chunks alone
+        window = chunks.begin_tick(world)
+        world, ages = world[window], ages[window]
+    rows, cols = len(world), len(world[0]) if len(world) else 0
+    interaction = _tick_interaction(interaction, rng, liquid_spread)
+    rng = interaction.rng
+    # Every particle can draw numbers, and embers can be handled twice
+    rng.refill(2 * DRAWS_PER_CELL * np.count_nonzero(world))
+    rising_handlers, handlers = interaction.rising_handlers, interaction.handlers
+    if profiler is not None:
+        rising_handlers, handlers = profiler.wrap(rising_handlers), profiler.wrap(handlers)
+    if active is not None:
+        _update_active(world, ages, active.attach(world), interaction, rising_handlers, handlers,
+                       oil_spread, profiler, start)
+        return
+    columns = [range(cols-1, -1, -1)] * rows if chunks is None else chunks.columns()
+    
+    # Update rising particles (embers) from top to bottom
+    for i in range(rows-1):
+        for j in reversed(columns[i]):
+            handler = rising_handlers[world[i][j]]
+            if handler is not None:
+                handler(world, i, j, ages)
+    if profiler is not None:
+        clock = profiler.lap("update.rising", clock)
+    
+    ignite_oil(world, ages, oil_spread)
+    apply_reactions(world, ages)
+    interaction.near = neighbor_fields(world)
+    if profiler is not None:
+        clock = profiler.lap("update.ignite", clock)
+    
+    # Update from bottom to top for proper particle movement
+    for i in range(rows-2, -1, -1):
+        for j in columns[i]:
+            handler = handlers[world[i][j]]
+            if handler is not None:
+                handler(world, i, j, ages)
+    if profiler is not None:
+        clock = profiler.lap("update.cells", clock)
+
+    advance_ages(world, ages)
+    if chunks is not None:
+        chunks.end_tick(grid)
+    if profiler is not None:
+        profiler.lap("update.ages", clock)
+        profiler.end_tick(grid, sum(map(len, columns)), start)
+
+def _update_active(world: np.ndarray, ages: np.ndarray, active: ActiveParticles,
+                   interaction: ParticleInteraction, rising_handlers: list, handlers: list,
+                   oil_spread: int, profiler: Profiler, start: float) -> None:
+    """
+    Runs the phases of update_particles over the particles an ActiveParticles
+    tracks instead of over every cell.
+    """
+    clock = start
+    visited = active.run(rising_handlers, ages, top_down=True)
+    if profiler is not None:
+        clock = profiler.lap("update.rising", clock)
+
+    before = world.copy()
+    ignite_oil(world, ages, oil_spread)
+    apply_reactions(world, ages)
+    active.refresh(before)
+    interaction.near = neighbor_fields(world)
+    if profiler is not None:
+        clock = profiler.lap("update.ignite", clock)
+
+    visited += active.run(handlers, ages, top_down=False)
+    if profiler is not None:
+        clock = profiler.lap("update.cells", clock)
+
+    advance_ages(world, ages)
+    if profiler is not None:
+        profiler.lap("update.ages", clock)
+        profiler.end_tick(world, visited, start)
+
+def _compiled(function):
+    """Compiles a kernel function with numba when it is installed."""
+    return numba.njit(cache=True)(function) if numba is not None else function
+
+# What each particle type does in the compiled kernel
+KERNEL_NONE, KERNEL_POWDER, KERNEL_POOL, KERNEL_FLOW, KERNEL_OIL, KERNEL_FIRE, KERNEL_SNOW, KERNEL_EMBER = range(8)
+
+def _kernel_tables() -> tuple:
+    """
+    Compiles the registered elements into the arrays the kernel reads.
+
+    Returns:
+        tuple: (rising kinds, cell kinds, sinks, reactions, reaction order,
+        surfaces, floats, watched index), or None if an element has an update
+        handler the kernel doesn't have
+    """
+    known = {
+        ParticleInteraction.handle_powder: KERNEL_POWDER,
+        ParticleInteraction.handle_pool: KERNEL_POOL,
+        ParticleInteraction.handle_flow: KERNEL_FLOW,
+        ParticleInteraction.handle_oil: KERNEL_OIL,
+        ParticleInteraction.handle_fire: KERNEL_FIRE,
+        ParticleInteraction.handle_snow: KERNEL_SNOW,
+    }
+    defaults = {POWDER: KERNEL_POWDER, POOL: KERNEL_POOL, FLOW: KERNEL_FLOW, RISING: KERNEL_EMBER}
+    rising_kinds = np.zeros(256, dtype=np.uint8)
+    cell_kinds = np.zeros(256, dtype=np.uint8)
+    sinks = np.full((256, 256), -1, dtype=np.int16)      # left behind, or -1
+    reactions = np.full((256, 256), -1, dtype=np.int16)  # result, or -1
+    # Neighbors in the order react() tries them, then -1
+    reaction_order = np.full((256, max([len(e.reactions) for e in ELEMENTS.values()] + [0]) + 1), -1,
+                             dtype=np.int16)
+    watched = np.full(256, -1, dtype=np.int16)  # row in the neighbor fields, or -1
+    surfaces = np.zeros((256, 256), dtype=np.bool_)
+    floats = np.zeros((256, 256), dtype=np.bool_)
+    for code, element in ELEMENTS.items():
+        if element.update is None:
+            kind = defaults.get(element.movement, KERNEL_NONE)
+        elif element.update in known:
+            kind = known[element.update]
+        else:
+            return None
+        (rising_kinds if element.movement == RISING else cell_kinds)[code] = kind
+        for below, left_behind in element.sinks.items():
+            sinks[code, below] = left_behind
+        for n, (neighbor, result) in enumerate(element.reactions.items()):
+            reactions[code, neighbor] = result
+            reaction_order[code, n] = neighbor
+        for surface in SURFACES.get(code, ()):
+            surfaces[code, surface] = True
+    for light, heavy in FLOATS:
+        floats[light, heavy] = True
+    for row, particle_type in enumerate(WATCHED):
+        watched[particle_type] = row
+    return rising_kinds, cell_kinds, sinks, reactions, reaction_order, surfaces, floats, watched
+
+# The kernel functions below mirror the ParticleMovement and
+# ParticleInteraction rules step for step, on a flat grid (cell i * width + j),
+# and draw from the ParticleRandom buffer in the same order, so both give
+# the same world for the same seed. They are plain Python when numba isn't
+# installed, which is far too slow to use but handy for checking them.
+
+@_compiled
+def _kernel_side(draw, left_free, right_free):
+    """
+    ParticleMovement.move_sideways' choice of direction, from its random
+    draw and whether the cells down-left and down-right are empty.
+    Returns -1, 1, or 0 if neither is empty.
+    """
+    direction = -1 if draw < 0.5 else 1
+    if left_free if direction < 0 else right_free:
+        return direction
+    if right_free if direction < 0 else left_free:
+        return -direction
+    return 0
+
+@_compiled
+def _kernel_scan(grid, moved_from, moved_to, surfaces, use_surfaces, particle, row, width, j, dx):
+    """
+    One direction of ParticleMovement.spread's look along the row from
+    column j, with the moved sets kept as flags per cell.
+
+    Returns (rank, gap, end): the drops in front of this one, the first gap
+    cell past them (-1 if there's none to reach) and the first column past
+    the gap that a drop can't cross on the way to a later gap cell (which
+    may be off the grid). The drop's own gap cell is rank cells past the
+    first one, and it can get there if that is short of end.
+    """
+    below = row + width
+    k, rank = j + dx, 0
+    while 0 <= k < width and ((grid[row + k] == particle and not moved_to[row + k]) or moved_from[row + k]):
+        k += dx
+        rank += 1
+    while 0 <= k < width and (grid[row + k] == EMPTY or moved_to[row + k]):
+        if grid[below + k] == EMPTY or moved_to[below + k]:
+            break
+        if use_surfaces and not surfaces[particle, grid[below + k]]:
+            return rank, -1, 0
+        k += dx
+    if not 0 <= k < width or not (grid[row + k] == EMPTY or moved_to[row + k]):
+        return rank, -1, 0
+    end = k + dx
+    while 0 <= end < width and grid[row + end] == EMPTY \
+            and (grid[below + end] == EMPTY or moved_to[below + end]):
+        end += dx
+    return rank, k, end
+
+@_compiled
+def _kernel_pass(grid, ages, height, width, kinds, top_down, sinks, reactions, reaction_order, surfaces,
+                 floats, near, watched, spread, awake, chunk_size, moved_from, moved_to, rand, pos):
+    """
+    Runs every particle's rule over the grid in update_particles' scan
+    order: top to bottom and left to right for rising particles, bottom to
+    top and right to left for the rest. The bottom row isn't updated, and
+    neither are cells in chunks (chunk_size square) marked asleep in awake.
+    Returns pos.
+
+    The rules are written out in the loop instead of called per cell, as
+    numba counts references to every array passed to a call. A resting
+    liquid drop starts from the look along the row made by the drop just
+    right of it (they see the same run, one drop apart) instead of walking
+    the run again, so a row of drops costs time linear in its width. A drop
+    that spreads changes the row on the side it went, so the next drop
+    looks that way afresh.
+    """
+    chunks_across = awake.shape[1]
+    for step in range(height - 1):
+        i = step if top_down else height - 2 - step
+        row = i * width
+        chunk_row = i // chunk_size
+        # The last look along this row each way: (column, particle) it was
+        # made from, and what _kernel_scan returned
+        left_from = right_from = -1
+        left_particle = right_particle = EMPTY
+        left_rank = left_gap = left_end = right_rank = right_gap = right_end = 0
+        for c in range(chunks_across):
+            chunk = c if top_down else chunks_across - 1 - c
+            if not awake[chunk_row, chunk]:
+                continue
+            first, last = chunk * chunk_size, min((chunk + 1) * chunk_size, width)
+            for column in range(first, last):
+                j = column if top_down else first + last - 1 - column
+                here = row + j
+                particle = grid[here]
+                kind = kinds[particle]
+                if kind == KERNEL_NONE:
+                    continue
+                under = here + width
+
+                if kind == KERNEL_EMBER:
+                    # ParticleMovement.move_ember
+                    pos -= 1
+                    if rand[pos] < 0.3:
+                        new_j = j
+                        pos -= 1
+                        if rand[pos] < 0.2:
+                            pos -= 1
+                            new_j = j + (-1 if rand[pos] < 0.5 else 1)
+                        if i > 0 and 0 <= new_j < width and grid[row - width + new_j] == EMPTY:
+                            grid[row - width + new_j] = particle
+                            grid[here] = EMPTY
+                        elif i == 0 or grid[here - width] != EMPTY:
+                            grid[here] = EMPTY
+                    continue
+
+                if kind == KERNEL_SNOW:
+                    melt_speed = FIRE_MELT_SPEED if near[watched[FIRE], here] else 1
+                    if ages[here] > SNOW_MELT_TIME / melt_speed:
+                        grid[here] = RAIN
+                        continue
+                    kind = KERNEL_POWDER
+
+                if kind == KERNEL_FIRE:
+                    reacted = False
+                    for n in range(reaction_order.shape[1]):
+                        neighbor = reaction_order[particle, n]
+                        if neighbor < 0:
+                            break
+                        if near[watched[neighbor], here]:
+                            grid[here] = reactions[particle, neighbor]
+                            ages[here] = 0
+                            reacted = True
+                            break
+                    if reacted:
+                        continue
+                    if ages[here] > FIRE_LIFETIME:
+                        grid[here] = EMPTY
+                        continue
+                    pos -= 1
+                    if rand[pos] < EMBER_CHANCE and i > 0 and grid[here - width] == EMPTY:
+                        grid[here - width] = EMBER
+                    if grid[under] == EMPTY:
+                        grid[here] = EMPTY
+                        grid[under] = FIRE
+                        ages[under] = ages[here]
+                        continue
+                    pos -= 1
+                    dx = _kernel_side(rand[pos], j > 0 and grid[under - 1] == EMPTY,
+                                      j + 1 < width and grid[under + 1] == EMPTY)
+                    if dx != 0:
+                        grid[here] = EMPTY
+                        grid[under + dx] = FIRE
+                        ages[under + dx] = ages[here]
+                    continue
+
+                if kind == KERNEL_POWDER:
+                    # ParticleInteraction.handle_powder
+                    below = grid[under]
+                    if below == EMPTY:
+                        grid[here] = EMPTY
+                        grid[under] = particle
+                        ages[under] = ages[here]
+                    elif sinks[particle, below] >= 0:
+                        grid[here] = sinks[particle, below]
+                        grid[under] = particle
+                        ages[under] = ages[here]
+                    else:
+                        pos -= 1
+                        dx = _kernel_side(rand[pos], j > 0 and grid[under - 1] == EMPTY,
+                                          j + 1 < width and grid[under + 1] == EMPTY)
+                        if dx != 0:
+                            grid[here] = EMPTY
+                            grid[under + dx] = particle
+                            ages[under + dx] = ages[here]
+                    continue
+
+                if kind == KERNEL_POOL:
+                    # ParticleInteraction.handle_pool
+                    below = grid[under]
+                    if sinks[particle, below] >= 0:
+                        grid[here] = sinks[particle, below]
+                        grid[under] = particle
+                        continue
+                    if below == EMPTY:
+                        grid[here] = EMPTY
+                        grid[under] = particle
+                        continue
+                    if not surfaces[particle, below]:
+                        continue
+                else:
+                    # ParticleInteraction.handle_flow and handle_oil
+                    if kind == KERNEL_OIL and i < height - OIL_MAX_DEPTH:
+                        # At most OIL_MAX_DEPTH layers deep
+                        capped = True
+                        for d in range(1, OIL_MAX_DEPTH + 1):
+                            if grid[here + d * width] != OIL:
+                                capped = False
+                                break
+                        if capped:
+                            grid[here] = EMPTY
+                            continue
+                    if i > 0 and floats[particle, grid[here - width]]:
+                        grid[here] = grid[here - width]
+                        grid[here - width] = particle
+                        continue
+                    if grid[under] == EMPTY:
+                        grid[here] = EMPTY
+                        grid[under] = particle
+                        continue
+                    pos -= 1
+                    dx = _kernel_side(rand[pos], j > 0 and grid[under - 1] == EMPTY,
+                                      j + 1 < width and grid[under + 1] == EMPTY)
+                    if dx != 0:
+                        grid[here] = EMPTY
+                        grid[under + dx] = particle
+                        continue
+
+                # ParticleMovement.spread
+                if moved_to[here]:
+                    continue
+                use_surfaces = kind == KERNEL_POOL
+                if left_from == j + 1 and left_particle == particle:
+                    # This drop was the first one in front of the last
+                    left_rank -= 1
+                else:
+                    left_rank, left_gap, left_end = _kernel_scan(grid, moved_from, moved_to, surfaces, use_surfaces,
+                                                                 particle, row, width, j, -1)
+                if right_from == j + 1 and right_particle == particle:
+                    # and the last drop is in front of this one
+                    right_rank += 1
+                else:
+                    right_rank, right_gap, right_end = _kernel_scan(grid, moved_from, moved_to, surfaces,
+                                                                    use_surfaces, particle, row, width, j, 1)
+                left_from = right_from = j
+                left_particle = right_particle = particle
+
+                found = False
+                best_target, best_travel, best_rank, best_dx = 0, 0, 0, 0
+                for dx in (-1, 1):
+                    if dx < 0:
+                        rank, gap, end = left_rank, left_gap, left_end
+                    else:
+                        rank, gap, end = right_rank, right_gap, right_end
+                    if gap < 0:
+                        continue
+                    target = gap + rank * dx
+                    if (end - target) * dx <= 0:
+                        continue
+                    travel = abs(target - j)
+                    take = not found or travel < best_travel
+                    if not take and travel == best_travel:
+                        pos -= 1
+                        take = rand[pos] < 0.5
+                    if take:
+                        found = True
+                        best_target, best_travel, best_rank, best_dx = target, travel, rank, dx
+                if not found:
+                    continue
+                if spread < 0 or best_travel <= spread:
+                    there = row + width + best_target
+                elif best_rank < spread:
+                    there = here + best_dx * spread
+                else:
+                    continue
+                if grid[there] != EMPTY:
+                    continue
+                grid[here] = EMPTY
+                grid[there] = particle
+                moved_from[here] = 1
+                moved_to[there] = 1
+                if best_dx < 0:
+                    left_from = -1
+                else:
+                    right_from = -1
+    return pos
+
+def update_particles_compiled(world: np.ndarray, ages: np.ndarray, chunks: ChunkTracker = None,
+                              oil_spread: int = None, rng: ParticleRandom = None,
+                              profiler: Profiler = None, liquid_spread: int = LIQUID_SPREAD,
+                              interaction: ParticleInteraction = None) -> None:
+    """
+    Updates all particles for one time step like update_particles, but runs
+    the per-cell rules as compiled loops over the grid's bytes when numba
+    is installed. The result is the same as update_particles for the same
+    seed.
+
+    Falls back to update_particles when numba isn't installed, when the
+    grid isn't a contiguous array, or when an element has an update
+    handler of its own.
+
+    Args:
+        world: 2D array representing the simulation grid
+        ages: per-cell particle ages, advanced by one tick
+        chunks: optional tracker; when given only awake chunks are updated
+        oil_spread: cells fire spreads through oil per tick, or None to light a whole body at once
+        rng: random source for the tick (defaults to DEFAULT_RANDOM)
+        profiler: optional Profiler to record the tick in
+        liquid_spread: cells a resting liquid drop moves sideways per tick, or
+            None to drop straight into the nearest gap
+        interaction: handlers to reuse instead of building them for this
+            tick; its own rng and liquid spread are used, and the kernel's
+            tables are kept on it
+    """
+    tables = None
+    if numba is not None and isinstance(world, np.ndarray) and world.flags.c_contiguous and ages.flags.c_contiguous:
+        if interaction is None:
+            tables = _kernel_tables()
+        else:
+            if interaction.kernel_tables is None:
+                interaction.kernel_tables = _kernel_tables() or ()
+            tables = interaction.kernel_tables or None
+    if tables is None:
+        update_particles(world, ages, chunks, oil_spread, rng, profiler, liquid_spread,
+                         interaction=interaction)
+        return
+    if interaction is not None:
+        rng, liquid_spread = interaction.rng, interaction.movement.liquid_spread
+    _step_kernel(world, ages, tables, oil_spread, rng, profiler, liquid_spread, chunks)
+
+def _step_kernel(world: np.ndarray, ages: np.ndarray, tables: tuple, oil_spread: int = None,
+                 rng: ParticleRandom = None, profiler: Profiler = None,
+                 liquid_spread: int = LIQUID_SPREAD, chunks: ChunkTracker = None) -> None:
+    """Runs one tick with the kernel functions, using tables from _kernel_tables."""
+    start = clock = None if profiler is None else profiler.begin_tick(world)
+    rng = rng or DEFAULT_RANDOM
+    rising_kinds, cell_kinds, sinks, reactions, reaction_order, surfaces, floats, watched = tables
+    full_world = world
+    if chunks is None:
+        # One chunk covering the whole grid
+        height, width = world.shape
+        awake, chunk_size, visited = np.ones((1, 1), dtype=np.bool_), max(height, width), height * width
+    else:
+        # The tick runs on the rows around the awake chunks alone
+        window = chunks.begin_tick(world)
+        world, ages = world[window], ages[window]
+        awake, chunk_size = chunks.awake[chunks.window_chunks], chunks.chunk_size
+        visited = int(np.count_nonzero(chunks.window_mask()))
+        height, width = world.shape
+    grid, flat_ages = world.reshape(-1), ages.reshape(-1)
+    spread = -1 if liquid_spread is None else liquid_spread
+    moved_from = np.zeros(grid.shape, dtype=np.uint8)
+    moved_to = np.zeros(grid.shape, dtype=np.uint8)
+    rand, pos = rng.refill_array(2 * DRAWS_PER_CELL * np.count_nonzero(world))
+
+    # Embers don't look at their neighbors, so the fields aren't needed yet
+    no_fields = np.zeros((0, 0), dtype=np.bool_)
+    pos = _kernel_pass(grid, flat_ages, height, width, rising_kinds, True, sinks, reactions, reaction_order,
+                       surfaces, floats, no_fields, watched, spread, awake, chunk_size, moved_from, moved_to,
+                       rand, pos)
+    if profiler is not None:
+        clock = profiler.lap("update.rising", clock)
+
+    ignite_oil(world, ages, oil_spread)
+    apply_reactions(world, ages)
+    fields = neighbor_fields(world)
+    near = np.stack([fields[particle_type].reshape(-1) for particle_type in WATCHED])
+    if profiler is not None:
+        clock = profiler.lap("update.ignite", clock)
+
+    pos = _kernel_pass(grid, flat_ages, height, width, cell_kinds, False, sinks, reactions, reaction_order,
+                       surfaces, floats, near, watched, spread, awake, chunk_size, moved_from, moved_to,
+                       rand, pos)
+    rng.release_array(pos)
+    if profiler is not None:
+        clock = profiler.lap("update.cells", clock)
+
+    advance_ages(world, ages)
+    if chunks is not None:
+        chunks.end_tick(full_world)
+    if profiler is not None:
+        profiler.lap("update.ages", clock)
+        profiler.end_tick(full_world, visited, start)
+
+def _shift(grid: np.ndarray, dy: int, dx: int, fill: int = 0) -> np.ndarray:
+    """
+    Returns a copy of grid moved by (dy, dx), so out[i+dy][j+dx] == grid[i][j].
+
+    Args:
+        grid: 2D array to shift
+        dy: row offset
+        dx: column offset
+        fill: value for cells shifted in from outside the grid
+
+    Returns:
+        np.ndarray: shifted copy of grid
+    """
+    out = np.full_like(grid, fill)
+    h, w = grid.shape
+    out[max(dy, 0):h + min(dy, 0), max(dx, 0):w + min(dx, 0)] = \
+        grid[max(-dy, 0):h + min(-dy, 0), max(-dx, 0):w + min(-dx, 0)]
+    return out
+
+def _move_cells(world: np.ndarray, src: np.ndarray, dy: int, dx: int) -> np.ndarray:
+    """
+    Moves every particle marked in src by (dy, dx), overwriting the targets.
+
+    Args:
+        world: 2D array representing the simulation grid
+        src: boolean mask of particles to move
+        dy: row offset
+        dx: column offset
+
+    Returns:
+        np.ndarray: boolean mask of the cells the particles moved into
+    """
+    # Masks are applied with arithmetic, which is much faster than
+    # boolean indexing when the moving cells are scattered
+    dst = _shift(src, dy, dx)
+    moved = _shift(world, dy, dx)
+    world *= (~(src | dst)).view(np.uint8)
+    world += moved * dst.view(np.uint8)
+    return dst
+
+def _swap_cells(world: np.ndarray, src: np.ndarray, dy: int, dx: int) -> np.ndarray:
+    """
+    Swaps every particle marked in src with the cell at offset (dy, dx).
+
+    Args:
+        world: 2D array representing the simulation grid
+        src: boolean mask of particles to swap
+        dy: row offset
+        dx: column offset
+
+    Returns:
+        np.ndarray: boolean mask of the cells the particles moved into
+    """
+    dst = _shift(src, dy, dx)
+    forward = _shift(world, dy, dx)
+    backward = _shift(world, -dy, -dx)
+    world *= (~(src | dst)).view(np.uint8)
+    world += backward * src.view(np.uint8) + forward * dst.view(np.uint8)
+    return dst
+
+def _falling_runs(world: np.ndarray, fallers: np.ndarray) -> np.ndarray:
+    """
+    Finds the particles that fall one cell this tick.
+
+    A particle falls when the first non-falling cell below it is EMPTY, so a
+    whole column of particles drops together the way it does when
+    update_particles walks the grid from the bottom up.
+
+    Args:
+        world: 2D array representing the simulation grid
+        fallers: boolean mask of particles that are allowed to fall
+
+    Returns:
+        np.ndarray: boolean mask of particles that fall
+    """
+    # 1 = empty cell below the run, 2 = blocked, 0 = still unknown
+    below = (world != EMPTY).view(np.uint8) + np.uint8(1)
+    below *= (~fallers).view(np.uint8)
+    below[-1] |= (below[-1] == 0) * np.uint8(2)
+    # Pointer jumping: each pass doubles how far down a run is resolved.
+    # Unknown cells are 0, so OR-ing in the masked value fills only those.
+    reach = 1
+    unknown = below == 0
+    while reach < len(world) and unknown.any():
+        below[:-reach] |= below[reach:] * unknown[:-reach].view(np.uint8)
+        unknown = below == 0
+        reach *= 2
+    falls = np.zeros_like(fallers)
+    falls[:-1] = fallers[:-1] & (below[1:] == 1)
+    return falls
+
+def _near(mask: np.ndarray) -> np.ndarray:
+    """
+    Marks every cell that has a marked cell in its 3x3 neighborhood.
+
+    Args:
+        mask: boolean mask of cells to look for
+
+    Returns:
+        np.ndarray: boolean mask of cells next to (or on) a marked cell
+    """
+    if not mask.any():
+        return mask.copy()
+    # The 3x3 box is a row of 3 ORed with the rows above and below
+    wide = mask.copy()
+    wide[:, 1:] |= mask[:, :-1]
+    wide[:, :-1] |= mask[:, 1:]
+    near = wide.copy()
+    near[1:] |= wide[:-1]
+    near[:-1] |= wide[1:]
+    return near
+
+def _spread_liquid(world: np.ndarray, liquid: np.ndarray, movable: np.ndarray, surface: np.ndarray,
+                   go_left: np.ndarray, distance: int = LIQUID_SPREAD) -> None:
+    """
+    Moves resting liquid sideways toward the nearest gap it can drop into,
+    like ParticleMovement.spread.
+
+    Each drop looks both ways along its row, past the drops next to it and
+    across empty cells above the surface, and heads for the closer gap
+    (picking a side with go_left when both are equally close). The drop at
+    the front of a run takes the first gap cell, the one behind it the
+    next, and so on, so a run pours over an edge several drops at a time.
+    A drop within distance of its gap cell drops into it. When the gap is
+    further away, the first distance drops of the run move distance cells
+    toward it. Drops with no gap in reach stay put, so a level surface
+    stays still.
+
+    Args:
+        world: 2D array representing the simulation grid
+        liquid: boolean mask of liquid particles that may spread
+        movable: boolean mask of cells that haven't moved yet this tick
+        surface: boolean mask of cells the liquid can move across
+        go_left: boolean mask choosing the side for drops between two equal gaps
+        distance: cells a drop moves per tick, or None to drop straight into the gap
+    """
+    # Only rows where a run ends next to an empty cell and there is a gap
+    # to head for can change
+    empty = world == EMPTY
+    exposed = liquid & (_shift(empty, 0, 1) | _shift(empty, 0, -1))
+    rows = np.flatnonzero(exposed.any(axis=1))
+    if len(rows) == 0:
+        return
+    gaps = empty[rows] & (_shift(world, -1, 0, FLOOR)[rows] == EMPTY)
+    reachable = gaps.any(axis=1)
+    if not reachable.any():
+        return
+    rows, gaps = rows[reachable], gaps[reachable]
+    width = world.shape[1]
+    runs = liquid[rows]
+    walls = ~empty[rows] | ~(surface[rows] | gaps)
+    cols = np.arange(width, dtype=np.int32)
+    i, j = np.nonzero(runs)
+
+    def reach(flip: bool) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Finds each drop's gap cell on one side (left, or right when flip is set).
+
+        Returns:
+            tuple: (gap cell column, cells to travel to it, place in the run
+            counted from the front)
+        """
+        if flip:
+            target, travel, rank = reach_left(runs[:, ::-1], gaps[:, ::-1], walls[:, ::-1], width - 1 - j)
+            return width - 1 - target, travel, rank
+        return reach_left(runs, gaps, walls, j)
+
+    def reach_left(runs, gaps, walls, j) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Start of each drop's run, the nearest gap past it, and where that
+        # stretch of gap cells ends
+        start = np.maximum.accumulate(np.where(runs, -1, cols), axis=1)[i, j] + 1
+        before = np.maximum(start - 1, 0)
+        gap = np.maximum.accumulate(np.where(gaps, cols, -1), axis=1)[i, before]
+        wall = np.maximum.accumulate(np.where(walls, cols, -1), axis=1)[i, before]
+        gap_end = np.maximum.accumulate(np.where(gaps, -1, cols), axis=1)[i, np.maximum(gap, 0)]
+        rank = j - start
+        target = gap - rank
+        ok = (start > 0) & (gap > wall) & (target > gap_end)
+        return np.where(ok, target, -1), np.where(ok, j - target, width), rank
+
+    left, to_left, left_rank = reach(False)
+    right, to_right, right_rank = reach(True)
+    moving = (to_left < width) | (to_right < width)
+    if not moving.any():
+        return
+    goes_left = (to_left < to_right) | ((to_left == to_right) & go_left[rows[i], j])
+    i, j, goes_left = rows[i[moving]], j[moving], goes_left[moving]
+    k = np.where(goes_left, left[moving], right[moving])
+    travel = np.where(goes_left, to_left[moving], to_right[moving])
+    drop = np.ones(len(i), dtype=bool)
+    if distance is not None:
+        drop = travel <= distance
+        # Out of reach: the front of the run moves over the empty cells
+        # ahead of it, toward the gap
+        rank = np.where(goes_left, left_rank[moving], right_rank[moving])
+        keep = drop | (rank < distance)
+        i, j, k, travel, drop, goes_left = (a[keep] for a in (i, j, k, travel, drop, goes_left))
+        k = np.where(drop, k, j + np.where(goes_left, -distance, distance))
+    # Drops heading for the same cell: the closest one goes, the rest wait
+    targets = (i + drop) * width + k
+    order = np.lexsort((travel, targets))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = targets[order][1:] != targets[order][:-1]
+    keep = order[first]
+    i, j, k, drop = i[keep], j[keep], k[keep], drop[keep]
+    particles = world[i, j]
+    world[i, j] = EMPTY
+    movable[i, j] = False
+    world[i + drop, k] = particles
+    movable[i + drop, k] = False
+
+def update_particles_vectorized(world: np.ndarray, ages: np.ndarray, chunks: ChunkTracker = None,
+                                oil_spread: int = None, stepper: "ParallelStepper" = None,
+                                rng: ParticleRandom = None, profiler: Profiler = None,
+                                liquid_spread: int = LIQUID_SPREAD,
+                                interaction: ParticleInteraction = None,
+                                velocities: np.ndarray = None) -> None:
+    """
+    Updates all particles in the simulation for one time step using
+    whole-array operations.
+
+    Falling, sinking and sliding for powders and liquids are applied to
+    every particle at once, and so is snow melting. Rising and CUSTOM
+    elements (embers and fire) still go through their per-cell handlers.
+
+    Without velocities, falling particles move one cell per tick. With
+    them, a falling particle speeds up by one cell per tick, up to
+    TERMINAL_VELOCITY, so a drop from the top of a tall world lands in
+    about the square root of the ticks it would otherwise take.
+
+    Args:
+        world: 2D array representing the simulation grid
+        ages: per-cell particle ages, advanced by one tick
+        chunks: optional tracker; when given only awake chunks are updated
+        oil_spread: cells fire spreads through oil per tick, or None to light a whole body at once
+        stepper: optional ParallelStepper that moves particles on several cores
+        rng: random source for the tick (defaults to DEFAULT_RANDOM)
+        profiler: optional Profiler to record the tick in
+        liquid_spread: cells a resting liquid drop moves sideways per tick, or
+            None to drop straight into the nearest gap
+        interaction: handlers to reuse instead of building them for this
+            tick; its own rng and liquid spread are used
+        velocities: optional per-cell falling speeds (see create_velocities),
+            moved and updated along with the particles
+    """
+    start = clock = None if profiler is None else profiler.begin_tick(world)
+    full_world, full_ages, full_velocities = world, ages, velocities
+    if chunks is not None:
+        # The tick runs on the rows around the awake chunks alone
+        window = chunks.begin_tick(world)
+        world, ages = world[window], ages[window]
+        if velocities is not None:
+            velocities = velocities[window]
+    interaction = _tick_interaction(interaction, rng, liquid_spread)
+    rng, liquid_spread = interaction.rng, interaction.movement.liquid_spread
+    rising_handlers, handlers = interaction.rising_handlers, interaction.handlers
+    if profiler is not None:
+        rising_handlers, handlers = profiler.wrap(rising_handlers), profiler.wrap(handlers)
+
+    # Embers rise, so walk them from the top down
+    embers = _of_type(world[:-1], RISING_TYPES)
+    if embers.any():
+        rng.refill(DRAWS_PER_CELL * np.count_nonzero(embers))
+        rows, cols = np.nonzero(embers)
+        for i, j, particle in zip(rows.tolist(), cols.tolist(), world[:-1][embers].tolist()):
+            rising_handlers[particle](world, i, j, ages)
+    if profiler is not None:
+        clock = profiler.lap("update.rising", clock)
+
+    ignite_oil(world, ages, oil_spread)
+    apply_reactions(world, ages)
+    interaction.near = near = neighbor_fields(world)
+    if profiler is not None:
+        clock = profiler.lap("update.ignite", clock)
+
+    # Fire, bottom to top like update_particles
+    custom = _of_type(world[:-1], CUSTOM_TYPES)
+    if custom.any():
+        rng.refill(DRAWS_PER_CELL * np.count_nonzero(custom))
+        custom_types = set(CUSTOM_TYPES)
+        rows, cols = np.nonzero(custom)
+        for i, j in zip(rows[::-1].tolist(), cols[::-1].tolist()):
+            # A particle moved earlier in the pass may have left this cell
+            if world[i][j] in custom_types:
+                handlers[world[i][j]](world, i, j, ages)
+    if profiler is not None:
+        clock = profiler.lap("update.custom", clock)
+
+    # Melt snow into water, faster next to fire (as it was before the fire moved)
+    snow = world[:-1] == SNOW
+    if snow.any():
+        melt_times = np.where(near[FIRE][:-1], SNOW_MELT_TIME / FIRE_MELT_SPEED, SNOW_MELT_TIME)
+        melts = snow & (ages[:-1] > melt_times)
+        world[:-1][melts] = RAIN
+    if profiler is not None:
+        clock = profiler.lap("update.melt", clock)
+
+    movable = np.ones(world.shape, dtype=bool) if chunks is None else chunks.window_mask().copy()
+    # Only particles above the bottom row move, as in update_particles
+    movable[-1:] = False
+    if stepper is None:
+        _step_box(world, movable, ages,
+                  functools.partial(_step_vectorized, rng=rng, liquid_spread=liquid_spread), velocities)
+    elif chunks is None:
+        stepper.step(world, movable, ages, rng, liquid_spread, velocities)
+    else:
+        # The stepper keeps the whole grid in shared memory, so it gets the
+        # whole grid with the window's mask
+        full_movable = np.zeros(full_world.shape, dtype=bool)
+        full_movable[window] = movable
+        stepper.step(full_world, full_movable, full_ages, rng, liquid_spread, full_velocities)
+    if profiler is not None:
+        clock = profiler.lap("update.move", clock)
+
+    advance_ages(world, ages)
+    if chunks is not None:
+        chunks.end_tick(full_world)
+    if profiler is not None:
+        profiler.lap("update.ages", clock)
+        visited = np.count_nonzero(movable) + np.count_nonzero(embers) + np.count_nonzero(custom)
+        profiler.end_tick(full_world, int(visited), start)
+
+def _step_box(world: np.ndarray, movable: np.ndarray, ages: np.ndarray, step=None,
+              velocities: np.ndarray = None) -> None:
+    """
+    Steps only the box around the particles that can move, plus a margin of
+    one cell for them to move into (or, for oil, float up into). With
+    velocities the box reaches TERMINAL_VELOCITY cells further down, as
+    far as a particle can fall in one tick.
+
+    Args:
+        world: 2D array representing the simulation grid (or part of it)
+        movable: boolean mask of the particles that may move
+        ages: per-cell particle ages for the same cells
+        step: stepping function to run on the box (defaults to _step_vectorized)
+        velocities: optional per-cell falling speeds, passed on to step
+    """
+    occupied = movable & (world != EMPTY) & (world != FLOOR)
+    rows = np.flatnonzero(occupied.any(axis=1))
+    if len(rows) == 0:
+        return
+    cols = np.flatnonzero(occupied.any(axis=0))
+    top, bottom = max(rows[0] - 1, 0), rows[-1] + 2
+    left, right = max(cols[0] - 1, 0), cols[-1] + 2
+    box = (slice(top, bottom), slice(left, right))
+    if velocities is None:
+        (step or _step_vectorized)(world[box], movable[box], ages[box])
+    else:
+        box = (slice(top, bottom + TERMINAL_VELOCITY - 1), box[1])
+        (step or _step_vectorized)(world[box], movable[box], ages[box], velocities=velocities[box])
+
+def _step_vectorized(world: np.ndarray, movable: np.ndarray, ages: np.ndarray,
+                     rng: ParticleRandom = None, liquid_spread: int = LIQUID_SPREAD,
+                     velocities: np.ndarray = None) -> None:
+    """
+    Applies falling, sinking, sliding and flowing to part of the world.
+
+    Args:
+        world: view of the part of the grid to update
+        movable: boolean mask of the particles in the view that may move
+        ages: view of the particle ages for the same part of the grid
+        rng: random source for the slides (defaults to DEFAULT_RANDOM)
+        liquid_spread: cells a resting liquid drop moves sideways per tick
+        velocities: optional view of the falling speeds (see _accelerate_falls)
+    """
+    movable = movable.copy()
+    _step_vertical(world, movable, ages, velocities)
+    _step_lateral(world, movable, ages, rng, liquid_spread)
+
+def _step_vertical(world: np.ndarray, movable: np.ndarray, ages: np.ndarray,
+                   velocities: np.ndarray = None) -> None:
+    """
+    Applies the oil layer limit, floating and falling. These only move
+    particles within their own column.
+
+    Args:
+        world: view of the part of the grid to update
+        movable: boolean mask of the particles that may move; cleared for
+            particles that moved and the cells they moved into
+        ages: view of the particle ages for the same part of the grid
+        velocities: optional view of the falling speeds; without it every
+            falling particle moves one cell
+    """
+    # Oil layer limit, then liquids float up through denser liquids
+    oil = world == OIL
+    if oil.any():
+        capped = oil.copy()
+        capped[-OIL_MAX_DEPTH:] = False
+        for d in range(1, OIL_MAX_DEPTH + 1):
+            capped[:-OIL_MAX_DEPTH] &= oil[d:len(oil) - OIL_MAX_DEPTH + d]
+        world *= (~capped).view(np.uint8)
+    floats = np.zeros_like(movable)
+    if FLOATS:
+        above = _shift(world, 1, 0, FLOOR)
+        for light, heavy in FLOATS:
+            floats |= (world == light) & (above == heavy)
+        floats &= movable
+    if floats.any():
+        movable &= ~(floats | _swap_cells(world, floats, -1, 0))
+
+    # Gravity
+    fallers = movable & _of_type(world, FALLING)
+    if velocities is not None:
+        _accelerate_falls(world, movable, fallers, ages, velocities)
+        return
+    falls = _falling_runs(world, fallers)
+    if falls.any():
+        aging = falls & _of_type(world, AGING)
+        if aging.any():
+            _move_cells(ages, aging, 1, 0)
+        movable &= ~(falls | _move_cells(world, falls, 1, 0))
+
+def _accelerate_falls(world: np.ndarray, movable: np.ndarray, fallers: np.ndarray, ages: np.ndarray,
+                      velocities: np.ndarray) -> None:
+    """
+    Lets falling particles drop as far as their speed carries them.
+
+    Every falling particle gains one cell per tick of speed, up to
+    TERMINAL_VELOCITY, then marches down one cell at a time, checking each
+    cell on the way, until it has gone that far or lands on something.
+    Landing resets its speed to 0. Each cell of the march works like the
+    single step of _step_vertical, so a column of particles falling at the
+    same speed drops together and the first cell of every fall is the one
+    it would take without velocities.
+
+    Args:
+        world: view of the part of the grid to update
+        movable: boolean mask of the particles that may move; cleared for
+            particles that moved and the cells they moved into
+        fallers: boolean mask of the falling particles that may move
+        ages: view of the particle ages for the same part of the grid
+        velocities: view of the falling speeds, in cells per tick
+    """
+    # Speed up every falling particle; everything else is at rest
+    np.minimum(velocities, TERMINAL_VELOCITY - 1, out=velocities)
+    velocities += np.uint8(1)
+    velocities *= fallers.view(np.uint8)
+    # Cells each particle still has to fall this tick, carried along with it
+    remaining = velocities.copy()
+    going = fallers
+    while True:
+        # Only the rows from the highest particle still going down are involved
+        rows = np.flatnonzero(going.any(axis=1))
+        if len(rows) == 0:
+            return
+        view = slice(rows[0], None)
+        falls = _falling_runs(world[view], going[view])
+        landed = (going[view] & ~falls).view(np.uint8)
+        velocities[view] -= velocities[view] * landed
+        if not falls.any():
+            return
+        remaining[view] -= remaining[view] * landed
+        aging = falls & _of_type(world[view], AGING)
+        if aging.any():
+            _move_cells(ages[view], aging, 1, 0)
+        _move_cells(velocities[view], falls, 1, 0)
+        _move_cells(remaining[view], falls, 1, 0)
+        moved = _move_cells(world[view], falls, 1, 0)
+        movable[view] &= ~(falls | moved)
+        remaining[view] -= moved.view(np.uint8)
+        going = remaining > 0
+
+def _step_lateral(world: np.ndarray, movable: np.ndarray, ages: np.ndarray,
+                  rng: ParticleRandom = None, liquid_spread: int = LIQUID_SPREAD) -> None:
+    """
+    Applies dousing, sinking, sliding and flowing. These move particles at
+    most one row down, but liquid can spread along its row.
+
+    Args:
+        world: view of the part of the grid to update
+        movable: boolean mask of the particles that may move; cleared for
+            particles that moved and the cells they moved into
+        ages: view of the particle ages for the same part of the grid
+        rng: random source for the slides (defaults to DEFAULT_RANDOM)
+        liquid_spread: cells a resting liquid drop moves sideways per tick,
+            or None to drop straight into the nearest gap
+    """
+    # Particles sink into what's below them (water puts out fire, sand
+    # soaks up water, snow sinks through water and oil)
+    below = _shift(world, -1, 0, FLOOR)
+    sinks = np.zeros_like(movable)
+    left_behind = np.zeros_like(world)
+    for particle_type, target, left in SINKS:
+        pair = (world == particle_type) & (below == target)
+        sinks |= pair
+        if left != EMPTY:
+            left_behind += pair.view(np.uint8) * np.uint8(left)
+    sinks &= movable
+    if sinks.any():
+        # A particle on top of one that sinks waits until the next tick
+        sinks &= ~_shift(sinks, -1, 0)
+        aging = sinks & _of_type(world, AGING)
+        if aging.any():
+            _move_cells(ages, aging, 1, 0)
+        movable &= ~(sinks | _move_cells(world, sinks, 1, 0))
+        world += left_behind * sinks.view(np.uint8)
+
+    # Diagonal slides: powders and flowing liquids try a random side first
+    grains = movable & _of_type(world, POWDERS + FLOWS)
+    go_left = (rng or DEFAULT_RANDOM).coin_flips(world.shape)
+    aging = _of_type(world, AGING)
+    for dx, tries in ((-1, grains & go_left), (1, grains), (-1, grains)):
+        slides = movable & tries & (_shift(world, -1, -dx, FLOOR) == EMPTY)
+        if slides.any():
+            if (slides & aging).any():
+                _move_cells(ages, slides & aging, 1, dx)
+            movable &= ~(slides | _move_cells(world, slides, 1, dx))
+
+    # Liquids spread sideways toward the nearest gap once they can't fall
+    for pool_type in POOLS:
+        below = _shift(world, -1, 0, FLOOR)
+        surface = _of_type(below, SURFACES[pool_type])
+        _spread_liquid(world, movable & (world == pool_type) & surface, movable, surface,
+                       go_left, liquid_spread)
+    if FLOWS:
+        below = _shift(world, -1, 0, FLOOR)
+        _spread_liquid(world, movable & _of_type(world, FLOWS), movable, below != EMPTY,
+                       go_left, liquid_spread)
+
+# Shared arrays a worker process has attached to, keyed by block name
+_shared_arrays = {}
+
+def _attach_shared(name: str, shape: tuple[int, int], dtype: str) -> np.ndarray:
+    """
+    Returns an array backed by a shared memory block made by ParallelStepper.
+
+    Args:
+        name: name of the shared memory block
+        shape: shape of the array
+        dtype: dtype of the array
+
+    Returns:
+        np.ndarray: array viewing the shared block
+    """
+    if name not in _shared_arrays:
+        block = shared_memory.SharedMemory(name=name)
+        _shared_arrays[name] = (block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+    return _shared_arrays[name][1]
+
+def _step_columns(task: tuple) -> None:
+    """
+    Applies the vertical phases to one band of columns of a shared world.
+
+    Runs in a worker process. Columns don't affect each other in these
+    phases, so every band can run at once. Afterwards the band is copied
+    to the snapshot the strips compare against.
+
+    Args:
+        task: (shared block names and dtypes, grid shape, first column, end column,
+            whether the shared velocities are used)
+    """
+    blocks, shape, start, end, falling_speeds = task
+    world, ages, before, movable, velocities = (_attach_shared(name, shape, dtype) for name, dtype in blocks)
+    _step_box(world[:, start:end], movable[:, start:end], ages[:, start:end], _step_vertical,
+              velocities[:, start:end] if falling_speeds else None)
+    before[:, start:end] = world[:, start:end]
+
+def _step_strip(task: tuple) -> None:
+    """
+    Applies the lateral phases to one horizontal strip of a shared world.
+
+    Runs in a worker process. The strip can read and write one row above
+    and below itself, but only particles inside it move, and particles
+    that another strip already moved into it this tick stay put.
+
+    Args:
+        task: (shared block names and dtypes, grid shape, first row, end row, seed,
+            liquid spread)
+    """
+    blocks, shape, start, end, seed, liquid_spread = task
+    world, ages, before, movable, _ = (_attach_shared(name, shape, dtype) for name, dtype in blocks)
+    top, bottom = max(start - 1, 0), min(end + 1, shape[0])
+    strip_movable = np.zeros((bottom - top, shape[1]), dtype=bool)
+    rows = slice(start - top, end - top)
+    strip_movable[rows] = movable[start:end] & (world[start:end] == before[start:end])
+    _step_box(world[top:bottom], strip_movable, ages[top:bottom],
+              functools.partial(_step_lateral, rng=ParticleRandom(seed), liquid_spread=liquid_spread))
+
+class ParallelStepper:
+    """
+    Moves particles on several cores by splitting the world into bands.
+
+    Floating and falling only move particles within their column, so they
+    run first on bands of whole columns, all at once. That way a falling
+    column never gets cut in two.
+
+    The remaining phases run on horizontal strips in two rounds, even
+    strips then odd strips, so strips that run at the same time never
+    touch. A particle that crosses into the neighboring strip lands there
+    while that strip is idle, and isn't moved again when its turn comes, so
+    nothing is lost or moved twice. The round order flips every tick so no
+    boundary is always stepped first. Strips cover whole rows because
+    pooled liquid slides along an entire row in one tick.
+
+    The world and ages are copied into shared memory each tick. Use
+    share() to keep them there and skip the copies.
+
+    With one worker, or a world too short to split, everything runs in this
+    process.
+    """
+
+    def __init__(self, workers: int = None, min_strip_rows: int = 32):
+        """
+        Args:
+            workers: number of worker processes (defaults to the CPU count);
+                1 or less steps serially
+            min_strip_rows: smallest strip height worth sending to a worker
+        """
+        self.workers = workers if workers is not None else multiprocessing.cpu_count()
+        self.min_strip_rows = max(min_strip_rows, 4)
+        self.pool = None
+        self.blocks = []
+        self.shape = None
+        self.world = None
+        self.ages = None
+        self.velocities = None
+        self.flip = False
+
+    def _allocate(self, shape: tuple[int, int]) -> None:
+        """Creates the shared world, ages, snapshot, movable and velocity arrays for a grid shape."""
+        self._release()
+        arrays = []
+        for dtype in (np.uint8, np.uint16, np.uint8, np.bool_, np.uint8):
+            block = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            self.blocks.append((block, np.dtype(dtype).str))
+            arrays.append(np.ndarray(shape, dtype=dtype, buffer=block.buf))
+        self.world, self.ages, self.before, self.movable, self.velocities = arrays
+        self.shape = shape
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+
+    def _release(self) -> None:
+        """Frees the shared arrays."""
+        self.world = self.ages = self.before = self.movable = self.velocities = None
+        for block, _ in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+        self.shape = None
+
+    def close(self) -> None:
+        """Stops the worker processes and frees the shared memory."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def strips(self, rows: int) -> list[tuple[int, int]]:
+        """
+        Splits the rows into two strips per worker.
+
+        Args:
+            rows: number of rows in the world
+
+        Returns:
+            list[tuple[int, int]]: (first row, end row) of each strip, top to bottom
+        """
+        count = min(2 * self.workers, rows // self.min_strip_rows)
+        count -= count % 2
+        bounds = np.linspace(0, rows, count + 1).astype(int).tolist()
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def share(self, world: np.ndarray, ages: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Moves a world and its ages into shared memory so steps don't have to
+        copy them.
+
+        Args:
+            world: 2D array representing the simulation grid
+            ages: per-cell particle ages
+
+        Returns:
+            tuple: (world, ages) to use from now on in place of the originals
+        """
+        if self.workers <= 1 or len(self.strips(len(world))) < 2:
+            return world, ages
+        if self.shape != world.shape:
+            self._allocate(world.shape)
+        self.world[...] = world
+        self.ages[...] = ages
+        return self.world, self.ages
+
+    def step(self, world: np.ndarray, movable: np.ndarray, ages: np.ndarray,
+             rng: ParticleRandom = None, liquid_spread: int = LIQUID_SPREAD,
+             velocities: np.ndarray = None) -> None:
+        """
+        Applies falling, sinking, sliding and flowing to the whole world.
+
+        Args:
+            world: 2D array representing the simulation grid
+            movable: boolean mask of the particles that may move
+            ages: per-cell particle ages
+            rng: random source that seeds the strips (defaults to DEFAULT_RANDOM)
+            liquid_spread: cells a resting liquid drop moves sideways per tick
+            velocities: optional per-cell falling speeds (copied into shared
+                memory each tick; they are small)
+        """
+        rng = rng or DEFAULT_RANDOM
+        strips = self.strips(len(world)) if self.workers > 1 else []
+        if len(strips) < 2:
+            _step_box(world, movable, ages,
+                      functools.partial(_step_vectorized, rng=rng, liquid_spread=liquid_spread), velocities)
+            return
+
+        if self.shape != world.shape:
+            self._allocate(world.shape)
+        shared = world is self.world
+        if not shared:
+            self.world[...] = world
+            self.ages[...] = ages
+        self.movable[...] = movable
+        if velocities is not None:
+            self.velocities[...] = velocities
+
+        blocks = [(block.name, dtype) for block, dtype in self.blocks]
+        bounds = np.linspace(0, world.shape[1], self.workers + 1).astype(int).tolist()
+        self.pool.map(_step_columns, [(blocks, world.shape, start, end, velocities is not None)
+                                      for start, end in zip(bounds[:-1], bounds[1:])])
+
+        seeds = rng.seeds(len(strips))
+        tasks = [(blocks, world.shape, start, end, seed, liquid_spread)
+                 for (start, end), seed in zip(strips, seeds)]
+        phases = (tasks[0::2], tasks[1::2])
+        for phase in (phases[::-1] if self.flip else phases):
+            self.pool.map(_step_strip, phase)
+        self.flip = not self.flip
+
+        if not shared:
+            world[...] = self.world
+            ages[...] = self.ages
+        if velocities is not None:
+            velocities[...] = self.velocities
+
+# Snapshot files: a fixed header, the RNG state, then the grid and the ages
+SNAPSHOT_MAGIC = b"SAND"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_ENCODINGS = ["raw", "rle", "zlib"]  # stored as the index in the header
+SNAPSHOT_FILE = "sandgame.snap"
+# magic, version, encoding, flags, rows, cols, tick, world bytes, ages bytes
+_SNAPSHOT_HEADER = struct.Struct("<4sHBBIIQQQ")
+# Length of the ParticleRandom state that follows
+_SNAPSHOT_RNG = struct.Struct("<I")
+# Version 1 stored the random and np.random module states in a fixed-size block
+_SNAPSHOT_RNG_V1_SIZE = struct.calcsize("<625I?d624II?d")
+_SNAPSHOT_HAS_RNG = 1
+_SNAPSHOT_ALIGN = 64  # payloads start on a 64-byte boundary so they can be mapped directly
+
+def _aligned(offset: int) -> int:
+    """Rounds a file offset up to the next payload boundary."""
+    return -(-offset // _SNAPSHOT_ALIGN) * _SNAPSHOT_ALIGN
+
+def _rle_encode(grid: np.ndarray) -> bytes:
+    """
+    Run-length encodes a grid as run lengths (uint32) followed by run values.
+    
+    Args:
+        grid: array to encode
+        
+    Returns:
+        bytes: encoded runs
+    """
+    flat = grid.ravel()
+    if len(flat) == 0:
+        return b""
+    starts = np.flatnonzero(np.concatenate(([True], flat[1:] != flat[:-1])))
+    lengths = np.diff(np.append(starts, len(flat))).astype("<u4")
+    return lengths.tobytes() + flat[starts].astype(grid.dtype.newbyteorder("<")).tobytes()
+
+def _rle_decode(data, dtype: np.dtype, shape: tuple[int, int]) -> np.ndarray:
+    """
+    Expands runs written by _rle_encode back into a grid.
+    
+    Args:
+        data: encoded runs
+        dtype: type of the grid values
+        shape: (rows, cols) of the grid
+        
+    Returns:
+        np.ndarray: decoded grid
+    """
+    dtype = np.dtype(dtype).newbyteorder("<")
+    runs = len(data) // (4 + dtype.itemsize)
+    lengths = np.frombuffer(data, dtype="<u4", count=runs)
+    values = np.frombuffer(data, dtype=dtype, count=runs, offset=4 * runs)
+    return np.repeat(values, lengths).astype(dtype.newbyteorder("=")).reshape(shape)
+
+def _encode_grid(grid: np.ndarray, encoding: str):
+    """
+    Encodes a grid for a snapshot.
+    
+    Args:
+        grid: array to encode
+        encoding: one of SNAPSHOT_ENCODINGS
+        
+    Returns:
+        the grid itself for "raw" (written without a copy), otherwise bytes
+    """
+    if encoding == "raw":
+        return np.ascontiguousarray(grid, dtype=grid.dtype.newbyteorder("<"))
+    if encoding == "rle":
+        return _rle_encode(grid)
+    return zlib.compress(np.ascontiguousarray(grid, dtype=grid.dtype.newbyteorder("<")), 6)
+
+def _decode_grid(data, encoding: str, dtype: np.dtype, shape: tuple[int, int]) -> np.ndarray:
+    """
+    Decodes a grid read from a snapshot.
+    
+    Args:
+        data: encoded bytes (a view of the mapped file)
+        encoding: one of SNAPSHOT_ENCODINGS
+        dtype: type of the grid values
+        shape: (rows, cols) of the grid
+        
+    Returns:
+        np.ndarray: decoded grid
+    """
+    if encoding == "rle":
+        return _rle_decode(data, dtype, shape)
+    raw = zlib.decompress(data)
+    return np.frombuffer(raw, dtype=np.dtype(dtype).newbyteorder("<")).astype(dtype).reshape(shape)
+
+def save_snapshot(path: str, world: np.ndarray, ages: np.ndarray, tick: int = 0,
+                  encoding: str = "raw", rng: ParticleRandom = None) -> None:
+    """
+    Saves a world to a versioned binary snapshot.
+    
+    The file is created at its full size and memory-mapped, and the grids
+    are copied straight into it. It is written next to path and moved over
+    it when complete, so grids loaded from path (which map the old file)
+    can be saved back to it, and a failed save leaves the old file intact.
+    
+    Args:
+        path: file to write
+        world: 2D array representing the simulation grid
+        ages: per-cell particle ages
+        tick: simulation tick the snapshot is taken at
+        encoding: how the grids are stored, one of SNAPSHOT_ENCODINGS
+        rng: random source whose state is stored with the world, or None to leave it out
+    """
+    if encoding not in SNAPSHOT_ENCODINGS:
+        raise ValueError(f"unknown snapshot encoding {encoding!r}, expected one of {SNAPSHOT_ENCODINGS}")
+    world = np.asarray(world, dtype=np.uint8)
+    ages = np.asarray(ages, dtype=np.uint16)
+    if world.ndim != 2 or ages.shape != world.shape:
+        raise ValueError(f"world {world.shape} and ages {ages.shape} must be matching 2D grids")
+    rng_state = b""
+    if rng is not None:
+        rng_state = rng.getstate()
+        rng_state = _SNAPSHOT_RNG.pack(len(rng_state)) + rng_state
+    world_data = _encode_grid(world, encoding)
+    ages_data = _encode_grid(ages, encoding)
+    world_bytes, ages_bytes = memoryview(world_data).nbytes, memoryview(ages_data).nbytes
+    header = _SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, SNAPSHOT_ENCODINGS.index(encoding),
+                                   _SNAPSHOT_HAS_RNG if rng is not None else 0, world.shape[0], world.shape[1],
+                                   tick, world_bytes, ages_bytes)
+    world_offset = _aligned(len(header) + len(rng_state))
+    ages_offset = _aligned(world_offset + world_bytes)
+
+    temp_path = f"{path}.tmp"
+    try:
+        # An empty file can't be mapped, and a header always has content
+        out = np.memmap(temp_path, dtype=np.uint8, mode="w+", shape=(ages_offset + max(ages_bytes, 1),))
+        try:
+            out[:len(header)] = np.frombuffer(header, dtype=np.uint8)
+            out[len(header):len(header) + len(rng_state)] = np.frombuffer(rng_state, dtype=np.uint8)
+            out[world_offset:world_offset + world_bytes] = np.frombuffer(world_data, dtype=np.uint8)
+            out[ages_offset:ages_offset + ages_bytes] = np.frombuffer(ages_data, dtype=np.uint8)
+            out.flush()
+        finally:
+            del out
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def load_snapshot(path: str, rng: ParticleRandom = None) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Loads a world saved with save_snapshot.
+    
+    The file is memory-mapped. Raw grids are used in place (copy-on-write,
+    so stepping the world never changes the file) and only the pages that
+    are touched get read, so even very large levels open at once.
+    Compressed grids are decoded straight from the mapping.
+    
+    Args:
+        path: file to read
+        rng: random source to restore the saved state into, if one was saved
+        
+    Returns:
+        tuple: (world, ages, tick)
+    """
+    data = np.memmap(path, dtype=np.uint8, mode="c")
+    if len(data) < _SNAPSHOT_HEADER.size:
+        raise ValueError(f"{path} is too short to be a snapshot")
+    magic, version, encoding, flags, rows, cols, tick, world_bytes, ages_bytes = \
+        _SNAPSHOT_HEADER.unpack(data[:_SNAPSHOT_HEADER.size].tobytes())
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError(f"{path} is not a sand game snapshot")
+    if version > SNAPSHOT_VERSION:
+        raise ValueError(f"{path} is snapshot version {version}, newer than supported ({SNAPSHOT_VERSION})")
+    if encoding >= len(SNAPSHOT_ENCODINGS):
+        raise ValueError(f"{path} uses unknown encoding {encoding}")
+    encoding = SNAPSHOT_ENCODINGS[encoding]
+
+    offset = _SNAPSHOT_HEADER.size
+    if flags & _SNAPSHOT_HAS_RNG and version == 1:
+        offset += _SNAPSHOT_RNG_V1_SIZE
+    elif flags & _SNAPSHOT_HAS_RNG:
+        length, = _SNAPSHOT_RNG.unpack(data[offset:offset + _SNAPSHOT_RNG.size].tobytes())
+        offset += _SNAPSHOT_RNG.size
+        if rng is not None:
+            rng.setstate(data[offset:offset + length])
+        offset += length
+    world_offset = _aligned(offset)
+    ages_offset = _aligned(world_offset + world_bytes)
+    shape = (rows, cols)
+    if encoding == "raw":
+        world = np.ndarray(shape, dtype=np.uint8, buffer=data, offset=world_offset)
+        ages = np.ndarray(shape, dtype="<u2", buffer=data, offset=ages_offset)
+        return world, ages, tick
+    world = _decode_grid(data[world_offset:world_offset + world_bytes], encoding, np.uint8, shape)
+    ages = _decode_grid(data[ages_offset:ages_offset + ages_bytes], encoding, np.uint16, shape)
+    return world, ages, tick
+
+# Frame recording
+RECORD_FILE = "sandgame_recording.png"
+RECORD_POLICIES = ["drop", "batch"]  # what FrameRecorder.add does while the writer is behind
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    """Frames a PNG chunk with its length and CRC."""
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+def _png_image_data(pixels: np.ndarray, level: int) -> bytes:
+    """Compresses an RGB image as PNG image data, each row unfiltered."""
+    rows = np.zeros((pixels.shape[0], pixels.shape[1] * 3 + 1), dtype=np.uint8)
+    rows[:, 1:] = pixels.reshape(pixels.shape[0], -1)
+    return zlib.compress(rows.tobytes(), level)
+
+def _png_header(width: int, height: int) -> bytes:
+    """Builds the PNG signature and IHDR chunk for an 8-bit RGB image."""
+    return b"\x89PNG\r\n\x1a\n" + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+def save_png(path: str, pixels: np.ndarray, level: int = 6) -> None:
+    """
+    Writes an RGB image to a PNG file.
+    
+    Args:
+        path: file to write
+        pixels: (rows, columns, 3) uint8 array, top row first
+        level: zlib compression level, 0-9
+    """
+    with open(path, "wb") as f:
+        f.write(_png_header(pixels.shape[1], pixels.shape[0]))
+        f.write(_png_chunk(b"IDAT", _png_image_data(pixels, level)))
+        f.write(_png_chunk(b"IEND", b""))
+
+class FrameRecorder:
+    """
+    Records the world as RGB frames on a background thread.
+    
+    add() only copies the grid and hands it to a writer thread through a
+    bounded queue; rendering, scaling and compressing all happen on the
+    writer, so recording never waits on the disk. When the writer falls
+    behind, the policy decides what happens to new frames: "drop" skips
+    them, and "batch" collects them and hands them over together once
+    there is room (dropping the oldest if even that batch fills up).
+    
+    A path containing a run of # writes numbered PNGs (frame_####.png ->
+    frame_0000.png, ...), numbered by frame, so dropped frames leave gaps.
+    Any other path writes a single animated PNG.
+    """
+    
+    def __init__(self, path: str, scale: int = 1, every: int = 1, fps: float = TICKS_PER_SECOND,
+                 queue_size: int = 32, policy: str = "drop", level: int = 6):
+        """
+        Args:
+            path: numbered PNG pattern or animated PNG file (see above)
+            scale: pixels per cell along each side
+            every: record one frame every this many calls to add()
+            fps: playback rate of the animated PNG, in recorded ticks per second
+            queue_size: frames the queue (and a batch) holds at most
+            policy: one of RECORD_POLICIES
+            level: zlib compression level, 0-9
+        """
+        import queue
+        import threading
+        
+        if policy not in RECORD_POLICIES:
+            raise ValueError(f"policy must be one of {RECORD_POLICIES}, got {policy!r}")
+        if scale < 1 or every < 1 or queue_size < 1:
+            raise ValueError("scale, every and queue_size must be at least 1")
+        self.path = path
+        self.scale = scale
+        self.every = every
+        self.fps = fps
+        self.policy = policy
+        self.level = level
+        self.calls = 0
+        self.written = 0
+        self.dropped = 0
+        self.batch = []
+        self.error = None
+        self.queue = queue.Queue(queue_size)
+        self.queue_size = queue_size
+        # "frame_####.png" -> "frame_{0:04d}.png"
+        self.pattern = None
+        start = end = path.find("#")
+        if start >= 0:
+            while end < len(path) and path[end] == "#":
+                end += 1
+            self.pattern = path[:start].replace("{", "{{").replace("}", "}}") + f"{{0:0{end - start}d}}" \
+                + path[end:].replace("{", "{{").replace("}", "}}")
+        self.writer = threading.Thread(target=self._write_frames, name="FrameRecorder", daemon=True)
+        self.writer.start()
+    
+    def add(self, world: np.ndarray) -> bool:
+        """
+        Queues a frame of the world without waiting for the writer.
+        
+        Args:
+            world: 2D array representing the simulation grid
+            
+        Returns:
+            bool: True if the frame was queued or batched, False if it was skipped or dropped
+        """
+        import queue
+        
+        index = self.calls
+        self.calls += 1
+        if index % self.every:
+            return False
+        frame = (index // self.every, np.array(world, dtype=np.uint8))
+        if self.policy == "batch":
+            self.batch.append(frame)
+            if len(self.batch) > self.queue_size:
+                del self.batch[0]
+                self.dropped += 1
+            try:
+                self.queue.put_nowait(self.batch)
+            except queue.Full:
+                return True
+            self.batch = []
+            return True
+        try:
+            self.queue.put_nowait([frame])
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+    
+    def _write_frames(self) -> None:
+        """Writer thread: renders and writes queued frames until close() sends None."""
+        renderer = FrameRenderer()
+        animation = None
+        pending = None  # the last frame of an animation waits for the next to know its delay
+        try:
+            while True:
+                frames = self.queue.get()
+                if frames is None:
+                    break
+                for index, world in frames:
+                    pixels = renderer.render(world)
+                    if self.scale > 1:
+                        pixels = pixels.repeat(self.scale, axis=0).repeat(self.scale, axis=1)
+                    if self.pattern is not None:
+                        save_png(self.pattern.format(index), pixels, self.level)
+                        self.written += 1
+                        continue
+                    if animation is None:
+                        animation = _AnimatedPng(self.path, pixels.shape[1], pixels.shape[0], self.fps, self.level)
+                    if pending is not None:
+                        animation.write(pending[1], index - pending[0])
+                        self.written += 1
+                    pending = (index, pixels)
+            if pending is not None:
+                animation.write(pending[1], 1)
+                self.written += 1
+        except Exception as error:  # reported by close()
+            self.error = error
+            # Keep emptying the queue so add() never sees it stuck full
+            while self.queue.get() is not None:
+                pass
+        finally:
+            if animation is not None:
+                animation.close()
+    
+    def close(self) -> None:
+        """
+        Writes the remaining frames and finishes the file. This waits for
+        the writer.
+        
+        Raises:
+            Exception: whatever stopped the writer, if it failed
+        """
+        if self.writer.is_alive():
+            if self.batch:
+                self.queue.put(self.batch)
+                self.batch = []
+            self.queue.put(None)
+            self.writer.join()
+        if self.error is not None:
+            raise self.error
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+class _AnimatedPng:
+    """Writes frames to an animated PNG (APNG) as they arrive."""
+    
+    def __init__(self, path: str, width: int, height: int, fps: float, level: int):
+        self.file = open(path, "wb")
+        self.width, self.height = width, height
+        self.fps = fps
+        self.level = level
+        self.frames = 0
+        self.sequence = 0
+        self.file.write(_png_header(width, height))
+        # The frame count is filled in by close()
+        self.control = self.file.tell()
+        self.file.write(_png_chunk(b"acTL", struct.pack(">II", 1, 0)))
+    
+    def write(self, pixels: np.ndarray, ticks: int) -> None:
+        """Adds a frame shown for ticks / fps seconds."""
+        delay = struct.pack(">HH", min(ticks, 0xFFFF), min(round(self.fps), 0xFFFF))
+        control = struct.pack(">IIIII", self.sequence, self.width, self.height, 0, 0) + delay + b"\x00\x00"
+        self.file.write(_png_chunk(b"fcTL", control))
+        data = _png_image_data(pixels, self.level)
+        if self.frames == 0:
+            # The first frame doubles as the still image
+            self.file.write(_png_chunk(b"IDAT", data))
+            self.sequence += 1
+        else:
+            self.file.write(_png_chunk(b"fdAT", struct.pack(">I", self.sequence + 1) + data))
+            self.sequence += 2
+        self.frames += 1
+    
+    def close(self) -> None:
+        """Writes the end of the file and the frame count."""
+        self.file.write(_png_chunk(b"IEND", b""))
+        self.file.seek(self.control)
+        self.file.write(_png_chunk(b"acTL", struct.pack(">II", self.frames, 0)))
+        self.file.close()
+
+def draw_button(mode: int) -> None:
+    """
+    Draws the mode selection and clear buttons.
+    
+    Args:
+        mode: Current particle type selected
+    """
+    import dudraw
+    
+    # Draw mode button background
+    dudraw.set_pen_color(dudraw.GRAY)
+    dudraw.filled_rectangle(10, 95, 8, 3)
+    
+    # Draw mode button text
+    dudraw.set_pen_color(dudraw.WHITE)
+    dudraw.text(10, 95, f"Mode: {ELEMENTS[mode].name}")
+    
+    # Draw clear button in top right
+    dudraw.set_pen_color(dudraw.RED)
+    dudraw.filled_rectangle(95, 95, 4, 2)
+    dudraw.set_pen_color(dudraw.WHITE)
+    dudraw.text(95, 95, "Clear")
+
+def draw_profiler_hud(profiler: Profiler, window: int = 50) -> None:
+    """
+    Draws the frame rate, tick time and the three biggest costs under the
+    mode button.
+    
+    Args:
+        profiler: Profiler recording the game loop
+        window: number of recent frames to average over
+    """
+    import dudraw
+    
+    if not profiler.records:
+        return
+    recent = profiler.average(window)
+    lines = [f"{profiler.fps(window):.0f} FPS",
+             f"tick {recent['phases'].get('update', 0.0) * 1000:.1f} ms"]
+    for name, seconds in profiler.costs(recent)[:3]:
+        lines.append(f"{name} {seconds * 1000:.2f} ms")
+    
+    dudraw.set_pen_color(dudraw.BLACK)
+    dudraw.filled_rectangle(10, 91 - 1.5 * len(lines), 8, 1.5 * len(lines))
+    dudraw.set_pen_color(dudraw.WHITE)
+    for row, line in enumerate(lines):
+        dudraw.text(10, 90.5 - 3 * row, line)
+
+def is_button_clicked(mouse_x: float, mouse_y: float) -> tuple[bool, bool]:
+    """
+    Checks if mode or clear buttons were clicked.
+    
+    Args:
+        mouse_x: x-coordinate of mouse click
+        mouse_y: y-coordinate of mouse click
+        
+    Returns:
+        tuple[bool, bool]: (mode_clicked, clear_clicked)
+    """
+    mode_clicked = (2 <= mouse_x <= 18 and 92 <= mouse_y <= 98)
+    clear_clicked = (91 <= mouse_x <= 99 and 93 <= mouse_y <= 97)  # Updated clear button hitbox
+    return (mode_clicked, clear_clicked)
+
+class FrameScheduler:
+    """
+    Runs the simulation at a fixed tick rate, independent of how fast
+    frames are drawn.
+    
+    Real time is added to an accumulator that is paid out in fixed ticks,
+    so when drawing falls behind several ticks run before the next frame,
+    and when a frame is slow the frames in between are simply skipped.
+    Frames are capped at their own rate, and in between the loop sleeps
+    until the next tick or frame is due instead of for a fixed time.
+    """
+    
+    def __init__(self, tick_rate: float = TICKS_PER_SECOND, max_fps: float = MAX_FPS,
+                 max_ticks: int = MAX_TICKS_PER_FRAME, clock=time.perf_counter):
+        """
+        Args:
+            tick_rate: simulation ticks per second
+            max_fps: most frames drawn per second (None for no cap)
+            max_ticks: most ticks run at once; if the simulation can't keep
+                up, the time beyond this is dropped so it slows down instead
+                of falling further and further behind
+            clock: function returning the current time in seconds
+        """
+        self.tick_time = 1 / tick_rate
+        self.frame_time = 1 / max_fps if max_fps else 0.0
+        self.max_ticks = max_ticks
+        self.clock = clock
+        self.last = clock()
+        self.accumulator = 0.0
+        self.next_frame = self.last
+        self.dirty = True
+    
+    def ticks_due(self) -> int:
+        """
+        Collects the time since the last call and pays it out in ticks.
+        
+        Returns:
+            int: number of simulation ticks to run now
+        """
+        now = self.clock()
+        self.accumulator += now - self.last
+        self.last = now
+        ticks = int(self.accumulator / self.tick_time)
+        if ticks > self.max_ticks:
+            ticks = self.max_ticks
+            self.accumulator = 0.0
+        else:
+            self.accumulator -= ticks * self.tick_time
+        if ticks:
+            self.dirty = True
+        return ticks
+    
+    def frame_due(self) -> bool:
+        """
+        Checks whether a frame should be drawn now: something changed since
+        the last frame and the frame cap allows another one. Returns True at
+        most once per frame.
+        
+        Returns:
+            bool: True if the caller should draw a frame
+        """
+        now = self.clock()
+        if not self.dirty or now < self.next_frame:
+            return False
+        # Late frames aren't made up for, the next one is just a frame later
+        self.next_frame = max(self.next_frame + self.frame_time, now)
+        self.dirty = False
+        return True
+    
+    def redraw(self) -> None:
+        """Asks for a frame even if no tick ran, e.g. after the mode changed."""
+        self.dirty = True
+    
+    def resume(self) -> None:
+        """Forgets the time since the last tick, e.g. after the loop sat idle."""
+        self.last = self.clock()
+        self.accumulator = 0.0
+    
+    def wait(self) -> None:
+        """Sleeps until the next tick or frame is due."""
+        now = self.clock()
+        due = self.last + self.tick_time - self.accumulator
+        if self.dirty:
+            due = min(due, self.next_frame)
+        if due > now:
+            time.sleep(due - now)
+
+class Debouncer:
+    """
+    Lets an action through at most once per interval without blocking, so
+    holding the mouse on a button doesn't trigger it every frame.
+    """
+    
+    def __init__(self, interval: float = CLICK_DEBOUNCE, clock=time.perf_counter):
+        """
+        Args:
+            interval: seconds to ignore the action for after it fires
+            clock: function returning the current time in seconds
+        """
+        self.interval = interval
+        self.clock = clock
+        self.until = 0.0
+    
+    def ready(self) -> bool:
+        """
+        Checks whether the action may fire now, and starts the interval if so.
+        
+        Returns:
+            bool: True if the action should run
+        """
+        now = self.clock()
+        if now < self.until:
+            return False
+        self.until = now + self.interval
+        return True
+
+HISTORY_BUDGET = 32 * 2**20  # bytes of rewind history a World keeps
+HISTORY_KEYFRAME = 100       # ticks between full copies of the world in the history
+
+class History:
+    """
+    Rewind history of a World, kept within a memory budget.
+    
+    After every tick, record() stores only the cells that changed: their
+    flat indices, with the old and the new values of the grid, the ages
+    and the falling speeds. A delta can be applied backward (old values)
+    or forward (new values), so any tick still in the history can be
+    rebuilt from the present one. Every keyframe_every ticks a full copy
+    of the world is kept as well, and a seek starts from whichever of
+    those or the present tick is closest, so it never applies more than
+    about keyframe_every / 2 deltas. When the history outgrows its budget
+    the oldest ticks are dropped, like a ring buffer.
+    
+    Seeking back keeps the ticks after it, so they can be seeked to again;
+    recording a tick from a rewound world drops them. The random source
+    isn't rewound: playing on from an earlier tick can turn out differently.
+    """
+    
+    def __init__(self, world: "World", budget: int = HISTORY_BUDGET,
+                 keyframe_every: int = HISTORY_KEYFRAME):
+        """
+        Args:
+            world: the world to record, at the tick the history starts from
+            budget: most bytes of deltas and keyframes to keep
+            keyframe_every: ticks between full copies of the world
+        """
+        if keyframe_every < 1:
+            raise ValueError(f"keyframe_every must be at least 1, not {keyframe_every}")
+        self.world = world
+        self.budget = budget
+        self.keyframe_every = keyframe_every
+        self.reset()
+    
+    def _layers(self) -> list[np.ndarray]:
+        """Flat views of the world's grid, ages and (if it has them) falling speeds."""
+        world = self.world
+        layers = [world.grid, world.ages] + ([] if world.velocities is None else [world.velocities])
+        return [layer.reshape(-1) for layer in layers]
+    
+    def reset(self) -> None:
+        """Forgets everything and starts over from the world as it is now."""
+        self.start = self.position = self.world.tick
+        self.deltas = deque()  # deltas[k] goes from tick start + k to start + k + 1
+        self.keyframes = {}                # tick -> copies of the layers
+        self.strokes = []                  # ticks at which brush strokes began
+        self.previous = [layer.copy() for layer in self._layers()]
+        self.size = 0
+        self._keyframe()
+    
+    @property
+    def end(self) -> int:
+        """The latest tick in the history."""
+        return self.start + len(self.deltas)
+    
+    def _keyframe(self) -> None:
+        """Keeps a full copy of the world at the current position."""
+        copies = [layer.copy() for layer in self.previous]
+        self.keyframes[self.position] = copies
+        self.size += sum(copy.nbytes for copy in copies)
+    
+    def record(self) -> None:
+        """
+        Adds the tick the world just ran. A world that was resized since
+        the last tick (e.g. by loading) restarts the history.
+        """
+        layers = self._layers()
+        if layers[0].shape != self.previous[0].shape or len(layers) != len(self.previous):
+            self.reset()
+            return
+        # Recording from a rewound position replaces the ticks after it
+        while self.end > self.position:
+            self._drop(self.deltas.pop())
+        for tick in [tick for tick in self.keyframes if tick > self.position]:
+            self._drop_keyframe(tick)
+        
+        changed = layers[0] != self.previous[0]
+        for layer, previous in zip(layers[1:], self.previous[1:]):
+            changed |= layer != previous
+        indices = np.flatnonzero(changed).astype(np.uint32)
+        delta = (indices, [previous[indices] for previous in self.previous],
+                 [layer[indices] for layer in layers])
+        for layer, previous in zip(layers, self.previous):
+            previous[indices] = layer[indices]
+        self.deltas.append(delta)
+        self.size += self._delta_size(delta)
+        self.position += 1
+        if self.position % self.keyframe_every == 0:
+            self._keyframe()
+        
+        # Drop the oldest ticks, and the keyframes and strokes before them, to stay in budget
+        while self.size > self.budget and len(self.deltas) > 1:
+            self._drop(self.deltas.popleft())
+            self.start += 1
+            for tick in [tick for tick in self.keyframes if tick < self.start]:
+                self._drop_keyframe(tick)
+        while self.strokes and self.strokes[0] < self.start:
+            self.strokes.pop(0)
+    
+    @staticmethod
+    def _delta_size(delta: tuple) -> int:
+        """Bytes held by one delta."""
+        indices, old, new = delta
+        return indices.nbytes + sum(values.nbytes for values in old + new)
+    
+    def _drop(self, delta: tuple) -> None:
+        """Takes a removed delta off the size."""
+        self.size -= self._delta_size(delta)
+    
+    def _drop_keyframe(self, tick: int) -> None:
+        """Removes the keyframe at a tick."""
+        self.size -= sum(copy.nbytes for copy in self.keyframes.pop(tick))
+    
+    def seek(self, tick: int) -> int:
+        """
+        Puts the world back (or forward) to a tick in the history.
+        
+        Args:
+            tick: tick to go to; clamped to the ticks still held
+            
+        Returns:
+            int: the tick the world is at now
+        """
+        tick = min(max(tick, self.start), self.end)
+        origin = min([self.position] + list(self.keyframes), key=lambda origin: abs(origin - tick))
+        if origin != self.position:
+            for previous, copy in zip(self.previous, self.keyframes[origin]):
+                previous[...] = copy
+        # Deltas are applied to the copies, then the world is brought in line in one go
+        for k in range(origin - self.start, tick - self.start):
+            indices, _, new = self.deltas[k]
+            for previous, values in zip(self.previous, new):
+                previous[indices] = values
+        for k in range(origin - self.start - 1, tick - self.start - 1, -1):
+            indices, old, _ = self.deltas[k]
+            for previous, values in zip(self.previous, old):
+                previous[indices] = values
+        for layer, previous in zip(self._layers(), self.previous):
+            layer[...] = previous
+        
+        self.position = self.world.tick = tick
+        self.world.wake()
+        return tick
+    
+    def mark_stroke(self) -> None:
+        """Notes that a brush stroke begins now, before any of it is placed."""
+        if not self.strokes or self.strokes[-1] != self.position:
+            self.strokes.append(self.position)
+    
+    def undo_stroke(self) -> bool:
+        """
+        Rewinds to just before the last brush stroke still in the history.
+        
+        Returns:
+            bool: whether there was a stroke to undo
+        """
+        # Strokes in ticks that a rewind left ahead of the world are skipped too
+        while self.strokes and self.strokes[-1] > self.position:
+            self.strokes.pop()
+        if not self.strokes:
+            return False
+        self.seek(self.strokes.pop())
+        return True
+
+class World:
+    """
+    A simulation that can be embedded in other programs: the grid, the
+    particle ages, the random source and the tick count in one object.
+    
+        world = World(200, seed=1)
+        world.spawn(SAND, 100, 20, radius=10)
+        world.step(100)
+        print(world.counts())
+    
+    The handlers are built once, when the world is made; register elements
+    before creating it. The grid can be read without copying, as an ndarray
+    (array, or np.asarray(world)) or through the buffer protocol
+    (memoryview(world) on Python 3.12+, or buffer()). These read-only views
+    stay valid until load() replaces the grid.
+    
+    Each step records how many cells changed (changed). Once nothing has
+    changed for IDLE_TICKS ticks and nothing is left that changes on its
+    own (fire, embers, melting snow), the world is idle: stepping it would
+    do nothing visible, so a game loop can stop until the next input.
+    Placing, clearing or loading wakes it.
+    
+    With the vectorized engine, falling particles speed up as they fall
+    (see update_particles_vectorized); their speeds are in velocities.
+    
+    Every tick is kept in history (a History) for rewinding, within
+    HISTORY_BUDGET bytes:
+    
+        world.history.seek(world.tick - 200)
+        world.history.undo_stroke()
+    """
+    
+    def __init__(self, rows: int, cols: int = None, seed: int = None,
+                 update=update_particles_vectorized, chunks: bool = True,
+                 oil_spread: int = None, liquid_spread: int = LIQUID_SPREAD,
+                 accelerate: bool = True, history: int = HISTORY_BUDGET):
+        """
+        Args:
+            rows: number of rows
+            cols: number of columns (defaults to rows, a square grid)
+            seed: seed for the random source, or None for a random one
+            update: engine stepping the grid, update_particles_vectorized,
+                update_particles or update_particles_compiled
+            chunks: whether to skip settled parts of the grid with a ChunkTracker
+            oil_spread: cells fire spreads through oil per tick, or None to light a whole body at once
+            liquid_spread: cells a resting liquid drop moves sideways per tick, or
+                None to drop straight into the nearest gap
+            accelerate: whether falling particles speed up as they fall; only
+                update_particles_vectorized supports it, the other engines
+                always move them one cell per tick
+            history: bytes of rewind history to keep, or 0 for none
+        """
+        self.grid = create_world(rows, cols)
+        self.ages = create_ages(rows, cols)
+        self.velocities = (create_velocities(rows, cols)
+                           if accelerate and update is update_particles_vectorized else None)
+        self.rng = ParticleRandom(seed)
+        self.tick = 0
+        self.update = update
+        self.oil_spread = oil_spread
+        self.chunks = ChunkTracker() if chunks else None
+        self.creator = ParticleCreator(self.rng)
+        self.interaction = ParticleInteraction(self.rng, liquid_spread)
+        self.changed = 0
+        self.quiet_ticks = 0
+        self.history = History(self, history) if history else None
+    
+    @property
+    def idle(self) -> bool:
+        """Whether nothing has happened for IDLE_TICKS ticks (see the class docstring)."""
+        return self.quiet_ticks >= IDLE_TICKS
+    
+    def wake(self, top: int = 0, left: int = 0, rows: int = None, cols: int = None) -> None:
+        """
+        Marks the world as changed from outside, e.g. after drawing into grid
+        directly. Given the block of cells that changed, only the chunks
+        around it wake up; otherwise all of them do.
+        
+        Args:
+            top: first row of the block
+            left: first column of the block
+            rows: number of rows in the block, or None for the whole grid
+            cols: number of columns in the block, or None for the whole grid
+        """
+        self.quiet_ticks = 0
+        if self.chunks is not None:
+            if rows is None or cols is None:
+                self.chunks.wake_all()
+            else:
+                self.chunks.mark(top, left, rows, cols)
+    
+    @property
+    def shape(self) -> tuple[int, int]:
+        """(rows, columns) of the grid."""
+        return self.grid.shape
+    
+    @property
+    def array(self) -> np.ndarray:
+        """Read-only ndarray view of the grid, without copying it."""
+        view = self.grid.view()
+        view.flags.writeable = False
+        return view
+    
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        if copy:
+            return np.array(self.grid, dtype=dtype)
+        return self.array if dtype is None else self.array.astype(dtype, copy=False)
+    
+    def buffer(self) -> memoryview:
+        """
+        Read-only memoryview of the grid's bytes, row by row, without copying.
+        
+        Returns:
+            memoryview: 2D view with format "B"
+        """
+        return memoryview(self.grid).toreadonly()
+    
+    def __buffer__(self, flags: int) -> memoryview:
+        return self.buffer()
+    
+    def step(self, n: int = 1, profiler: Profiler = None) -> int:
+        """
+        Advances the simulation.
+        
+        Args:
+            n: number of ticks to run
+            profiler: optional Profiler to record the ticks in
+            
+        Returns:
+            int: the tick count afterward
+        """
+        for _ in range(n):
+            before = self.grid.copy() if self.chunks is None else None
+            options = {} if self.velocities is None else {"velocities": self.velocities}
+            self.update(self.grid, self.ages, self.chunks, oil_spread=self.oil_spread,
+                        profiler=profiler, interaction=self.interaction, **options)
+            self.tick += 1
+            if self.history is not None:
+                self.history.record()
+            if before is None:
+                self.changed, live = self.chunks.changed, self.chunks.live
+            else:
+                self.changed = int(np.count_nonzero(self.grid != before))
+                live = _of_type(self.grid[:-1], RISING_TYPES + CUSTOM_TYPES + AGING).any()
+            self.quiet_ticks = 0 if self.changed or live else self.quiet_ticks + 1
+        return self.tick
+    
+    def spawn(self, particle_type: int, x: int, y: int, radius: float = None,
+              density: float = 1.0) -> int:
+        """
+        Places particles of a registered type, into empty cells only. For
+        lines, rectangles, polygons and masks use the shape methods of
+        creator (a ParticleCreator) on grid.
+        
+        Args:
+            particle_type: type of particle to place
+            x: column to place at
+            y: row to place at
+            radius: fill a disk of this radius; None uses the element's
+                brush, like a mouse click
+            density: chance of each cell in the disk getting a particle, 0 to 1
+            
+        Returns:
+            int: number of particles placed
+        """
+        if particle_type not in ELEMENTS:
+            raise ValueError(f"unknown particle type {particle_type}")
+        if radius is not None:
+            reach = int(radius) + 1
+            self.wake(y - reach, x - reach, 2 * reach + 1, 2 * reach + 1)
+            return self.creator.circle(self.grid, x, y, radius, particle_type, density)
+        left, right, up, down = self.creator.reach(particle_type)
+        self.wake(y - up, x - left, up + down + 1, left + right + 1)
+        before = np.count_nonzero(self.grid == particle_type)
+        self.creator.create(self.grid, x, y, particle_type)
+        return int(np.count_nonzero(self.grid == particle_type) - before)
+    
+    def stroke(self, x0: int, y0: int, x1: int, y1: int, particle_type: int) -> int:
+        """
+        Places an element's brush all along a line, like dragging the mouse
+        from (x0, y0) to (x1, y1) (see ParticleCreator.stroke).
+        
+        Args:
+            x0, y0: column and row the stroke starts at
+            x1, y1: column and row it ends at
+            particle_type: type of particle to place
+            
+        Returns:
+            int: number of particles placed
+        """
+        if particle_type not in ELEMENTS:
+            raise ValueError(f"unknown particle type {particle_type}")
+        left, right, up, down = self.creator.reach(particle_type)
+        top, first = min(y0, y1) - up, min(x0, x1) - left
+        self.wake(top, first, max(y0, y1) + down + 1 - top, max(x0, x1) + right + 1 - first)
+        return self.creator.stroke(self.grid, x0, y0, x1, y1, particle_type)
+    
+    def clear(self) -> None:
+        """Empties the grid. The tick count and random source carry on."""
+        self.grid[:] = EMPTY
+        self.ages[:] = 0
+        if self.velocities is not None:
+            self.velocities[:] = 0
+        self.wake()
+    
+    def count(self, particle_type: int) -> int:
+        """
+        Counts the particles of one type.
+        
+        Args:
+            particle_type: type to count
+            
+        Returns:
+            int: number of cells holding it
+        """
+        return int(np.count_nonzero(self.grid == particle_type))
+    
+    def counts(self) -> dict:
+        """
+        Counts the particles of every registered type.
+        
+        Returns:
+            dict: {element name: number of cells holding it}
+        """
+        totals = np.bincount(self.grid.ravel(), minlength=256)
+        return {element.name: int(totals[code]) for code, element in ELEMENTS.items()}
+    
+    def save(self, path: str, encoding: str = "raw") -> None:
+        """
+        Saves the world, tick and random state to a snapshot (see save_snapshot).
+        
+        Args:
+            path: file to write
+            encoding: one of SNAPSHOT_ENCODINGS
+        """
+        save_snapshot(path, self.grid, self.ages, self.tick, encoding, self.rng)
+    
+    def load(self, path: str) -> None:
+        """
+        Replaces the world with a snapshot (see load_snapshot). Views of the
+        old grid no longer follow the world afterward. Snapshots don't hold
+        falling speeds, so every particle starts out at rest. The history
+        starts over from the loaded world.
+        
+        Args:
+            path: file to read
+        """
+        self.grid, self.ages, self.tick = load_snapshot(path, self.rng)
+        if self.velocities is not None:
+            self.velocities = create_velocities(*self.grid.shape)
+        if self.history is not None:
+            self.history.reset()
+        self.wake()
+
+class SimulationThread:
+    """
+    Runs the simulation on its own thread so slow frames don't slow it down.
+    
+    The thread owns a World: it steps it at the fixed tick rate and, at
+    most once per frame, copies it into the back one of two buffers and
+    swaps them. Drawing reads the front buffer through render(), which
+    holds a lock only while it turns the grid into pixels; the copy itself
+    happens outside the lock, since the renderer never reads the back
+    buffer, and the profiler's records are only added under the same lock.
+    Input doesn't touch the world directly either; it is sent with send()
+    as events, which the thread handles before its next ticks. While the
+    world is idle (see World) or paused and no brush is held, the thread
+    neither steps nor publishes; it sleeps until the next event arrives:
+    
+        ("brush", x, y, type)  place particles there every tick, like a held mouse
+                               (and play on if paused)
+        ("release",)           stop placing particles
+        ("scrub", ticks)       pause and move that many ticks through the history
+        ("play",)              play on from the current tick
+        ("undo",)              rewind to before the last brush stroke
+        ("clear",)             empty the world
+        ("save",) ("load",)    save or load SNAPSHOT_FILE
+        ("profile",)           turn the profiler on or off
+        ("export",)            export the profiler's frames to PROFILE_FILE
+        ("record",)            start or stop recording to RECORD_FILE
+        ("quit",)              stop the thread
+    """
+    
+    def __init__(self, world: World, scheduler: FrameScheduler = None):
+        """
+        Args:
+            world: the simulation, owned by the thread from now on
+            scheduler: paces the ticks and buffer swaps (defaults to FrameScheduler())
+        """
+        import queue
+        import threading
+        
+        self.world = world
+        self.scheduler = scheduler or FrameScheduler()
+        self.brush = None       # (x, y, type) while particles are being placed
+        self.last_brush = None  # where they were placed last tick
+        self.profiler = None
+        self.recorder = None
+        self.error = None
+        self.running = False
+        self.idle = False
+        self.paused = False
+        
+        self.events = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.buffers = [np.array(world.grid), np.array(world.grid)]
+        self.front = 0
+        self.published = 0  # swaps so far, so the renderer can tell a new frame from an old one
+        self.thread = threading.Thread(target=self._run, name="SimulationThread", daemon=True)
+    
+    def start(self) -> "SimulationThread":
+        """Starts the thread and returns self."""
+        self.running = True
+        self.thread.start()
+        return self
+    
+    def send(self, *event) -> None:
+        """
+        Queues an input event for the simulation (see the class docstring).
+        
+        Args:
+            event: event name followed by its arguments
+        """
+        self.events.put(event)
+    
+    def is_alive(self) -> bool:
+        """Checks whether the simulation is still running."""
+        return self.thread.is_alive()
+    
+    def stop(self) -> None:
+        """
+        Asks the thread to quit and waits for it.
+        
+        Raises:
+            Exception: whatever stopped the thread, if it failed
+        """
+        self.send("quit")
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+    
+    def render(self, renderer: FrameRenderer) -> np.ndarray:
+        """
+        Renders the most recently completed world.
+        
+        Args:
+            renderer: FrameRenderer to build the image with
+            
+        Returns:
+            np.ndarray: (rows, columns, 3) uint8 image, see FrameRenderer.render
+        """
+        with self.lock:
+            return renderer.render(self.buffers[self.front])
+    
+    def _publish(self) -> None:
+        """Copies the world into the back buffer and swaps the buffers."""
+        back = self.buffers[1 - self.front]
+        if back.shape != self.world.shape:
+            back = np.empty(self.world.shape, dtype=np.uint8)
+        np.copyto(back, self.world.grid)
+        with self.lock:
+            self.buffers[1 - self.front] = back
+            self.front = 1 - self.front
+            self.published += 1
+    
+    def _handle(self, event: tuple) -> None:
+        """Applies one input event."""
+        name, args = event[0], event[1:]
+        if name == "brush":
+            if self.brush is None and self.world.history is not None:
+                self.world.history.mark_stroke()
+            self.brush = args
+            self.paused = False
+        elif name == "release":
+            self.brush = self.last_brush = None
+        elif name in ("scrub", "undo") and self.world.history is not None:
+            if name == "scrub":
+                self.paused = True
+                self.world.history.seek(self.world.tick + args[0])
+            else:
+                self.world.history.undo_stroke()
+            # The thread may wait for input next, so show the result now
+            self._publish()
+        elif name == "play":
+            self.paused = False
+        elif name == "clear":
+            self.world.clear()
+            self.scheduler.redraw()
+        elif name == "save":
+            self.world.save(SNAPSHOT_FILE)
+        elif name == "load":
+            try:
+                self.world.load(SNAPSHOT_FILE)
+                self.scheduler.redraw()
+            except (OSError, ValueError) as error:
+                print(f"Couldn't load {SNAPSHOT_FILE}: {error}")
+        elif name == "profile":
+            self.profiler = Profiler() if self.profiler is None else None
+            self.scheduler.redraw()
+        elif name == "export" and self.profiler is not None:
+            self.profiler.export(PROFILE_FILE + ".csv")
+            self.profiler.export(PROFILE_FILE + ".json")
+        elif name == "record":
+            if self.recorder is None:
+                self.recorder = FrameRecorder(RECORD_FILE, scale=4)
+            else:
+                self.recorder.close()
+                self.recorder = None
+        elif name == "quit":
+            self.running = False
+    
+    def _run(self) -> None:
+        """Thread body: handles events, runs the ticks that are due and publishes frames."""
+        import queue
+        
+        try:
+            while self.running:
+                if (self.world.idle or self.paused) and self.brush is None:
+                    # Nothing will move until something happens; wait for input
+                    self.idle = True
+                    self._handle(self.events.get())
+                    self.idle = False
+                    self.scheduler.resume()
+                    continue
+                self.scheduler.wait()
+                ticks = self.scheduler.ticks_due()
+                clock = time.perf_counter()
+                while True:
+                    try:
+                        self._handle(self.events.get_nowait())
+                    except queue.Empty:
+                        break
+                if not self.running:
+                    break
+                if self.paused and self.brush is None:
+                    continue
+                # A profiler record covers everything from one swap to the next
+                profiler = self.profiler
+                if profiler is not None:
+                    if profiler.record is None:
+                        profiler.begin_frame()
+                    profiler.lap("input", clock)
+                
+                world = self.world
+                for _ in range(ticks):
+                    if self.brush is not None:
+                        # Stroke from where the brush was last tick, so a fast drag leaves no gaps
+                        x, y, particle_type = self.brush
+                        start = self.last_brush or (x, y)
+                        world.stroke(start[0], start[1], x, y, particle_type)
+                        self.last_brush = (x, y)
+                    world.step(profiler=profiler)
+                    if self.recorder is not None:
+                        self.recorder.add(world.grid)
+                
+                if self.scheduler.frame_due():
+                    clock = time.perf_counter()
+                    self._publish()
+                    if profiler is not None:
+                        profiler.lap("publish", clock)
+                        with self.lock:
+                            profiler.end_frame()
+        except Exception as error:  # reported by stop()
+            self.error = error
+        finally:
+            self.running = False
+            if self.recorder is not None:
+                self.recorder.close()
+
+def main():
+    """
+    Main function that runs the game.
+    Handles:
+    - Window setup
+    - User input, sent to the simulation thread as events
+    - Drawing the latest finished world
+    The particle updates run on a SimulationThread.
+    """
+    # dudraw is only imported for the window so headless runs never load it
+    import dudraw
+    
+    size = 100
+    dudraw.set_canvas_size(500, 500)
+    dudraw.set_x_scale(0, size)
+    dudraw.set_y_scale(0, size)
+    
+    # Initialize state variables
+    current_mode = MODES[0]
+    renderer = FrameRenderer()
+    simulation = SimulationThread(World(size)).start()
+    button = Debouncer()
+    frame_time = 1 / MAX_FPS
+    next_frame = time.perf_counter()
+    drawn = None     # the simulation frame on screen
+    redraw = True    # whether something else on screen changed
+    placing = False  # whether the mouse is placing particles
+    
+    # Main game loop
+    while simulation.is_alive():
+        # Handle user input
+        brush = None
+        if dudraw.mouse_is_pressed():
+            mouse_x = dudraw.mouse_x()
+            mouse_y = dudraw.mouse_y()
+            
+            mode_clicked, clear_clicked = is_button_clicked(mouse_x, mouse_y)
+            
+            # Handle button clicks
+            if mode_clicked:
+                if button.ready():
+                    # Cycle through the placeable particle types
+                    current_mode = MODES[(MODES.index(current_mode) + 1) % len(MODES)]
+                    redraw = True
+            elif clear_clicked:
+                if button.ready():
+                    simulation.send("clear")
+            else:
+                brush = (int(mouse_x), size - int(mouse_y))
+        if brush is not None:
+            simulation.send("brush", brush[0], brush[1], current_mode)
+            placing = True
+        elif placing:
+            simulation.send("release")
+            placing = False
+        
+        if dudraw.has_next_key_typed():
+            key = dudraw.next_key_typed()
+            if key == 'q':
+                break
+            # s: save, l: load, p: profiler, e: export the profile, r: record,
+            # [ ]: scrub a second back or forward, space: play, z: undo the last stroke
+            events = {'s': ("save",), 'l': ("load",), 'p': ("profile",), 'e': ("export",), 'r': ("record",),
+                      '[': ("scrub", -TICKS_PER_SECOND), ']': ("scrub", TICKS_PER_SECOND),
+                      ' ': ("play",), 'z': ("undo",)}
+            if key in events:
+                simulation.send(*events[key])
+                redraw = True
+        
+        if simulation.published != drawn or redraw:
+            drawn, redraw = simulation.published, False
+            renderer.blit(simulation.render(renderer))
+            draw_button(current_mode)
+            profiler = simulation.profiler
+            if profiler is not None:
+                with simulation.lock:
+                    draw_profiler_hud(profiler)
+            dudraw.show()
+        
+        if simulation.idle and not redraw:
+            # Nothing to draw; keep reading input, but rarely
+            check_for_events = _dudraw_private("_check_for_events")
+            if check_for_events is not None:
+                check_for_events()
+            else:
+                dudraw.show(0)
+            time.sleep(IDLE_POLL)
+            next_frame = time.perf_counter()
+            continue
+        # Late frames aren't made up for, the next one is just a frame later
+        now = time.perf_counter()
+        next_frame = max(next_frame + frame_time, now)
+        time.sleep(next_frame - now)
+    
+    simulation.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,314 @@
+"""
+    Filename: benchmark.py
+
+    Description of program:
+    Runs the sand game without a window on scripted scenes and measures how
+    fast the simulation steps. Nothing here imports dudraw or pygame, so it
+    can run on machines without a display.
+
+    Usage:
+        python benchmark.py
+        python benchmark.py --sizes 64 128 256 --ticks 300 --output results.json
+        python benchmark.py --scenes sand_column --engine cellwise --chunks
+        python benchmark.py --scenes light_rain --engine cellwise --active
+        python benchmark.py --sizes 1024 --engine compiled
+        python benchmark.py --sizes 1024 --scenes sand_column light_rain --accelerate
+        python benchmark.py --sizes 128 --trace "trace_{scene}_{size}.csv"
+        python benchmark.py --sizes 128 --record "frames_{scene}/frame_####.png"
+"""
+
+import argparse
+import json
+import os
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+
+from Newman_project3part1_sandgame import (
+    EMPTY, SAND, RAIN, FLOOR, FIRE, EMBER, OIL, SNOW, RECORD_POLICIES,
+    ActiveParticles, ChunkTracker, FrameRecorder, ParallelStepper, ParticleRandom, Profiler, create_ages, create_world, update_particles, update_particles_compiled,
+    create_velocities, update_particles_vectorized,
+)
+
+ENGINES = {
+    "vectorized": update_particles_vectorized,
+    "cellwise": update_particles,
+    "compiled": update_particles_compiled,
+}
+
+
+def _basin(world: np.ndarray) -> tuple[int, int, int]:
+    """
+    Builds a floor basin in the lower half of the world.
+
+    Args:
+        world: 2D array representing the simulation grid
+
+    Returns:
+        tuple[int, int, int]: (top row of the walls, left wall column, right wall column)
+    """
+    size = len(world)
+    top, left, right = size // 2, size // 8, size - 1 - size // 8
+    world[top:, left] = FLOOR
+    world[top:, right] = FLOOR
+    world[-1, left:right + 1] = FLOOR
+    return top, left, right
+
+
+def sand_column(size: int) -> np.ndarray:
+    """A tall column of sand dropped onto an empty floor."""
+    world = create_world(size)
+    width = max(size // 8, 1)
+    left = (size - width) // 2
+    world[:size // 2, left:left + width] = SAND
+    return world
+
+
+def rain_basin(size: int) -> np.ndarray:
+    """A floor basin with a block of rain falling in and leveling out."""
+    world = create_world(size)
+    top, left, right = _basin(world)
+    world[size // 8:top + size // 4, left + 1:right] = RAIN
+    return world
+
+
+def burning_oil_lake(size: int) -> np.ndarray:
+    """Oil floating on a basin of water, lit by a few sparks above it."""
+    world = create_world(size)
+    top, left, right = _basin(world)
+    water = size - 1 - size // 8
+    world[water:-1, left + 1:right] = RAIN
+    world[water - 2:water, left + 1:right] = OIL
+    world[water - 4, left + 1:right:max(size // 16, 1)] = FIRE
+    return world
+
+
+def snowfall_onto_fire(size: int) -> np.ndarray:
+    """Scattered snow falling onto a bed of fire."""
+    world = create_world(size)
+    rng = np.random.default_rng(size)
+    world[:size // 4][rng.random((size // 4, size)) < 0.3] = SNOW
+    world[-3:, :] = FIRE
+    return world
+
+
+def ember_storm(size: int) -> np.ndarray:
+    """A dense cloud of embers rising off a line of fire."""
+    world = create_world(size)
+    rng = np.random.default_rng(size)
+    world[size // 2:-1][rng.random((size - 1 - size // 2, size)) < 0.25] = EMBER
+    world[-1, :] = FIRE
+    return world
+
+
+def light_rain(size: int) -> np.ndarray:
+    """A few raindrops falling onto a floor, mostly empty space."""
+    world = create_world(size)
+    rng = np.random.default_rng(size)
+    world[:size // 2][rng.random((size // 2, size)) < 0.002] = RAIN
+    world[-1, :] = FLOOR
+    return world
+
+
+SCENES = {
+    "sand_column": sand_column,
+    "rain_basin": rain_basin,
+    "burning_oil_lake": burning_oil_lake,
+    "snowfall_onto_fire": snowfall_onto_fire,
+    "ember_storm": ember_storm,
+    "light_rain": light_rain,
+}
+
+
+def run_headless(scene: str, size: int, ticks: int, engine: str = "vectorized",
+                 chunks: bool = False, seed: int = 0, workers: int = 1,
+                 profiler: Profiler = None, active: bool = False,
+                 recorder: FrameRecorder = None, accelerate: bool = False) -> tuple[np.ndarray, list[float]]:
+    """
+    Builds a scene and steps it without drawing anything.
+
+    Args:
+        scene: name of a scene in SCENES
+        size: dimension of the square grid
+        ticks: number of simulation steps to run
+        engine: name of an engine in ENGINES
+        chunks: whether to skip settled chunks with a ChunkTracker
+        seed: seed for the engines' random source
+        workers: worker processes for the vectorized engine (1 runs serially)
+        profiler: optional Profiler that records every tick
+        active: whether the cellwise engine visits only particles, with ActiveParticles
+        recorder: optional FrameRecorder that gets a frame after every tick
+            (handing it over counts toward the tick's time)
+        accelerate: whether falling particles speed up as they fall (vectorized engine)
+
+    Returns:
+        tuple: (final world, seconds taken by each tick)
+    """
+    world = SCENES[scene](size)
+    ages = create_ages(size)
+    step = ENGINES[engine]
+    tracker = ChunkTracker() if chunks else None
+
+    latencies = []
+    with ParallelStepper(workers) as stepper:
+        options = {"rng": ParticleRandom(seed), "profiler": profiler}
+        if active:
+            options["active"] = ActiveParticles()
+        if accelerate:
+            options["velocities"] = create_velocities(size)
+        if workers > 1:
+            world, ages = stepper.share(world, ages)
+            options["stepper"] = stepper
+        for _ in range(ticks):
+            start = time.perf_counter()
+            step(world, ages, tracker, **options)
+            if recorder is not None:
+                recorder.add(world)
+            latencies.append(time.perf_counter() - start)
+        world = world.copy()
+    return world, latencies
+
+
+def peak_memory(scene: str, size: int, ticks: int, engine: str = "vectorized",
+                chunks: bool = False, seed: int = 0, workers: int = 1, active: bool = False,
+                accelerate: bool = False) -> int:
+    """
+    Measures the peak memory allocated while a scene runs.
+
+    This is a separate run because tracing allocations slows the
+    simulation down and would skew the timings.
+
+    Returns:
+        int: peak traced allocation in bytes
+    """
+    tracemalloc.start()
+    try:
+        run_headless(scene, size, ticks, engine, chunks, seed, workers, active=active, accelerate=accelerate)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(scenes: list[str], sizes: list[int], ticks: int, engine: str = "vectorized",
+              chunks: bool = False, seed: int = 0, memory: bool = True, workers: int = 1,
+              trace: str = None, active: bool = False, record: str = None,
+              record_options: dict = None, accelerate: bool = False) -> list[dict]:
+    """
+    Times every scene at every grid size.
+
+    Args:
+        scenes: names of scenes to run
+        sizes: grid sizes to run each scene at
+        ticks: number of steps per run
+        engine: name of an engine in ENGINES
+        chunks: whether to skip settled chunks with a ChunkTracker
+        seed: seed for the engines' random source
+        memory: whether to also measure peak memory
+        workers: worker processes for the vectorized engine (1 runs serially)
+        trace: path with {scene} and {size} placeholders; when given, each
+            run is repeated with a Profiler and its trace written there
+            (.csv or .json)
+        active: whether the cellwise engine visits only particles, with ActiveParticles
+        record: path with {scene} and {size} placeholders; when given, every
+            tick is recorded there with a FrameRecorder (see its path rules)
+        record_options: keyword arguments for the FrameRecorder
+        accelerate: whether falling particles speed up as they fall (vectorized engine)
+
+    Returns:
+        list[dict]: one result per (scene, size)
+    """
+    results = []
+    for scene in scenes:
+        for size in sizes:
+            recorder = None
+            if record:
+                path = record.format(scene=scene, size=size)
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                recorder = FrameRecorder(path, **(record_options or {}))
+            world, latencies = run_headless(scene, size, ticks, engine, chunks, seed, workers,
+                                            active=active, recorder=recorder, accelerate=accelerate)
+            latencies = np.array(latencies)
+            result = {
+                "scene": scene,
+                "size": size,
+                "ticks": ticks,
+                "ticks_per_sec": round(ticks / latencies.sum(), 2),
+                "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+                "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 3),
+                "peak_memory_bytes": (peak_memory(scene, size, ticks, engine, chunks, seed, workers, active,
+                                                  accelerate) if memory else None),
+                "particles": int(np.count_nonzero((world != EMPTY) & (world != FLOOR))),
+            }
+            if recorder is not None:
+                recorder.close()
+                result["frames_written"] = recorder.written
+                result["frames_dropped"] = recorder.dropped
+            if trace:
+                # Profiled separately, like peak memory, so it doesn't skew the timings
+                profiler = Profiler(history=ticks)
+                run_headless(scene, size, ticks, engine, chunks, seed, workers, profiler, active,
+                             accelerate=accelerate)
+                profiler.export(trace.format(scene=scene, size=size))
+            results.append(result)
+            print(f"{scene:<20} {size:>5} {result['ticks_per_sec']:>10.1f} t/s "
+                  f"p50 {result['p50_ms']:>8.3f} ms  p99 {result['p99_ms']:>8.3f} ms")
+    return results
+
+
+def main():
+    """Parses the command line, runs the benchmark and writes the JSON report."""
+    parser = argparse.ArgumentParser(description="Headless sand game benchmark")
+    parser.add_argument("--scenes", nargs="+", choices=list(SCENES), default=list(SCENES))
+    parser.add_argument("--sizes", nargs="+", type=int, default=[64, 128, 256])
+    parser.add_argument("--ticks", type=int, default=200)
+    parser.add_argument("--engine", choices=list(ENGINES), default="vectorized")
+    parser.add_argument("--chunks", action="store_true", help="skip settled chunks")
+    parser.add_argument("--active", action="store_true",
+                        help="visit only cells holding particles (cellwise engine)")
+    parser.add_argument("--accelerate", action="store_true",
+                        help="falling particles speed up as they fall (vectorized engine)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes for the vectorized engine (1 runs serially)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory run")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--trace", help="also write a per-tick profile for every run to this path "
+                                        "(.csv or .json, with {scene} and {size} placeholders)")
+    parser.add_argument("--record", help="record every tick to numbered PNGs (a path with a run of #) "
+                                         "or an animated PNG, with {scene} and {size} placeholders")
+    parser.add_argument("--record-scale", type=int, default=1, help="pixels per cell in recorded frames")
+    parser.add_argument("--record-policy", choices=RECORD_POLICIES, default="drop",
+                        help="what happens to frames while the writer is behind")
+    args = parser.parse_args()
+    if args.workers > 1 and args.engine != "vectorized":
+        parser.error("--workers needs the vectorized engine")
+    if args.active and (args.engine != "cellwise" or args.chunks):
+        parser.error("--active needs the cellwise engine and can't be combined with --chunks")
+    if args.accelerate and args.engine != "vectorized":
+        parser.error("--accelerate needs the vectorized engine")
+
+    results = benchmark(args.scenes, args.sizes, args.ticks, args.engine,
+                        args.chunks, args.seed, not args.no_memory, args.workers, args.trace, args.active,
+                        args.record, {"scale": args.record_scale, "policy": args.record_policy},
+                        args.accelerate)
+    report = {
+        "engine": args.engine,
+        "chunks": args.chunks,
+        "active": args.active,
+        "accelerate": args.accelerate,
+        "workers": args.workers,
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
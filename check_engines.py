@@ -0,0 +1,311 @@
+"""
+    Filename: check_engines.py
+
+    Description of program:
+    Checks that the engine variants that are meant to give the same world
+    still do. Each check steps the benchmark scenes from the same seed
+    both ways and compares the grids and the ages after every tick,
+    reporting the first tick where they differ. Exits with status 1 if
+    any check fails, so it can run after every change.
+
+        active    update_particles with ActiveParticles vs a full scan
+        compiled  the update_particles_compiled kernel vs update_particles
+        chunks    the same, both skipping settled chunks with a ChunkTracker
+        world     World with each engine on non-square grids, with and
+                  without chunks, vs the engine called directly; a World
+                  with the compiled engine must run the kernel when numba
+                  is installed
+        ignite    ignite_oil spreading through a line of oil at each spread
+        snapshot  saving a loaded snapshot back to the same file, in every
+                  pair of encodings
+
+    Usage:
+        python check_engines.py
+        python check_engines.py --checks active --sizes 24 48 --ticks 200 --seeds 0 1 2
+        python check_engines.py --checks compiled --sizes 64 --ticks 500
+        python check_engines.py --checks ignite snapshot
+"""
+
+import argparse
+import itertools
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+import Newman_project3part1_sandgame as game
+from Newman_project3part1_sandgame import (
+    FIRE, FLOOR, MODES, OIL, SAND, SNAPSHOT_ENCODINGS, ActiveParticles, ChunkTracker, ParticleCreator,
+    ParticleRandom, World,
+    create_ages, create_world, ignite_oil, load_snapshot, save_snapshot, update_particles, update_particles_compiled, update_particles_vectorized, _kernel_tables, _step_kernel,
+)
+from benchmark import SCENES
+
+BRUSH_EVERY = 7  # ticks between brush strokes in the scenes
+CHUNK_SIZE = 4   # chunk size for the chunks check
+SHAPES = [(24, 40), (40, 24)]  # (rows, columns) of the grids the world check runs on
+
+
+def _compare(scene: str, size: int, ticks: int, seed: int, step_a, step_b) -> int:
+    """
+    Steps a scene two ways from the same seed, placing the same particles
+    with a brush along the way.
+
+    Args:
+        scene: name of a scene in SCENES
+        size: dimension of the square grid
+        ticks: number of steps to compare
+        seed: seed for both random sources
+        step_a: step(world, ages, rng, creator, tick) for the reference engine
+        step_b: the same for the engine checked against it
+
+    Returns:
+        int: first tick after which the worlds differ, or -1 if they never did
+    """
+    runs = []
+    for _ in range(2):
+        world = SCENES[scene](size)
+        rng = ParticleRandom(seed)
+        runs.append((world, create_ages(size), rng, ParticleCreator(rng)))
+    for tick in range(ticks):
+        for step, (world, ages, rng, creator) in zip((step_a, step_b), runs):
+            step(world, ages, rng, creator, tick)
+        (world_a, ages_a, *_), (world_b, ages_b, *_) = runs
+        if not (np.array_equal(world_a, world_b) and np.array_equal(ages_a, ages_b)):
+            return tick
+    return -1
+
+
+def _brush(world: np.ndarray, creator: ParticleCreator, tick: int, chunks: ChunkTracker = None) -> None:
+    """
+    Places a brush of a different element every BRUSH_EVERY ticks, marking
+    where it reaches in chunks if given.
+    """
+    if tick % BRUSH_EVERY == 0:
+        x, y, particle_type = tick % len(world[0]), 2, MODES[tick // BRUSH_EVERY % len(MODES)]
+        if chunks is not None:
+            left, right, up, down = creator.reach(particle_type)
+            chunks.mark(y - up, x - left, up + down + 1, left + right + 1)
+        creator.create(world, x, y, particle_type)
+
+
+def check_active() -> tuple:
+    """update_particles visiting only the tracked particles vs the full scan."""
+    def full_scan(world, ages, rng, creator, tick):
+        _brush(world, creator, tick)
+        update_particles(world, ages, rng=rng)
+
+    trackers = {}
+
+    def tracked(world, ages, rng, creator, tick):
+        active = trackers.setdefault(id(world), ActiveParticles())
+        # Placing particles goes through the tracker so it sees them
+        _brush(active.attach(world), creator, tick)
+        update_particles(world, ages, rng=rng, active=active)
+
+    return full_scan, tracked
+
+
+def check_compiled() -> tuple:
+    """
+    The kernel behind update_particles_compiled vs update_particles.
+
+    The kernel is run directly, so this checks its rules even without
+    numba, where they run as plain Python and update_particles_compiled
+    would just fall back to update_particles.
+    """
+    def cellwise(world, ages, rng, creator, tick):
+        _brush(world, creator, tick)
+        update_particles(world, ages, rng=rng)
+
+    tables = _kernel_tables()
+
+    def kernel(world, ages, rng, creator, tick):
+        _brush(world, creator, tick)
+        _step_kernel(world, ages, tables, rng=rng)
+
+    return cellwise, kernel
+
+
+def check_chunks() -> tuple:
+    """
+    The kernel vs update_particles, each with a ChunkTracker of its own.
+    The chunks are small, so the rows a tick covers are often fewer than
+    the grid's.
+    """
+    trackers = {}
+
+    def cellwise(world, ages, rng, creator, tick):
+        chunks = trackers.setdefault(id(world), ChunkTracker(CHUNK_SIZE))
+        _brush(world, creator, tick, chunks)
+        update_particles(world, ages, chunks, rng=rng)
+
+    tables = _kernel_tables()
+
+    def kernel(world, ages, rng, creator, tick):
+        chunks = trackers.setdefault(id(world), ChunkTracker(CHUNK_SIZE))
+        _brush(world, creator, tick, chunks)
+        _step_kernel(world, ages, tables, rng=rng, chunks=chunks)
+
+    return cellwise, kernel
+
+
+CHECKS = {
+    "active": check_active,
+    "compiled": check_compiled,
+    "chunks": check_chunks,
+}
+
+
+def check_world(ticks: int, seed: int) -> list[str]:
+    """
+    Steps a World with each engine on non-square grids, with and without
+    chunks, next to the same engine called directly, with a row of sand
+    across the whole width dropping onto a floor. With numba installed,
+    a World on the compiled engine must step with the kernel rather than
+    fall back to update_particles.
+
+    Args:
+        ticks: number of steps per run (at least the rows, for the sand to land)
+        seed: seed for both random sources
+
+    Returns:
+        list[str]: one line per run that failed
+    """
+    failures = []
+    step_kernel = game._step_kernel
+    kernel_ticks = []
+
+    def counted(world, *args, **kwargs):
+        kernel_ticks.append(world)
+        step_kernel(world, *args, **kwargs)
+
+    for rows, cols in SHAPES:
+        for update in (update_particles, update_particles_compiled, update_particles_vectorized):
+            for chunks in (False, True):
+                world = World(rows, cols, seed=seed, update=update, chunks=chunks, accelerate=False, history=0)
+                world.grid[0] = SAND
+                world.grid[1, ::3] = MODES[1]
+                world.grid[-1] = FLOOR
+                grid, ages, rng = world.grid.copy(), world.ages.copy(), ParticleRandom(seed)
+                tracker = ChunkTracker() if chunks else None
+                name = f"{update.__name__} {rows}x{cols}{' chunks' if chunks else ''}"
+                kernel_ticks.clear()
+                game._step_kernel = counted
+                try:
+                    for tick in range(ticks):
+                        world.step()
+                        update(grid, ages, tracker, rng=rng)
+                        if not np.array_equal(world.grid, grid):
+                            failures.append(f"{name}: differs after tick {tick}")
+                            break
+                    else:
+                        if (world.grid[:rows // 2] == SAND).any():
+                            failures.append(f"{name}: sand left hanging in the top half")
+                        stepped = sum(stepped is world.grid for stepped in kernel_ticks)
+                        if update is update_particles_compiled and game.numba is not None and stepped != ticks:
+                            failures.append(f"{name}: the kernel ran {stepped} of {ticks} ticks")
+                except IndexError as error:
+                    failures.append(f"{name}: {error}")
+                finally:
+                    game._step_kernel = step_kernel
+    return failures
+
+
+def check_ignite() -> list[str]:
+    """
+    Lights one end of a line of oil with ignite_oil at each spread and
+    checks how far the fire got after one tick.
+
+    Returns:
+        list[str]: one line per spread that failed
+    """
+    failures = []
+    for spread, burnt in ((None, 10), (1, 1), (3, 3), (0, ValueError), (-1, ValueError)):
+        world, ages = create_world(4, 12), create_ages(4, 12)
+        world[1, 0], world[1, 1:11] = FIRE, OIL
+        try:
+            ignite_oil(world, ages, spread)
+        except ValueError:
+            got = ValueError
+        else:
+            got = int(np.count_nonzero(world[1, 1:11] == FIRE))
+        if got != burnt:
+            failures.append(f"spread {spread}: expected {getattr(burnt, '__name__', burnt)}, "
+                            f"got {getattr(got, '__name__', got)}")
+    return failures
+
+
+def check_snapshot() -> list[str]:
+    """
+    Saves a world, loads it and saves the loaded grids back to the same
+    file, for every pair of encodings, and checks the file still holds
+    the world. Raw grids are loaded as views of the file, so this catches
+    a save that overwrites the file while reading from it.
+
+    Returns:
+        list[str]: one line per pair of encodings that failed
+    """
+    world, ages = create_world(64, 48), create_ages(64, 48)
+    world[-1], world[10:20, 5:30], world[30, ::2] = FLOOR, SAND, OIL
+    ages[world == SAND] = 7
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "check.snap")
+        for first, second in itertools.product(SNAPSHOT_ENCODINGS, repeat=2):
+            name = f"{first} then {second}"
+            try:
+                save_snapshot(path, world, ages, 5, first)
+                loaded_world, loaded_ages, tick = load_snapshot(path)
+                save_snapshot(path, loaded_world, loaded_ages, tick, second)
+                del loaded_world, loaded_ages
+                saved_world, saved_ages, tick = load_snapshot(path)
+                if not (np.array_equal(saved_world, world) and np.array_equal(saved_ages, ages) and tick == 5):
+                    failures.append(f"{name}: the saved world differs")
+                del saved_world, saved_ages
+            except (OSError, ValueError) as error:
+                failures.append(f"{name}: {error}")
+    return failures
+
+
+def main():
+    """Parses the command line and runs the checks."""
+    parser = argparse.ArgumentParser(description="Sand game engine equivalence checks")
+    extra = ["world", "ignite", "snapshot"]
+    parser.add_argument("--checks", nargs="+", choices=list(CHECKS) + extra, default=list(CHECKS) + extra)
+    parser.add_argument("--scenes", nargs="+", choices=list(SCENES), default=list(SCENES))
+    parser.add_argument("--sizes", nargs="+", type=int, default=[24])
+    parser.add_argument("--ticks", type=int, default=100)
+    parser.add_argument("--seeds", nargs="+", type=int, default=[0])
+    args = parser.parse_args()
+
+    failures = 0
+    for name in args.checks:
+        if name == "world":
+            for seed in args.seeds:
+                lines = check_world(max(args.ticks, max(rows for rows, _ in SHAPES)), seed)
+                failures += len(lines)
+                for line in lines or ["ok"]:
+                    print(f"{name:<10} seed {seed:<3} {line}")
+            continue
+        if name in ("ignite", "snapshot"):
+            lines = check_ignite() if name == "ignite" else check_snapshot()
+            failures += len(lines)
+            for line in lines or ["ok"]:
+                print(f"{name:<10} {line}")
+            continue
+        for scene in args.scenes:
+            for size in args.sizes:
+                for seed in args.seeds:
+                    tick = _compare(scene, size, args.ticks, seed, *CHECKS[name]())
+                    if tick >= 0:
+                        failures += 1
+                    print(f"{name:<10} {scene:<20} {size:>5} seed {seed:<3} "
+                          f"{'ok' if tick < 0 else f'differs after tick {tick}'}")
+    print(f"{failures} failed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+    Filename: sweep.py
+
+    Description of program:
+    Runs the sand game headless over a grid of rule parameters and scene
+    seeds, spread across a process pool, to tune rules like the fire
+    lifetime without playing every candidate by hand. Each run's metrics
+    are appended to a JSON Lines file as soon as it finishes, and runs
+    already in that file are skipped, so an interrupted sweep picks up
+    where it stopped.
+
+    Usage:
+        python sweep.py --scenes snowfall_onto_fire --param FIRE_LIFETIME=150,300,450 --seeds 0 1 2
+        python sweep.py --scenes burning_oil_lake --param EMBER_CHANCE=0.01,0.02 \
+            --param OIL_MAX_DEPTH=1,2,3 --sizes 64 --ticks 2000 --workers 4
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import Newman_project3part1_sandgame as game
+from Newman_project3part1_sandgame import ELEMENTS, FIRE, create_ages, ParticleRandom
+from benchmark import ENGINES, SCENES
+
+# Rule constants a sweep may change, with the values they had at import
+TUNABLE = {name: getattr(game, name) for name in
+           ("FIRE_LIFETIME", "SNOW_MELT_TIME", "FIRE_MELT_SPEED", "EMBER_CHANCE", "OIL_MAX_DEPTH",
+            "LIQUID_SPREAD")}
+SETTLE_TICKS = 20  # ticks without a change before a scene counts as settled
+# Types that change on their own (burn out, rise, melt), so a scene holding any isn't settled
+LIVE_TYPES = game.RISING_TYPES + game.CUSTOM_TYPES + game.AGING
+
+
+def run_scenario(task: dict) -> dict:
+    """
+    Runs one scene with one set of rule parameters and measures it.
+
+    The parameters are set as the game module's constants for the run and
+    put back afterward, so a worker process can run any number of tasks.
+
+    Args:
+        task: {"scene", "size", "ticks", "engine", "seed", "params": {constant: value}}
+
+    Returns:
+        dict: the task plus its metrics: ticks_to_settle (None if it never
+        settled; a scene with fire, embers or snow left isn't settled),
+        burn_ticks (ticks with fire in the world), particles remaining by
+        element name, ticks_per_sec and p99_ms (None for a run of 0 ticks)
+    """
+    for name, value in task["params"].items():
+        if name not in TUNABLE:
+            raise ValueError(f"{name} isn't a tunable rule, expected one of {list(TUNABLE)}")
+    try:
+        for name, default in TUNABLE.items():
+            setattr(game, name, task["params"].get(name, default))
+        world = SCENES[task["scene"]](task["size"])
+        ages = create_ages(task["size"])
+        rng = ParticleRandom(task["seed"])
+        step = ENGINES[task["engine"]]
+        kwargs = {"liquid_spread": game.LIQUID_SPREAD}
+
+        latencies = []
+        tick = last_change = -1
+        burn_ticks = 0
+        live = False
+        previous = world.copy()
+        for tick in range(task["ticks"]):
+            start = time.perf_counter()
+            step(world, ages, rng=rng, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            if not np.array_equal(world, previous):
+                last_change = tick
+                np.copyto(previous, world)
+            if (world == FIRE).any():
+                burn_ticks += 1
+            # Fire, embers and aging snow change on their own even when nothing moved
+            # (particles in the bottom row are never updated, as in World.step)
+            live = np.isin(world[:-1], LIVE_TYPES).any()
+            if not live and task["ticks"] - tick > SETTLE_TICKS and tick - last_change >= SETTLE_TICKS:
+                # Nothing has moved for a while and nothing is left that changes; it won't change again
+                break
+    finally:
+        for name, default in TUNABLE.items():
+            setattr(game, name, default)
+
+    counts = np.bincount(world.ravel(), minlength=256)
+    latencies = np.array(latencies)
+    settled = not live and tick - last_change >= SETTLE_TICKS
+    return dict(task, **{
+        "ticks_run": tick + 1,
+        "ticks_to_settle": last_change + 1 if settled else None,
+        "burn_ticks": burn_ticks,
+        "particles": {element.name: int(counts[code]) for code, element in ELEMENTS.items()},
+        "ticks_per_sec": round(len(latencies) / latencies.sum(), 2) if len(latencies) else None,
+        "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 3) if len(latencies) else None,
+    })
+
+
+def run_key(task: dict) -> str:
+    """Identifies a run by everything that went into it, to skip it on resume."""
+    return json.dumps({key: task[key] for key in ("scene", "size", "ticks", "engine", "seed", "params")},
+                      sort_keys=True)
+
+
+def sweep_tasks(scenes: list[str], sizes: list[int], ticks: int, engine: str, seeds: list[int],
+                grid: dict) -> list[dict]:
+    """
+    Lists every combination of scene, size, seed and parameter values.
+
+    Args:
+        scenes: names of scenes in SCENES
+        sizes: grid sizes
+        ticks: most ticks per run
+        engine: name of an engine in ENGINES
+        seeds: seeds for the random source
+        grid: {constant name: list of values to try}
+
+    Returns:
+        list[dict]: one task per run, for run_scenario
+    """
+    names = sorted(grid)
+    tasks = []
+    for scene, size, seed, values in itertools.product(scenes, sizes, seeds,
+                                                       itertools.product(*(grid[name] for name in names))):
+        tasks.append({"scene": scene, "size": size, "ticks": ticks, "engine": engine, "seed": seed,
+                      "params": dict(zip(names, values))})
+    return tasks
+
+
+def finished_runs(path: str) -> set:
+    """
+    Reads the keys of the runs already in a results file.
+
+    Args:
+        path: JSON Lines results file; it may not exist yet
+
+    Returns:
+        set: run_key of every complete line
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                done.add(run_key(json.loads(line)))
+            except (ValueError, KeyError):
+                pass  # a line cut off by an interrupted run is run again
+    return done
+
+
+def sweep(tasks: list[dict], output: str, workers: int = None) -> int:
+    """
+    Runs the tasks not yet in the output file and appends each result as
+    it finishes.
+
+    Args:
+        tasks: runs from sweep_tasks
+        output: JSON Lines file to append results to
+        workers: worker processes (defaults to one per core; 1 runs in this process)
+
+    Returns:
+        int: number of runs done now
+    """
+    done = finished_runs(output)
+    todo = [task for task in tasks if run_key(task) not in done]
+    print(f"{len(tasks) - len(todo)} of {len(tasks)} runs already in {output}")
+    if not todo:
+        return 0
+    workers = min(workers or os.cpu_count() or 1, len(todo))
+    with open(output, "a") as f:
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                results = pool.imap_unordered(run_scenario, todo)
+                _write_results(results, f, len(todo))
+        else:
+            _write_results(map(run_scenario, todo), f, len(todo))
+    return len(todo)
+
+
+def _write_results(results, f, total: int) -> None:
+    """Streams results to the file as they arrive, one JSON object per line."""
+    for count, result in enumerate(results, 1):
+        f.write(json.dumps(result) + "\n")
+        f.flush()
+        settle, speed = result["ticks_to_settle"], result["ticks_per_sec"]
+        print(f"[{count}/{total}] {result['scene']:<20} seed {result['seed']:<3} {result['params']} "
+              f"settled {'never' if settle is None else settle:>6}  burned {result['burn_ticks']:>6}  "
+              f"{'-' if speed is None else f'{speed:.1f}':>8} t/s")
+
+
+def _parse_param(text: str) -> tuple[str, list]:
+    """Parses NAME=v1,v2,... into the name and its values (ints where possible)."""
+    name, _, values = text.partition("=")
+    if name not in TUNABLE or not values:
+        raise argparse.ArgumentTypeError(f"expected NAME=v1,v2,... with NAME one of {list(TUNABLE)}")
+    parse = float if isinstance(TUNABLE[name], float) else int
+    try:
+        return name, [parse(value) for value in values.split(",")]
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+
+def main():
+    """Parses the command line and runs the sweep."""
+    parser = argparse.ArgumentParser(description="Headless sand game parameter sweep")
+    parser.add_argument("--scenes", nargs="+", choices=list(SCENES), default=list(SCENES))
+    parser.add_argument("--sizes", nargs="+", type=int, default=[64])
+    parser.add_argument("--ticks", type=int, default=1000, help="most ticks per run")
+    parser.add_argument("--seeds", nargs="+", type=int, default=[0])
+    parser.add_argument("--engine", choices=["vectorized", "cellwise"], default="vectorized")
+    parser.add_argument("--param", action="append", type=_parse_param, default=[],
+                        help=f"NAME=v1,v2,... to try, one of {', '.join(TUNABLE)}; repeat for a grid")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--output", default="sweep_results.jsonl")
+    args = parser.parse_args()
+
+    tasks = sweep_tasks(args.scenes, args.sizes, args.ticks, args.engine, args.seeds, dict(args.param))
+    sweep(tasks, args.output, args.workers)
+
+
+if __name__ == "__main__":
+    main()